@@ -1,15 +1,82 @@
+import itertools
+import logging
 import os
-from typing import Generator
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.concurrency import run_in_threadpool
+
+from .metrics import DB_READ_SESSIONS, observe_pool
+from .tracing import instrument_engine
 
 # URL подключения к БД берётся из переменной окружения DATABASE_URL.
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Как HTTP-обработчики работают с БД:
+# - async: asyncpg + AsyncSession, запрос не занимает поток из пула Starlette;
+# - sync:  psycopg2, каждый вызов БД уходит в пул потоков (прежнее поведение, для сравнения).
+DB_MODE = os.getenv("DB_MODE", "async").lower()
+
+# Реплики для чтения: DATABASE_READ_URLS — через запятую, или одна DATABASE_READ_URL.
+# Без них все запросы идут в DATABASE_URL.
+DATABASE_READ_URLS = [
+    url.strip()
+    for url in (os.getenv("DATABASE_READ_URLS") or os.getenv("DATABASE_READ_URL", "")).split(",")
+    if url.strip()
+]
+# На сколько секунд исключать реплику, к которой не удалось подключиться.
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "10"))
+
+logger = logging.getLogger(__name__)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, который отдаёт в /metrics время ожидания соединения и заполненность пула."""
+
+    metrics_name = "sync"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        conn = super()._do_get()
+        observe_pool(self.metrics_name, self, time.perf_counter() - started)
+        return conn
+
+    def _do_return_conn(self, record) -> None:
+        super()._do_return_conn(record)
+        observe_pool(self.metrics_name, self)
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+
+def _async_url(url: str) -> str:
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+
+# Синхронный engine нужен всегда: создание таблиц при старте и фоновые потоки.
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, poolclass=TimedQueuePool)
+instrument_engine(engine)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+# Сессии HTTP-запросов не «протухают» после commit: иначе чтение атрибута
+# после commit ушло бы в БД синхронно прямо из event loop.
+_RequestSessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_MODE == "async":
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True, poolclass=TimedAsyncQueuePool)
+    instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 
 class Base(DeclarativeBase):
     """Базовый класс декларативных моделей SQLAlchemy."""
@@ -17,10 +84,176 @@ class Base(DeclarativeBase):
     pass
 
 
-def get_db() -> Generator[Session, None, None]:
+class SyncSessionAdapter:
+    """Синхронная Session с интерфейсом AsyncSession (режим DB_MODE=sync).
+
+    Каждый вызов, который ходит в БД, выполняется в пуле потоков, поэтому
+    одни и те же `async def` обработчики работают в обоих режимах.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance) -> None:
+        self.sync_session.add(instance)
+
+    def add_all(self, instances) -> None:
+        self.sync_session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def delete(self, instance) -> None:
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self) -> None:
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def refresh(self, instance) -> None:
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def commit(self) -> None:
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self) -> None:
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self) -> None:
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        """Как AsyncSession.run_sync: вызывает fn(session, ...) с синхронной сессией."""
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def connection(self):
+        return await run_in_threadpool(self.sync_session.connection)
+
+
+class Replica:
+    """Реплика для чтения: свой пул соединений и момент, до которого она исключена."""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.down_until = 0.0
+        self.engine = None
+        self.async_engine = None
+        # Пул с собственным именем в метриках db_pool_*.
+        pool_class = TimedAsyncQueuePool if DB_MODE == "async" else TimedQueuePool
+        pool_class = type(f"{name}Pool", (pool_class,), {"metrics_name": name})
+        if DB_MODE == "async":
+            self.async_engine = create_async_engine(_async_url(url), pool_pre_ping=True, poolclass=pool_class)
+            instrument_engine(self.async_engine.sync_engine)
+            self.sessionmaker = async_sessionmaker(bind=self.async_engine, autoflush=False, expire_on_commit=False)
+        else:
+            self.engine = create_engine(url, pool_pre_ping=True, poolclass=pool_class)
+            instrument_engine(self.engine)
+            self.sessionmaker = sessionmaker(bind=self.engine, autoflush=False, expire_on_commit=False)
+
+    def session(self):
+        db = self.sessionmaker()
+        db_session = db if DB_MODE == "async" else SyncSessionAdapter(db)
+        db_session.sync_session.info["replica"] = self.name
+        return db_session
+
+    async def dispose(self) -> None:
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        if self.engine is not None:
+            self.engine.dispose()
+
+
+replicas = [Replica(f"replica{n}", url) for n, url in enumerate(DATABASE_READ_URLS)]
+_next_replica = itertools.count()
+
+
+def is_replica(db) -> bool:
+    """Открыта ли сессия на реплике (данные могут отставать от primary)."""
+    return "replica" in db.sync_session.info
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """Открывает сессию для текущего режима DB_MODE и гарантирует её закрытие."""
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+
+    db = SyncSessionAdapter(_RequestSessionLocal())
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """FastAPI dependency: отдаёт сессию SQLAlchemy и гарантирует её закрытие."""
-    db = SessionLocal()
+    async with session_scope() as db:
+        yield db
+
+
+async def _open_replica_session():
+    """Сессия на первой доступной реплике по кругу или None.
+
+    Соединение берётся сразу (pool_pre_ping проверяет его): если реплика не
+    отвечает, она исключается на DB_REPLICA_RETRY_SECONDS и пробуется следующая.
+    """
+    start = next(_next_replica)
+    now = time.monotonic()
+    for i in range(len(replicas)):
+        replica = replicas[(start + i) % len(replicas)]
+        if replica.down_until > now:
+            continue
+        db = replica.session()
+        try:
+            await db.connection()
+            return db
+        except Exception:
+            await db.close()
+            replica.down_until = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+            logger.warning("Read replica %s is unavailable, excluded for %ss", replica.name, DB_REPLICA_RETRY_SECONDS)
+    return None
+
+
+@asynccontextmanager
+async def read_session_scope() -> AsyncIterator[AsyncSession]:
+    """Сессия только для чтения: реплика, если она есть и доступна, иначе primary.
+
+    Запись, сделанная только что, на реплике может быть ещё не видна — см. is_replica.
+    """
+    db = None
+    if replicas:
+        db = await _open_replica_session()
+        DB_READ_SESSIONS.labels("replica" if db is not None else "primary_failover").inc()
+    if db is None:
+        async with session_scope() as db:
+            yield db
+        return
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+
+async def get_read_db() -> AsyncGenerator[AsyncSession, None]:
+    """FastAPI dependency для обработчиков, которые только читают (см. read_session_scope)."""
+    async with read_session_scope() as db:
+        yield db
+
+
+async def dispose_engines() -> None:
+    """Закрывает пулы соединений, в том числе реплик (вызывается при остановке приложения)."""
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+    for replica in replicas:
+        await replica.dispose()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .security import hash_password, verify_password
+
+# bcrypt выполняется в отдельных процессах: он занимает CPU ~сотни мс и не должен
+# ни держать GIL процесса uvicorn, ни занимать пул потоков Starlette.
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 1)))
+# Сколько операций может одновременно выполняться и ждать в очереди пула.
+# Всё, что сверх, сразу получает 503: ждать дольше нескольких «раундов» бессмысленно.
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", str(BCRYPT_WORKERS * 4)))
+# Значение заголовка Retry-After (секунды) для ответа 503.
+BCRYPT_RETRY_AFTER = int(os.getenv("BCRYPT_RETRY_AFTER", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    """Очередь на хеширование заполнена — запрос нужно повторить позже."""
+
+
+def _timed(fn, *args):
+    """Выполняется в процессе пула: возвращает (результат, время начала, время работы)."""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time() - started
+
+
+class HasherStats:
+    """Счётчики пула: сколько ждали в очереди и сколько считали bcrypt."""
+
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._queue_ms: deque = deque(maxlen=self.SAMPLES)
+        self._hash_ms: deque = deque(maxlen=self.SAMPLES)
+
+    def record(self, queue_seconds: float, hash_seconds: float) -> None:
+        self.completed += 1
+        self._queue_ms.append(max(queue_seconds, 0.0) * 1000)
+        self._hash_ms.append(hash_seconds * 1000)
+
+    @staticmethod
+    def _summary(samples: deque) -> dict:
+        if not samples:
+            return {"avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        ordered = sorted(samples)
+        return {
+            "avg": round(sum(ordered) / len(ordered), 2),
+            "p50": round(ordered[len(ordered) // 2], 2),
+            "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+            "max": round(ordered[-1], 2),
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "queue_ms": self._summary(self._queue_ms),
+            "hash_ms": self._summary(self._hash_ms),
+        }
+
+
+class PasswordHasher:
+    """Ограниченный пул процессов для bcrypt с контролем длины очереди.
+
+    Все методы вызываются из event loop, поэтому счётчики не требуют блокировок.
+    """
+
+    def __init__(self, workers: int = BCRYPT_WORKERS, max_pending: int = BCRYPT_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.stats = HasherStats()
+        self.restarts = 0
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn: дочерние процессы не наследуют потоки и соединения uvicorn/SQLAlchemy.
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _replace_broken(self, executor: ProcessPoolExecutor) -> None:
+        """Пересоздаёт пул, если в нём умер процесс (OOM kill, падение bcrypt).
+
+        Сломанный ProcessPoolExecutor отклоняет все дальнейшие задачи, поэтому
+        без замены логин и регистрация не работали бы до перезапуска сервиса.
+        Несколько запросов могут заметить поломку одновременно — пул меняет первый.
+        """
+        if self._executor is not executor:
+            return
+        logger.warning("bcrypt process pool is broken, restarting it")
+        self.restarts += 1
+        self._executor = self._new_executor()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self) -> None:
+        """Запускает процессы пула заранее, чтобы первый логин не ждал их старта."""
+        for f in [self._executor.submit(time.sleep, 0) for _ in range(self.workers)]:
+            f.result()
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.stats.rejected += 1
+            raise HasherBusy()
+
+        self.pending += 1
+        submitted = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._executor
+            try:
+                result, started, hash_seconds = await loop.run_in_executor(executor, _timed, fn, *args)
+            except BrokenProcessPool:
+                # Один повтор на новом пуле; если упадёт и он — ошибка уходит клиенту.
+                self._replace_broken(executor)
+                result, started, hash_seconds = await loop.run_in_executor(self._executor, _timed, fn, *args)
+        except ValueError:
+            # Слишком длинный пароль — ошибка клиента, а не пула.
+            raise
+        except Exception:
+            self.stats.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        self.stats.record(started - submitted, hash_seconds)
+        return result
+
+    async def hash(self, password: str) -> str:
+        """Хеширует пароль в пуле. Бросает HasherBusy, если очередь заполнена."""
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        """Проверяет пароль в пуле. Бросает HasherBusy, если очередь заполнена."""
+        return await self._run(verify_password, password, password_hash)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats.snapshot(),
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "workers": self.workers,
+            "restarts": self.restarts,
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+_hasher: PasswordHasher | None = None
+
+
+def get_hasher() -> PasswordHasher:
+    """Возвращает общий для процесса пул хеширования (создаётся при первом вызове)."""
+    global _hasher
+    if _hasher is None:
+        _hasher = PasswordHasher()
+    return _hasher
+
+
+def stop_hasher() -> None:
+    global _hasher
+    if _hasher is not None:
+        _hasher.shutdown()
+        _hasher = None
@@ -1,6 +1,71 @@
 import os
+import json
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# text — прежний человекочитаемый формат, json — одна JSON-строка на запись.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Запись в файл/консоль выполняется отдельным потоком QueueListener, а не в event loop.
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") == "1"
+# Доля успешных запросов, попадающих в access-лог (0..1). Ошибки пишутся всегда.
+LOG_ACCESS_SAMPLE_RATE = float(os.getenv("LOG_ACCESS_SAMPLE_RATE", "1.0"))
+
+# Стандартные атрибуты LogRecord; всё остальное пришло через extra= и попадает в JSON.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listeners: list[QueueListener] = []
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну JSON-строку, включая поля из extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """QueueHandler, который сохраняет поля extra= и traceback для форматтеров за очередью.
+
+    Стандартный prepare() форматирует запись своим форматтером и склеивает
+    traceback с сообщением — тогда JSON-форматтер не смог бы выделить его в поле.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def should_log_access(status_code: int) -> bool:
+    """Решает, писать ли строку access-лога: ошибки всегда, успешные — с вероятностью LOG_ACCESS_SAMPLE_RATE."""
+    return status_code >= 400 or LOG_ACCESS_SAMPLE_RATE >= 1.0 or random.random() < LOG_ACCESS_SAMPLE_RATE
+
+
+def stop_logging() -> None:
+    """Дописывает накопленные в очереди записи и останавливает потоки логирования."""
+    while _listeners:
+        _listeners.pop().stop()
+
 
 def setup_logging(service_name: str) -> logging.Logger:
     log_dir = os.getenv("LOG_DIR", "/logs")
@@ -17,7 +82,10 @@ def setup_logging(service_name: str) -> logging.Logger:
     if logger.handlers:
         return logger
 
-    fmt = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if LOG_FORMAT == "json":
+        fmt = JsonFormatter()
+    else:
+        fmt = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
 
     # в файл (ротация)
     file_handler = RotatingFileHandler(log_path, maxBytes=2_000_000, backupCount=3, encoding="utf-8")
@@ -29,7 +97,18 @@ def setup_logging(service_name: str) -> logging.Logger:
     console_handler.setLevel(level)
     console_handler.setFormatter(fmt)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if not LOG_QUEUE:
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
+        return logger
+
+    # В запросе остаётся только put в очередь; ротация и запись — в потоке listener'а.
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    if len(_listeners) == 1:
+        atexit.register(stop_logging)
 
+    logger.addHandler(_QueueHandler(log_queue))
     return logger
@@ -1,14 +1,18 @@
 import os
+import time
 
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from .db import engine
-from .logging_setup import setup_logging
+from .db import dispose_engines, engine
+from .hashing import get_hasher, stop_hasher
+from .logging_setup import setup_logging, should_log_access
+from .metrics import HTTP_REQUESTS_IN_FLIGHT, observe_request, render_metrics
 from .models import User  # noqa: F401  # импорт нужен, чтобы SQLAlchemy создал таблицу users
 from .routes_auth import router as auth_router
+from .tracing import current_trace_id, finish_request_span, request_span, setup_tracing, shutdown_tracing
 
 app = FastAPI(
     title="Auth Service",
@@ -17,15 +21,49 @@ app = FastAPI(
 )
 
 logger = setup_logging(os.getenv("SERVICE_NAME", "auth_service"))
+setup_tracing(os.getenv("SERVICE_NAME", "auth_service"))
 
 
 @app.middleware("http")
 async def access_log(request: Request, call_next):
-    """Логирует входящие и исходящие HTTP-запросы."""
-    logger.info("IN %s %s", request.method, request.url.path)
-    resp = await call_next(request)
-    logger.info("OUT %s %s -> %s", request.method, request.url.path, resp.status_code)
-    return resp
+    """Пишет одну строку access-лога на запрос (статус, длительность, пользователь), метрики и span запроса.
+
+    Успешные запросы сэмплируются (LOG_ACCESS_SAMPLE_RATE), ошибки пишутся всегда.
+    """
+    started = time.perf_counter()
+    status_code = 500
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+    with request_span(request) as span:
+        try:
+            resp = await call_next(request)
+            status_code = resp.status_code
+            return resp
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            # Шаблон маршрута, а не сам путь — иначе число серий метрик не ограничено.
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            observe_request(request.method, route, status_code, elapsed)
+            finish_request_span(span, request.method, route, status_code)
+            if should_log_access(status_code):
+                duration_ms = round(elapsed * 1000, 2)
+                user_id = getattr(request.state, "user_id", None)
+                logger.info(
+                    "%s %s -> %s %.2fms user=%s",
+                    request.method,
+                    request.url.path,
+                    status_code,
+                    duration_ms,
+                    user_id,
+                    extra={
+                        "method": request.method,
+                        "path": request.url.path,
+                        "status": status_code,
+                        "duration_ms": duration_ms,
+                        "user_id": user_id,
+                        "trace_id": current_trace_id(),
+                    },
+                )
 
 
 @app.exception_handler(RequestValidationError)
@@ -50,7 +88,7 @@ async def http_handler(request: Request, exc: StarletteHTTPException):
         request.url.path,
         exc.detail,
     )
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=exc.headers)
 
 
 @app.exception_handler(Exception)
@@ -62,10 +100,36 @@ async def any_handler(request: Request, exc: Exception):
 
 @app.on_event("startup")
 def on_startup():
-    """Создаёт таблицы auth_service в БД (если их ещё нет)."""
+    """Создаёт таблицы auth_service в БД (если их ещё нет) и запускает пул bcrypt."""
     from .db import Base
 
     Base.metadata.create_all(bind=engine)
+    get_hasher().warm_up()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Останавливает пул bcrypt и закрывает пулы соединений с БД."""
+    stop_hasher()
+    await dispose_engines()
+    shutdown_tracing()
+
+
+@app.get(
+    "/internal/hasher",
+    summary="Показатели пула bcrypt",
+    description="Длина очереди, число отказов (503) и распределение времени ожидания в очереди и времени хеширования.",
+)
+async def hasher_metrics():
+    """Возвращает счётчики пула процессов bcrypt."""
+    return get_hasher().snapshot()
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Метрики процесса (или всех worker'ов при PROMETHEUS_MULTIPROC_DIR) в формате Prometheus."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 app.include_router(auth_router)
@@ -1,14 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, Header, status
+import logging
+
+from fastapi import APIRouter, Depends, HTTPException, Header, Request, status
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .db import get_db
+from .db import get_db, get_read_db, is_replica, session_scope
+from .hashing import BCRYPT_RETRY_AFTER, HasherBusy, get_hasher
 from .models import User
 from .schemas import LoginRequest, MeResponse, RegisterRequest, TokenResponse
-from .security import JWT_ALG, JWT_SECRET, create_access_token, hash_password, verify_password
+from .security import JWT_ALG, JWT_SECRET, create_access_token, needs_rehash
 
 router = APIRouter(prefix="/api/v1/auth", tags=["auth"])
 
+logger = logging.getLogger(__name__)
+
+
+def _busy() -> HTTPException:
+    """Ответ 503, когда очередь на bcrypt заполнена."""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many authentication requests, retry later",
+        headers={"Retry-After": str(BCRYPT_RETRY_AFTER)},
+    )
+
 
 def decode_token(token: str) -> str:
     """Декодирует JWT и возвращает email пользователя из claim `sub`."""
@@ -28,22 +43,26 @@ def decode_token(token: str) -> str:
     summary="Регистрация",
     description="Создаёт пользователя, сохраняет пароль в виде bcrypt-хеша и возвращает JWT для последующей авторизации.",
 )
-def register(data: RegisterRequest, db: Session = Depends(get_db)):
+async def register(data: RegisterRequest, request: Request, db: AsyncSession = Depends(get_db)):
     """Регистрирует нового пользователя и возвращает access token."""
-    existing = db.query(User).filter(User.email == str(data.email)).first()
+    existing = await db.scalar(select(User.id).where(User.email == str(data.email)))
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
 
     try:
-        pw_hash = hash_password(data.password)
+        # bcrypt — тяжёлая CPU-операция, он считается в отдельном пуле процессов.
+        pw_hash = await get_hasher().hash(data.password)
+    except HasherBusy:
+        raise _busy()
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     user = User(email=str(data.email), password_hash=pw_hash)
 
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    request.state.user_id = user.id
 
     token = create_access_token(subject=str(data.email), user_id=int(user.id))
     return TokenResponse(access_token=token)
@@ -55,11 +74,41 @@ def register(data: RegisterRequest, db: Session = Depends(get_db)):
     summary="Вход",
     description="Проверяет email/пароль и возвращает JWT (access token) при успешной аутентификации.",
 )
-def login(data: LoginRequest, db: Session = Depends(get_db)):
-    """Проверяет учётные данные и возвращает access token."""
-    user = db.query(User).filter(User.email == str(data.email)).first()
-    if not user or not verify_password(data.password, user.password_hash):
+async def login(data: LoginRequest, request: Request, db: AsyncSession = Depends(get_read_db)):
+    """Проверяет учётные данные и возвращает access token.
+
+    Пользователь читается с реплики (если она настроена); не найденного там —
+    например, только что зарегистрированного — ищем ещё и в primary.
+    Если хеш посчитан с другой стоимостью bcrypt, он прозрачно пересчитывается (в primary).
+    """
+    stmt = select(User).where(User.email == str(data.email))
+    user = await db.scalar(stmt)
+    if not user and is_replica(db):
+        async with session_scope() as primary:
+            user = await primary.scalar(stmt)
+    if not user:
+        raise HTTPException(status_code=401, detail="Wrong email or password")
+    hasher = get_hasher()
+    try:
+        ok = await hasher.verify(data.password, user.password_hash)
+    except HasherBusy:
+        raise _busy()
+    if not ok:
         raise HTTPException(status_code=401, detail="Wrong email or password")
+    request.state.user_id = user.id
+
+    if needs_rehash(user.password_hash):
+        try:
+            new_hash = await hasher.hash(data.password)
+            async with session_scope() as primary:
+                await primary.execute(update(User).where(User.id == user.id).values(password_hash=new_hash))
+                await primary.commit()
+        except HasherBusy:
+            # Пересчёт не обязателен: сделаем при следующем входе.
+            pass
+        except Exception:
+            # Пароль уже проверен: сбой пула bcrypt или записи в primary не должен ломать вход.
+            logger.warning("Password rehash failed for user %s, will retry on next login", user.id, exc_info=True)
 
     token = create_access_token(subject=str(user.email), user_id=int(user.id))
     return TokenResponse(access_token=token)
@@ -71,7 +120,7 @@ def login(data: LoginRequest, db: Session = Depends(get_db)):
     summary="Текущий пользователь",
     description="Возвращает email текущего пользователя по переданному JWT в заголовке Authorization: Bearer <token>.",
 )
-def me(authorization: str | None = Header(default=None)):
+async def me(authorization: str | None = Header(default=None)):
     """Возвращает информацию о текущем пользователе на основе Bearer-токена."""
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing Bearer token")
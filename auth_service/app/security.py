@@ -7,6 +7,8 @@ from jose import jwt
 JWT_SECRET = os.getenv("JWT_SECRET", "DUhBi61fh85J8fA47npzwo1PYXjXlsfjVXcoFRgKWcy")
 JWT_ALG = os.getenv("JWT_ALG", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# Стоимость bcrypt (log2 числа раундов). Хеши с другой стоимостью пересчитываются при входе.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
 
 def hash_password(password: str) -> str:
@@ -16,7 +18,7 @@ def hash_password(password: str) -> str:
     """
     if len(password.encode("utf-8")) > 72:
         raise ValueError("Password too long (max 72 bytes for bcrypt)")
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed.decode("utf-8")
 
@@ -26,6 +28,14 @@ def verify_password(password: str, password_hash: str) -> bool:
     return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
 
 
+def needs_rehash(password_hash: str) -> bool:
+    """Проверяет, посчитан ли хеш с текущей стоимостью BCRYPT_ROUNDS (формат $2b$<cost>$...)."""
+    try:
+        return int(password_hash.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
 def create_access_token(subject: str, user_id: int) -> str:
     """Создаёт JWT access token.
 
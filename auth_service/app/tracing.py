@@ -0,0 +1,143 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.propagate import extract, inject
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.trace import Span, SpanKind, Status, StatusCode
+from sqlalchemy import event
+
+# none — трассировка выключена (вызовы API OpenTelemetry ничего не делают);
+# file — спаны пишутся JSON-строками в TRACE_FILE (по умолчанию LOG_DIR/<сервис>.traces.jsonl);
+# otlp — отправка в коллектор по OTLP/HTTP (адрес из OTEL_EXPORTER_OTLP_ENDPOINT).
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACING_ENABLED = TRACE_EXPORTER in ("file", "otlp")
+
+tracer = trace.get_tracer("app")
+
+
+class JsonFileSpanExporter(SpanExporter):
+    """Пишет завершённые спаны в файл, по одному JSON-объекту на строку."""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def export(self, spans: list[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(span.to_json(indent=None) + "\n" for span in spans)
+        with self._lock, open(self._path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        pass
+
+
+def setup_tracing(service_name: str) -> None:
+    """Настраивает TracerProvider процесса. Спаны отправляются фоновым потоком пачками."""
+    if not TRACING_ENABLED:
+        return
+    if TRACE_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter: SpanExporter = OTLPSpanExporter()
+    else:
+        log_dir = os.getenv("LOG_DIR", "/logs")
+        exporter = JsonFileSpanExporter(os.getenv("TRACE_FILE", os.path.join(log_dir, f"{service_name}.traces.jsonl")))
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def shutdown_tracing() -> None:
+    """Дописывает накопленные спаны (вызывается при остановке процесса)."""
+    provider = trace.get_tracer_provider()
+    if isinstance(provider, TracerProvider):
+        provider.shutdown()
+
+
+def current_trace_id() -> str | None:
+    ctx = trace.get_current_span().get_span_context()
+    return format(ctx.trace_id, "032x") if ctx.is_valid else None
+
+
+def current_traceparent() -> str | None:
+    """traceparent текущего спана (W3C Trace Context) для сохранения вместе с данными."""
+    carrier: dict[str, str] = {}
+    inject(carrier)
+    return carrier.get("traceparent")
+
+
+def context_from_traceparent(traceparent: str | None) -> otel_context.Context:
+    """Контекст родителя по сохранённому traceparent (пустой, если его нет)."""
+    return extract({"traceparent": traceparent} if traceparent else {})
+
+
+def headers_for(span: Span) -> dict[str, str]:
+    """Заголовки для передачи контекста span'а дальше (в AMQP-сообщение)."""
+    carrier: dict[str, str] = {}
+    inject(carrier, context=trace.set_span_in_context(span))
+    return carrier
+
+
+@contextmanager
+def request_span(request) -> Iterator[Span]:
+    """Серверный span HTTP-запроса; родитель берётся из заголовка traceparent, если он есть."""
+    with tracer.start_as_current_span(
+        f"{request.method} {request.url.path}",
+        context=extract(request.headers),
+        kind=SpanKind.SERVER,
+        attributes={"http.request.method": request.method, "url.path": request.url.path},
+    ) as span:
+        yield span
+
+
+def finish_request_span(span: Span, method: str, route: str, status_code: int) -> None:
+    """Дописывает в span шаблон маршрута и статус ответа."""
+    span.update_name(f"{method} {route}")
+    span.set_attribute("http.route", route)
+    span.set_attribute("http.response.status_code", status_code)
+    if status_code >= 500:
+        span.set_status(Status(StatusCode.ERROR))
+
+
+def instrument_engine(engine) -> None:
+    """Оборачивает SQL-запросы engine в дочерние span'ы текущего контекста.
+
+    Запросы вне какого-либо span'а (DDL при старте, опрос outbox) не трассируются,
+    чтобы не плодить trace'ы из одного запроса.
+    """
+    if not TRACING_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if not trace.get_current_span().get_span_context().is_valid:
+            return
+        span = tracer.start_span(
+            statement.split(None, 1)[0].upper() if statement else "SQL",
+            kind=SpanKind.CLIENT,
+            attributes={"db.system": "postgresql", "db.statement": statement[:1000]},
+        )
+        context._otel_span = span
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_otel_span", None)
+        if span is not None:
+            span.end()
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        span = getattr(exception_context.execution_context, "_otel_span", None)
+        if span is not None:
+            span.record_exception(exception_context.original_exception)
+            span.set_status(Status(StatusCode.ERROR))
+            span.end()
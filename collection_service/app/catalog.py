@@ -0,0 +1,298 @@
+import bisect
+import logging
+import os
+import re
+import threading
+import unicodedata
+from array import array
+
+from sqlalchemy import event, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal
+from .models import Game
+
+# Держать ли префиксный индекс каталога в памяти процесса (иначе подсказки идут в БД).
+CATALOG_INDEX_ENABLED = os.getenv("CATALOG_INDEX_ENABLED", "1").lower() in ("1", "true", "yes")
+# Как часто перечитывать каталог из БД (игры, добавленные другими процессами).
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", "60"))
+# По скольким словам названия можно найти игру («mario» находит «super mario bros»).
+CATALOG_INDEX_MAX_WORDS = int(os.getenv("CATALOG_INDEX_MAX_WORDS", "8"))
+# Сколько новых игр держать вне отсортированного индекса; больше — индекс перестраивается досрочно.
+CATALOG_PENDING_MAX = int(os.getenv("CATALOG_PENDING_MAX", "1000"))
+
+logger = logging.getLogger(__name__)
+
+# Установлено ли расширение pg_trgm (нечёткие подсказки и поиск); выставляет setup_trigram().
+trigram_enabled = False
+
+_stop = threading.Event()
+_wake = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def normalize(text: str) -> str:
+    """Ключ дедупликации: NFKC, без различия регистра, пробелы схлопнуты."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def _key(title: str, platform: str) -> tuple[str, str]:
+    return normalize(title)[:255], normalize(platform)[:64]
+
+
+_GAME_COLUMNS = (Game.id, Game.title, Game.platform, Game.title_norm, Game.platform_norm)
+
+
+def _lookup(db: Session, keys) -> dict[tuple[str, str], object]:
+    rows = db.execute(select(*_GAME_COLUMNS).where(tuple_(Game.title_norm, Game.platform_norm).in_(list(keys))))
+    return {(r.title_norm, r.platform_norm): r for r in rows}
+
+
+def resolve_games(db: Session, items: list[tuple[str, str]]) -> list:
+    """Игры каталога (строки с id, title, platform) для пар (название, платформа); недостающие создаются.
+
+    Обычно один SELECT; для новых игр — INSERT ... ON CONFLICT DO NOTHING (в порядке
+    ключей, чтобы параллельные транзакции не ждали друг друга по кругу). Игру,
+    которую одновременно вставила другая транзакция, ON CONFLICT дожидается — после
+    этого она видна повторному SELECT'у. Вызывается в транзакции записи элементов
+    (из async-кода — через db.run_sync). Созданные игры попадают в индекс подсказок
+    только после commit этой транзакции (см. _register_new_games).
+    """
+    keys = [_key(title, platform) for title, platform in items]
+    spelling: dict[tuple[str, str], tuple[str, str]] = {}
+    for (title, platform), key in zip(items, keys):
+        spelling.setdefault(key, (" ".join(title.split())[:255], platform.strip()[:64]))
+
+    games = _lookup(db, spelling)
+    missing = sorted(key for key in spelling if key not in games)
+    if missing:
+        stmt = (
+            pg_insert(Game)
+            .values(
+                [
+                    {"title": spelling[k][0], "platform": spelling[k][1], "title_norm": k[0], "platform_norm": k[1]}
+                    for k in missing
+                ]
+            )
+            .on_conflict_do_nothing(constraint="ux_games_title_platform")
+            .returning(*_GAME_COLUMNS)
+        )
+        created = db.execute(stmt).all()
+        for row in created:
+            games[(row.title_norm, row.platform_norm)] = row
+        db.info.setdefault("new_games", []).extend((r.id, r.title, r.platform, r.title_norm) for r in created)
+        missing = [key for key in missing if key not in games]
+        if missing:
+            games.update(_lookup(db, missing))
+    return [games[key] for key in keys]
+
+
+@event.listens_for(Session, "after_commit")
+def _register_new_games(session: Session) -> None:
+    # Срабатывает и для AsyncSession (её sync_session): игры, созданные resolve_games, уже видны другим.
+    games = session.info.pop("new_games", None)
+    if games:
+        catalog_index.add_many(games)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_new_games(session: Session) -> None:
+    session.info.pop("new_games", None)
+
+
+def _word_starts(title_norm: str) -> list[int]:
+    starts = [0] + [i + 1 for i, ch in enumerate(title_norm) if ch == " "]
+    return starts[:CATALOG_INDEX_MAX_WORDS]
+
+
+class CatalogIndex:
+    """Префиксный индекс каталога в памяти процесса (подсказки без запроса в БД).
+
+    Ключи — хвосты title_norm, начинающиеся с каждого слова («super mario bros»,
+    «mario bros», «bros»), в отсортированном списке; рядом — array с номерами игр.
+    Подсказка — bisect к префиксу запроса и проход по соседним ключам, то есть
+    O(log n + limit) без выделения памяти под промежуточные структуры.
+    replace() строит индекс заново и подменяет целиком (фоновый поток, см.
+    run_catalog_refresh_forever). Игры, созданные этим процессом после сборки,
+    add_many() кладёт в короткий несортированный список за O(1): подсказки
+    просматривают его целиком, а в отсортированные ключи он попадает при следующей
+    перестройке (досрочной, если в нём набралось CATALOG_PENDING_MAX игр). Потокобезопасен.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._keys: list[str] = []
+        self._refs = array("I")
+        self._games: list[tuple[int, str, str]] = []
+        self._ids: set[int] = set()
+        # (title_norm, (id, title, platform)) — игры, ещё не вошедшие в _keys.
+        self._pending: list[tuple[str, tuple[int, str, str]]] = []
+
+    def replace(self, games: list[tuple[int, str, str, str]]) -> None:
+        """games — (id, title, platform, title_norm)."""
+        pairs = sorted(
+            (title_norm[start:], n)
+            for n, (_, _, _, title_norm) in enumerate(games)
+            for start in _word_starts(title_norm)
+        )
+        keys = [key for key, _ in pairs]
+        refs = array("I", (n for _, n in pairs))
+        entries = [(game_id, title, platform) for game_id, title, platform, _ in games]
+        ids = {entry[0] for entry in entries}
+        with self._lock:
+            self._keys, self._refs, self._games = keys, refs, entries
+            # Игры, созданные, пока каталог перечитывался, в снимок могли не попасть.
+            self._pending = [item for item in self._pending if item[1][0] not in ids]
+            self._ids = ids | {item[1][0] for item in self._pending}
+            self.loaded = True
+
+    def add_many(self, games: list[tuple[int, str, str, str]]) -> None:
+        """games — (id, title, platform, title_norm) игр из закоммиченной транзакции."""
+        with self._lock:
+            if not self.loaded:
+                return
+            for game_id, title, platform, title_norm in games:
+                if game_id not in self._ids:
+                    self._ids.add(game_id)
+                    self._pending.append((title_norm, (game_id, title, platform)))
+            overflow = len(self._pending) >= CATALOG_PENDING_MAX
+        if overflow:
+            _wake.set()
+
+    def suggest(self, prefix: str, limit: int) -> list[tuple[int, str, str]]:
+        """До limit игр, у которых одно из слов названия начинается с prefix (уже нормализованного).
+
+        Порядок — по совпавшей части названия (от начала совпавшего слова до конца).
+        """
+        found: list[tuple[str, tuple[int, str, str]]] = []
+        seen: set[int] = set()
+        with self._lock:
+            keys = self._keys
+            i = bisect.bisect_left(keys, prefix)
+            while i < len(keys) and len(found) < limit and keys[i].startswith(prefix):
+                n = self._refs[i]
+                if n not in seen:
+                    seen.add(n)
+                    found.append((keys[i], self._games[n]))
+                i += 1
+            extra = []
+            for title_norm, entry in self._pending:
+                matched = [title_norm[start:] for start in _word_starts(title_norm) if title_norm.startswith(prefix, start)]
+                if matched:
+                    extra.append((min(matched), entry))
+        if extra:
+            found = sorted(found + extra, key=lambda item: item[0])[:limit]
+        return [entry for _, entry in found]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "games": len(self._games) + len(self._pending),
+                "keys": len(self._keys),
+                "pending": len(self._pending),
+            }
+
+
+catalog_index = CatalogIndex()
+
+
+def _word_start_regex(prefix: str) -> str:
+    # Одно из первых CATALOG_INDEX_MAX_WORDS слов начинается с prefix — то же правило, что у
+    # CatalogIndex. В ARE «\» перед не буквой/цифрой — сам символ, поэтому ввод экранируется так.
+    escaped = re.sub(r"(\W)", r"\\\1", prefix)
+    return f"^(?:[^ ]+ ){{0,{CATALOG_INDEX_MAX_WORDS - 1}}}?({escaped}.*)$"
+
+
+def suggest_prefix(db: Session, prefix: str, limit: int) -> list:
+    """Подсказки из БД: игры, в названии которых есть слово, начинающееся с prefix (как catalog_index.suggest).
+
+    Регулярное выражение ускоряет триграммный индекс ix_games_title_trgm, если есть pg_trgm;
+    без него — последовательное чтение games (запасной путь, пока индекс в памяти не загружен).
+    """
+    pattern = _word_start_regex(prefix)
+    stmt = (
+        select(Game.id, Game.title, Game.platform)
+        .where(Game.title_norm.regexp_match(pattern))
+        .order_by(func.substring(Game.title_norm, pattern), Game.id)
+        .limit(limit)
+    )
+    return list(db.execute(stmt).all())
+
+
+def suggest_similar(db: Session, query: str, limit: int) -> list:
+    """Нечёткие подсказки (опечатки, слова в середине названия) по триграммному индексу pg_trgm."""
+    stmt = (
+        select(Game.id, Game.title, Game.platform)
+        .where(Game.title_norm.op("%")(query))
+        .order_by(func.similarity(Game.title_norm, query).desc(), Game.id)
+        .limit(limit)
+    )
+    return list(db.execute(stmt).all())
+
+
+# Триграммный индекс: подсказки каталога (suggest_prefix, suggest_similar).
+_TRIGRAM_INDEXES = ("CREATE INDEX IF NOT EXISTS ix_games_title_trgm ON games USING gin (title_norm gin_trgm_ops)",)
+
+
+def setup_trigram(engine: Engine) -> bool:
+    """Включает pg_trgm и триграммные индексы, если расширение доступно.
+
+    Без него подсказки и поиск работают, но без поправки на опечатки.
+    """
+    global trigram_enabled
+    try:
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for ddl in _TRIGRAM_INDEXES:
+                conn.exec_driver_sql(ddl)
+        trigram_enabled = True
+    except Exception as exc:
+        logger.warning("pg_trgm is not available, fuzzy search is disabled: %s", getattr(exc, "orig", exc))
+        trigram_enabled = False
+    return trigram_enabled
+
+
+def load_catalog_index() -> None:
+    """Перечитывает каталог из БД и подменяет индекс в памяти."""
+    with SessionLocal() as db:
+        games = db.execute(select(Game.id, Game.title, Game.platform, Game.title_norm)).all()
+    catalog_index.replace([tuple(g) for g in games])
+
+
+def run_catalog_refresh_forever() -> None:
+    """Перечитывает каталог раз в CATALOG_REFRESH_INTERVAL (или досрочно, см. add_many) до stop_catalog_refresh()."""
+    while True:
+        _wake.wait(CATALOG_REFRESH_INTERVAL)
+        _wake.clear()
+        if _stop.is_set():
+            return
+        try:
+            load_catalog_index()
+        except Exception:
+            logger.exception("Catalog index refresh failed")
+
+
+def start_catalog_refresh() -> None:
+    """Загружает индекс каталога и запускает его периодическое обновление в фоновом потоке."""
+    global _thread
+    if not CATALOG_INDEX_ENABLED or _thread is not None:
+        return
+    load_catalog_index()
+    _stop.clear()
+    _wake.clear()
+    _thread = threading.Thread(target=run_catalog_refresh_forever, name="catalog-refresh", daemon=True)
+    _thread.start()
+
+
+def stop_catalog_refresh(timeout: float = 5.0) -> None:
+    """Останавливает фоновое обновление индекса каталога."""
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+    _thread = None
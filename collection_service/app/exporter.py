@@ -0,0 +1,55 @@
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator
+
+from sqlalchemy import select
+
+from .db import stream_partitions
+from .models import CollectionItem, Game
+
+# Сколько строк за раз читается из серверного курсора и отдаётся одним куском ответа.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+EXPORT_COLUMNS = ["id", "title", "platform", "status", "rating", "note", "created_at"]
+
+
+def _rows(user_id: int) -> AsyncIterator[list]:
+    """Читает коллекцию пользователя серверным курсором, пачками по EXPORT_BATCH_SIZE."""
+    # Название и платформа — из каталога: один JOIN вместо подзапросов на каждую строку.
+    columns = {c: getattr(CollectionItem, c) for c in EXPORT_COLUMNS} | {"title": Game.title, "platform": Game.platform}
+    stmt = (
+        select(*(columns[c] for c in EXPORT_COLUMNS))
+        .join(Game, Game.id == CollectionItem.game_id)
+        .where(CollectionItem.user_id == user_id)
+        .order_by(CollectionItem.id)
+    )
+    return stream_partitions(stmt, EXPORT_BATCH_SIZE)
+
+
+async def export_ndjson(user_id: int) -> AsyncIterator[str]:
+    """Отдаёт коллекцию как NDJSON: один JSON-объект на строку."""
+    async for partition in _rows(user_id):
+        yield "".join(
+            json.dumps(
+                {**row._asdict(), "created_at": row.created_at.isoformat() if row.created_at else None},
+                ensure_ascii=False,
+            )
+            + "\n"
+            for row in partition
+        )
+
+
+async def export_csv(user_id: int) -> AsyncIterator[str]:
+    """Отдаёт коллекцию как CSV с заголовком."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buf.getvalue()
+
+    async for partition in _rows(user_id):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(partition)
+        yield buf.getvalue()
@@ -0,0 +1,138 @@
+import codecs
+import csv
+import json
+import os
+from collections import Counter
+from typing import AsyncIterator
+
+from pydantic import ValidationError
+from sqlalchemy import insert
+
+from .catalog import resolve_games
+from .db import session_scope
+from .listing import bump_version, listing_cache
+from .models import CollectionItem
+from .outbox import add_outbox_event
+from .schemas import ItemCreate
+
+# Сколько строк вставляется одним multi-row INSERT (и попадает в одно событие).
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+# Ограничение на размер одного импорта (в строках данных).
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "100000"))
+# Сколько ошибок возвращать клиенту; остальные только считаются.
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Режет поток байт на строки по мере поступления (UTF-8, в т.ч. на стыках чанков)."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    tail = ""
+    async for chunk in chunks:
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def iter_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | None, str | None]]:
+    """Разбирает NDJSON: по одному JSON-объекту на строку. Отдаёт (номер строки, запись, ошибка)."""
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "Expected a JSON object"
+            continue
+        yield line_no, record, None
+
+
+async def iter_csv(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, dict | None, str | None]]:
+    """Разбирает CSV с заголовком. Запись в кавычках может занимать несколько строк."""
+    header: list[str] | None = None
+    line_no = 0
+    start_no = 0
+    buf: list[str] = []
+    async for line in lines:
+        line_no += 1
+        if not buf:
+            start_no = line_no
+        buf.append(line)
+        text = "\n".join(buf)
+        # Нечётное число кавычек — поле в кавычках ещё не закрыто, ждём следующую строку.
+        if text.count('"') % 2:
+            continue
+        buf = []
+
+        if not text.strip():
+            continue
+        try:
+            values = next(csv.reader([text.rstrip("\r")]))
+        except csv.Error as e:
+            yield start_no, None, f"Invalid CSV: {e}"
+            continue
+
+        if header is None:
+            header = [h.strip().lower() for h in values]
+            continue
+        if len(values) > len(header):
+            yield start_no, None, "Too many columns"
+            continue
+        # Пустые ячейки не передаём, чтобы сработали значения по умолчанию из ItemCreate.
+        yield start_no, {k: v for k, v in zip(header, values) if v != ""}, None
+
+    if buf:
+        yield start_no, None, "Unterminated quoted field"
+
+
+def _validation_message(e: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(p) for p in err['loc']) or 'row'}: {err['msg']}" for err in e.errors()
+    )
+
+
+def validate_item(record: dict) -> tuple[ItemCreate | None, str | None]:
+    """Проверяет запись схемой ItemCreate. Отдаёт (элемент, None) или (None, текст ошибки)."""
+    try:
+        return ItemCreate.model_validate(record), None
+    except ValidationError as e:
+        return None, _validation_message(e)
+
+
+async def insert_chunk(user_id: int, items: list[ItemCreate]) -> list[int]:
+    """Вставляет пачку игр одним INSERT ... RETURNING и пишет одно событие в outbox.
+
+    Каждая пачка — отдельная транзакция: уже импортированные пачки остаются,
+    даже если следующая не вставилась.
+    """
+    table = CollectionItem.__table__
+    async with session_scope() as db:
+        games = await db.run_sync(resolve_games, [(item.title, item.platform) for item in items])
+        rows = [{"user_id": user_id, "status": "planned", "game_id": game.id} for game in games]
+        result = await db.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+        ids = list(result.scalars())
+        add_outbox_event(
+            db,
+            "collection.items_imported",
+            {
+                "user_id": user_id,
+                "count": len(ids),
+                "item_ids": ids,
+                "status": "planned",
+                # Платформа в написании каталога — как в событиях изменения и удаления этих игр.
+                "platforms": dict(Counter(game.platform for game in games)),
+            },
+        )
+        await bump_version(db, user_id)
+        await db.commit()
+    listing_cache.invalidate(user_id)
+    return ids
@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Request
+from fastapi.responses import Response
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import CollectionVersion
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него ответы сжимаются только gzip
+    brotli = None
+
+# Сколько сериализованных страниц списка держать в памяти процесса (0 — кэш выключен).
+COLLECTION_CACHE_SIZE = int(os.getenv("COLLECTION_CACHE_SIZE", "2000"))
+# Сколько секунд хранить страницу в кэше. Актуальность обеспечивает версия
+# коллекции в ключе, TTL лишь освобождает память от страниц, которые больше не спрашивают.
+COLLECTION_CACHE_TTL = float(os.getenv("COLLECTION_CACHE_TTL", "60"))
+# С какого размера ответа (байты) включать сжатие.
+COLLECTION_COMPRESS_MIN_SIZE = int(os.getenv("COLLECTION_COMPRESS_MIN_SIZE", "1024"))
+
+# Список зависит от пользователя (JWT) и поддерживаемых клиентом кодировок.
+_HEADERS = {"Cache-Control": "private, no-cache", "Vary": "Authorization, Accept-Encoding"}
+
+
+async def bump_version(db: AsyncSession, user_id: int) -> None:
+    """Увеличивает версию коллекции пользователя в текущей транзакции.
+
+    Вызывается при каждом изменении collection_items; строка версии блокируется
+    до commit, поэтому версии растут в порядке commit'ов.
+    """
+    stmt = pg_insert(CollectionVersion).values(user_id=user_id, version=1)
+    await db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[CollectionVersion.user_id], set_={"version": CollectionVersion.version + 1}
+        )
+    )
+
+
+async def current_version(db: AsyncSession, user_id: int) -> int:
+    """Версия коллекции пользователя; 0 — коллекцию ещё не меняли."""
+    return (await db.scalar(select(CollectionVersion.version).where(CollectionVersion.user_id == user_id))) or 0
+
+
+def make_etag(user_id: int, version: int, params: tuple) -> str:
+    """Сильный ETag страницы списка: версия коллекции + хэш параметров запроса."""
+    digest = hashlib.sha256(repr((user_id, params)).encode("utf-8")).hexdigest()[:16]
+    return f'"{version}-{digest}"'
+
+
+def _variant_etag(etag: str, encoding: str | None) -> str:
+    # Сжатый ответ — другое представление, поэтому у него свой сильный ETag.
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def matching_etag(if_none_match: str | None, etag: str) -> str | None:
+    """Тег из If-None-Match, совпавший с ETag в любом из вариантов сжатия (слабое сравнение), или None."""
+    if not if_none_match:
+        return None
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return etag
+        if tag.removeprefix("W/") in (etag, _variant_etag(etag, "gzip"), _variant_etag(etag, "br")):
+            return tag
+    return None
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    """Кодировка ответа по Accept-Encoding: br (если установлен brotli), затем gzip."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get("*", 0.0)) > 0:
+            return coding
+    return None
+
+
+class ListingCache:
+    """LRU с TTL сериализованных страниц списка: (user_id, версия, параметры) -> тела ответа.
+
+    Для каждой страницы хранится JSON и сжатые варианты (сжимаются при первом
+    запросе). Версия в ключе делает кэш корректным и между процессами: после
+    изменения коллекции в другом worker'е запрос придёт с новой версией.
+    invalidate() после записи лишь сразу освобождает память этого процесса. Потокобезопасен.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items: OrderedDict[tuple, tuple[dict[str | None, bytes], float]] = OrderedDict()
+        self._by_user: dict[int, set[tuple]] = {}
+
+    def get(self, key: tuple) -> dict[str | None, bytes] | None:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, body: bytes) -> dict[str | None, bytes]:
+        variants = {None: body}
+        if self.size <= 0:
+            return variants
+        with self._lock:
+            self._items[key] = (variants, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            self._by_user.setdefault(key[0], set()).add(key)
+            while len(self._items) > self.size:
+                self._remove(next(iter(self._items)))
+        return variants
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+
+    def _remove(self, key: tuple) -> None:
+        self._items.pop(key, None)
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+listing_cache = ListingCache(COLLECTION_CACHE_SIZE, COLLECTION_CACHE_TTL)
+
+
+def _encoded(variants: dict[str | None, bytes], encoding: str | None) -> bytes:
+    body = variants.get(encoding)
+    if body is None:
+        raw = variants[None]
+        body = brotli.compress(raw, quality=5) if encoding == "br" else gzip.compress(raw, compresslevel=6)
+        variants[encoding] = body
+    return body
+
+
+def not_modified(etag: str) -> Response:
+    """Ответ 304; etag — совпавший тег из If-None-Match (вариант, который уже есть у клиента)."""
+    return Response(status_code=304, headers={**_HEADERS, "ETag": etag})
+
+
+def listing_response(variants: dict[str | None, bytes], etag: str, request: Request) -> Response:
+    """JSON-ответ со сжатием (если клиент его принимает и тело достаточно большое) и ETag."""
+    encoding = None
+    if len(variants[None]) >= COLLECTION_COMPRESS_MIN_SIZE:
+        encoding = choose_encoding(request.headers.get("accept-encoding"))
+    headers = {**_HEADERS, "ETag": _variant_etag(etag, encoding)}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=_encoded(variants, encoding), media_type="application/json", headers=headers)
+
+
+def listing_cache_stats() -> dict:
+    """Снимок счётчиков кэша списков (для /internal/list-cache)."""
+    return listing_cache.snapshot()
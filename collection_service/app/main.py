@@ -3,13 +3,30 @@ import time
 
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from .db import engine
-from .logging_setup import setup_logging
-from .models import CollectionItem  # noqa: F401  # импорт нужен, чтобы SQLAlchemy создал таблицу collection_items
+from .catalog import setup_trigram, start_catalog_refresh, stop_catalog_refresh
+from .db import (
+    DB_POSITION_COOKIE,
+    DB_POSITION_HEADER,
+    bind_consistency,
+    dispose_engines,
+    engine,
+    issue_consistency_token,
+)
+from .listing import listing_cache_stats
+from .logging_setup import setup_logging, should_log_access
+from .metrics import HTTP_REQUESTS_IN_FLIGHT, observe_request, render_metrics
+from .migrate_catalog import count_unlinked, install_legacy_sync
+from .models import NOTE_TSV_SQL, TITLE_TSV_SQL, CollectionItem, CollectionVersion, Game, OutboxEvent  # noqa: F401  # импорт нужен, чтобы SQLAlchemy создал таблицы
+from .mq import get_publisher, stop_publisher
+from .outbox import OUTBOX_RELAY_ENABLED, start_outbox_relay, stop_outbox_relay
+from .routes_catalog import router as catalog_router
 from .routes_collection import router as collection_router
+from .security import jwt_cache_stats
+from .tracing import current_trace_id, finish_request_span, request_span, setup_tracing, shutdown_tracing
 
 app = FastAPI(
     title="Collection Service",
@@ -18,15 +35,52 @@ app = FastAPI(
 )
 
 logger = setup_logging(os.getenv("SERVICE_NAME", "collection_service"))
+setup_tracing(os.getenv("SERVICE_NAME", "collection_service"))
 
 
 @app.middleware("http")
 async def access_log(request: Request, call_next):
-    """Логирует входящие и исходящие HTTP-запросы."""
-    logger.info("IN %s %s", request.method, request.url.path)
-    resp = await call_next(request)
-    logger.info("OUT %s %s -> %s", request.method, request.url.path, resp.status_code)
-    return resp
+    """Пишет одну строку access-лога на запрос (статус, длительность, пользователь), метрики и span запроса.
+
+    Успешные запросы сэмплируются (LOG_ACCESS_SAMPLE_RATE), ошибки пишутся всегда.
+    """
+    # Read-your-writes: позиция WAL последней записи клиента (см. db.ReadConsistency).
+    consistency = bind_consistency(request.headers.get(DB_POSITION_HEADER) or request.cookies.get(DB_POSITION_COOKIE))
+    started = time.perf_counter()
+    status_code = 500
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+    with request_span(request) as span:
+        try:
+            resp = await call_next(request)
+            status_code = resp.status_code
+            await issue_consistency_token(consistency, resp)
+            return resp
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            # Шаблон маршрута, а не сам путь — иначе число серий метрик не ограничено.
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            observe_request(request.method, route, status_code, elapsed)
+            finish_request_span(span, request.method, route, status_code)
+            if should_log_access(status_code):
+                duration_ms = round(elapsed * 1000, 2)
+                user_id = getattr(request.state, "user_id", None)
+                logger.info(
+                    "%s %s -> %s %.2fms user=%s",
+                    request.method,
+                    request.url.path,
+                    status_code,
+                    duration_ms,
+                    user_id,
+                    extra={
+                        "method": request.method,
+                        "path": request.url.path,
+                        "status": status_code,
+                        "duration_ms": duration_ms,
+                        "user_id": user_id,
+                        "trace_id": current_trace_id(),
+                    },
+                )
 
 
 @app.exception_handler(RequestValidationError)
@@ -52,7 +106,7 @@ async def any_handler(request: Request, exc: Exception):
 
 @app.on_event("startup")
 def on_startup():
-    """Создаёт таблицу collection_items.
+    """Создаёт таблицы games, collection_items, collection_versions и outbox, запускает outbox-relay и индекс каталога.
 
     Важно: в модели есть FK на users.id, поэтому таблица users должна уже существовать.
     Если auth_service ещё не успел создать users, делаем несколько попыток.
@@ -63,7 +117,35 @@ def on_startup():
         try:
             # Создаём ТОЛЬКО таблицу этого сервиса.
             # Таблица users управляется auth_service, чтобы не создать её случайно «неполной».
-            Base.metadata.create_all(bind=engine, tables=[CollectionItem.__table__])
+            Base.metadata.create_all(
+                bind=engine,
+                tables=[Game.__table__, CollectionItem.__table__, CollectionVersion.__table__, OutboxEvent.__table__],
+            )
+            # Колонки, появившиеся после первого релиза collection_items (до создания их индексов).
+            with engine.begin() as conn:
+                conn.exec_driver_sql(
+                    "ALTER TABLE collection_items ADD COLUMN IF NOT EXISTS game_id INTEGER REFERENCES games(id)"
+                )
+                # Документы полнотекстового поиска (генерируемые колонки; таблицы переписываются один раз).
+                conn.exec_driver_sql(
+                    "ALTER TABLE collection_items ADD COLUMN IF NOT EXISTS note_tsv tsvector "
+                    f"GENERATED ALWAYS AS ({NOTE_TSV_SQL}) STORED"
+                )
+                conn.exec_driver_sql(
+                    f"ALTER TABLE games ADD COLUMN IF NOT EXISTS title_tsv tsvector GENERATED ALWAYS AS ({TITLE_TSV_SQL}) STORED"
+                )
+                # Подсказки ищут по началу любого слова, префиксный индекс по началу названия не нужен.
+                conn.exec_driver_sql("DROP INDEX IF EXISTS ix_games_title_prefix")
+            # create_all не добавляет новые индексы к уже существующей таблице.
+            for index in CollectionItem.__table__.indexes:
+                index.create(bind=engine, checkfirst=True)
+            # Колонки, добавленные после первого релиза таблицы outbox.
+            with engine.begin() as conn:
+                conn.exec_driver_sql("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS traceparent VARCHAR(64)")
+                conn.exec_driver_sql(
+                    "ALTER TABLE outbox ADD COLUMN IF NOT EXISTS event_id VARCHAR(36) NOT NULL DEFAULT gen_random_uuid()::text"
+                )
+                conn.exec_driver_sql("ALTER TABLE outbox ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ")
             logger.info("DB schema ensured (attempt %s)", attempt)
             break
         except Exception:
@@ -73,5 +155,64 @@ def on_startup():
         # Лучше упасть при старте, чем работать без таблиц.
         raise RuntimeError("DB init failed after retries")
 
+    # Нечёткие подсказки и поиск — только если в PostgreSQL есть pg_trgm.
+    setup_trigram(engine)
+    # Перенос в каталог games — отдельной командой (python -m app.migrate_catalog); при старте
+    # только триггер, который держит прежние title/platform заполненными, пока они есть.
+    if install_legacy_sync(engine):
+        unlinked = count_unlinked(engine)
+        if unlinked:
+            logger.warning(
+                "%s collection items are not linked to the game catalog, run `python -m app.migrate_catalog link`",
+                unlinked,
+            )
+    start_catalog_refresh()
+
+    # Соединение с RabbitMQ открывается один раз на процесс, а не на каждый запрос.
+    get_publisher()
+
+    # Relay переносит события из outbox в RabbitMQ в фоновом потоке.
+    # Несколько процессов могут разбирать outbox параллельно (аренда строк, SKIP LOCKED).
+    if OUTBOX_RELAY_ENABLED:
+        start_outbox_relay()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Останавливает outbox-relay и обновление каталога, закрывает соединение с RabbitMQ и пулы соединений с БД."""
+    await run_in_threadpool(stop_outbox_relay)
+    await run_in_threadpool(stop_catalog_refresh)
+    await run_in_threadpool(stop_publisher)
+    await dispose_engines()
+    shutdown_tracing()
+
+
+@app.get(
+    "/internal/jwt-cache",
+    summary="Показатели кэша JWT",
+    description="Размер кэша проверенных токенов и число попаданий/промахов в этом процессе.",
+)
+def jwt_cache_metrics():
+    """Возвращает счётчики кэша проверенных JWT."""
+    return jwt_cache_stats()
+
+
+@app.get(
+    "/internal/list-cache",
+    summary="Показатели кэша списков",
+    description="Размер кэша сериализованных страниц GET /api/v1/collection и число попаданий/промахов в этом процессе.",
+)
+def list_cache_metrics():
+    """Возвращает счётчики кэша страниц списка коллекции."""
+    return listing_cache_stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Метрики процесса (или всех worker'ов при PROMETHEUS_MULTIPROC_DIR) в формате Prometheus."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 
 app.include_router(collection_router)
+app.include_router(catalog_router)
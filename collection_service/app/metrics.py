@@ -0,0 +1,101 @@
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Для нескольких uvicorn worker'ов задайте PROMETHEUS_MULTIPROC_DIR — пустой каталог,
+# очищаемый перед запуском. Каждый процесс пишет значения в свои mmap-файлы,
+# а /metrics в любом из процессов отдаёт сумму по всем.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Границы бакетов для быстрых операций (ожидание пула, публикация).
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки HTTP-запроса",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Сколько HTTP-запросов обрабатывается прямо сейчас",
+    multiprocess_mode="livesum",
+)
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Сколько запрос ждал соединение из пула SQLAlchemy",
+    ["pool"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_SIZE = Gauge("db_pool_size", "Размер пула соединений", ["pool"], multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Соединения, выданные из пула", ["pool"], multiprocess_mode="livesum"
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Соединения сверх pool_size (max_overflow)", ["pool"], multiprocess_mode="livesum"
+)
+DB_READ_SESSIONS = Counter(
+    "db_read_sessions_total",
+    "Сессии для чтения: replica, primary_sticky (реплики ещё не дошли до записи клиента), primary_failover (нет доступных реплик)",
+    ["target"],
+)
+
+MQ_PUBLISH_SECONDS = Histogram(
+    "mq_publish_duration_seconds",
+    "Время от постановки события в очередь издателя до подтверждения брокером",
+    buckets=FAST_BUCKETS,
+)
+MQ_PUBLISH_FAILURES = Counter("mq_publish_failures_total", "Неудачные публикации", ["reason"])
+MQ_PUBLISH_BACKLOG = Gauge(
+    "mq_publish_backlog", "События, ещё не подтверждённые брокером", multiprocess_mode="livesum"
+)
+
+OUTBOX_RELAY_SECONDS = Histogram(
+    "outbox_relay_batch_duration_seconds", "Время одного прохода outbox-relay (выборка, публикация, удаление)"
+)
+OUTBOX_EVENTS = Counter("outbox_events_total", "События, обработанные outbox-relay", ["result"])
+
+COLLECTION_LIST_RESPONSES = Counter(
+    "collection_list_responses_total",
+    "Ответы GET /api/v1/collection: not_modified (304), cache_hit (из кэша процесса), db (из БД)",
+    ["result"],
+)
+
+CATALOG_SUGGEST_SECONDS = Histogram(
+    "catalog_suggest_duration_seconds",
+    "Время подбора подсказок каталога: memory (индекс процесса), db (префикс в БД), trigram (pg_trgm)",
+    ["source"],
+    buckets=(0.00005, 0.0001, 0.00025) + FAST_BUCKETS,
+)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float) -> None:
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+def observe_pool(pool_name: str, pool, wait_seconds: float | None = None) -> None:
+    """Обновляет метрики пула SQLAlchemy; вызывается при выдаче и возврате соединения."""
+    if wait_seconds is not None:
+        DB_POOL_CHECKOUT_SECONDS.labels(pool_name).observe(wait_seconds)
+    DB_POOL_SIZE.labels(pool_name).set(pool.size())
+    DB_POOL_CHECKED_OUT.labels(pool_name).set(pool.checkedout())
+    DB_POOL_OVERFLOW.labels(pool_name).set(max(0, pool.overflow()))
+
+
+def observe_publish(started: float, exc: BaseException | None) -> None:
+    if exc is None:
+        MQ_PUBLISH_SECONDS.observe(time.perf_counter() - started)
+    else:
+        MQ_PUBLISH_FAILURES.labels(type(exc).__name__).inc()
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Текст для /metrics в формате Prometheus: (тело, Content-Type)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
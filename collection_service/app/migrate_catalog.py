@@ -0,0 +1,211 @@
+import argparse
+import logging
+import os
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from .catalog import _key, resolve_games
+from .db import SessionLocal, engine
+
+# Сколько строк collection_items привязывать к каталогу за одну транзакцию.
+CATALOG_BACKFILL_BATCH = int(os.getenv("CATALOG_BACKFILL_BATCH", "1000"))
+
+logger = logging.getLogger(__name__)
+
+_MIGRATION_LOCK_ID = 7_302_001
+
+# Пока в collection_items есть прежние колонки title/platform, триггер заполняет их
+# из games для строк, которые пишет текущая версия (она знает только game_id).
+# Так колонки остаются полными, и откат на прежнюю версию сервиса возможен.
+# Привязку старой строки (game_id был NULL) триггер не трогает: её title/platform
+# остаются в том написании, в каком их ввёл пользователь.
+_LEGACY_SYNC_SQL = (
+    """
+    CREATE OR REPLACE FUNCTION collection_items_legacy_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR OLD.game_id IS NOT NULL THEN
+            SELECT title, platform INTO NEW.title, NEW.platform FROM games WHERE id = NEW.game_id;
+        END IF;
+        RETURN NEW;
+    END
+    $$
+    """,
+    "CREATE OR REPLACE TRIGGER collection_items_legacy_sync BEFORE INSERT OR UPDATE OF game_id "
+    "ON collection_items FOR EACH ROW WHEN (NEW.game_id IS NOT NULL) EXECUTE FUNCTION collection_items_legacy_sync()",
+)
+
+_LEGACY_ITEMS = text(
+    "SELECT id, title, platform FROM collection_items WHERE game_id IS NULL "
+    "ORDER BY id LIMIT :limit FOR UPDATE SKIP LOCKED"
+)
+
+
+def _has_column(conn: Connection, name: str) -> bool:
+    return (
+        conn.execute(
+            text(
+                "SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() "
+                "AND table_name = 'collection_items' AND column_name = :name"
+            ),
+            {"name": name},
+        ).first()
+        is not None
+    )
+
+
+def install_legacy_sync(engine: Engine) -> bool:
+    """Ставит триггер collection_items_legacy_sync, если прежние колонки ещё есть.
+
+    Вызывается при старте сервиса; только добавляет объекты и ничего не удаляет.
+    Возвращает True, если в collection_items ещё есть title/platform.
+    """
+    with engine.begin() as conn:
+        # CREATE OR REPLACE из нескольких процессов сразу конфликтует на каталоге PostgreSQL.
+        conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({_MIGRATION_LOCK_ID})")
+        if not _has_column(conn, "title"):
+            return False
+        for statement in _LEGACY_SYNC_SQL:
+            conn.exec_driver_sql(statement)
+    return True
+
+
+def count_unlinked(engine: Engine) -> int:
+    """Сколько строк collection_items ещё без game_id (их показывать нечем — название только в games)."""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM collection_items WHERE game_id IS NULL")).scalar_one()
+
+
+def _link_legacy_batch(db: Session) -> int:
+    # Строки, записанные до появления каталога: название и платформа есть только в самой строке.
+    rows = db.execute(_LEGACY_ITEMS, {"limit": CATALOG_BACKFILL_BATCH}).all()
+    if rows:
+        games = resolve_games(db, [(r.title, r.platform) for r in rows])
+        db.execute(
+            text("UPDATE collection_items SET game_id = :game_id WHERE id = :item_id"),
+            [{"item_id": r.id, "game_id": game.id} for r, game in zip(rows, games)],
+        )
+    return len(rows)
+
+
+def link_legacy_items(engine: Engine) -> int:
+    """Проставляет game_id строкам без него, пачками по CATALOG_BACKFILL_BATCH.
+
+    Каждая пачка — своя короткая транзакция (SKIP LOCKED), таблица не блокируется,
+    колонки title/platform не меняются. Повторный запуск безопасен. Возвращает
+    число привязанных строк.
+    """
+    total = 0
+    with engine.connect() as conn:
+        if not _has_column(conn, "title"):
+            return 0
+    while True:
+        with SessionLocal() as db:
+            linked = _link_legacy_batch(db)
+            db.commit()
+        if not linked:
+            return total
+        total += linked
+
+
+def find_mismatches(engine: Engine, limit: int = 20) -> tuple[int, list[tuple[int, str, str, str, str]]]:
+    """Строки, у которых прежние title/platform не совпадают с игрой каталога (по catalog.normalize).
+
+    Например, название изменила прежняя версия сервиса уже после привязки.
+    Возвращает общее число таких строк и до limit примеров (id, title, platform, игра, платформа игры).
+    """
+    found, examples = 0, []
+    stmt = text(
+        "SELECT ci.id, ci.title, ci.platform, g.title, g.platform, g.title_norm, g.platform_norm "
+        "FROM collection_items ci JOIN games g ON g.id = ci.game_id"
+    )
+    with engine.connect() as conn:
+        for row in conn.execution_options(yield_per=CATALOG_BACKFILL_BATCH).execute(stmt):
+            if _key(row[1] or "", row[2] or "") != (row[5], row[6]):
+                found += 1
+                if len(examples) < limit:
+                    examples.append(tuple(row[:5]))
+    return found, examples
+
+
+def drop_legacy_columns(engine: Engine) -> int:
+    """Удаляет из collection_items прежние title/platform; game_id становится NOT NULL.
+
+    Необратимо, поэтому выполняется только командой `python -m app.migrate_catalog drop-legacy`
+    после проверки (status): прежняя версия сервиса после этого работать не сможет.
+    Строки, которые успели вставить её процессы, привязываются под ACCESS EXCLUSIVE
+    перед удалением. Возвращает число таких строк.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.exec_driver_sql(f"SELECT pg_advisory_lock({_MIGRATION_LOCK_ID})")
+        try:
+            if not _has_column(lock_conn, "title"):
+                return 0
+            if _has_column(lock_conn, "search_tsv"):
+                # Колонка поиска зависит от title; её судьбу решает не эта миграция.
+                raise RuntimeError(
+                    "collection_items.search_tsv depends on title; drop it before removing the legacy columns"
+                )
+            unlinked = count_unlinked(engine)
+            if unlinked > CATALOG_BACKFILL_BATCH:
+                # Под ACCESS EXCLUSIVE привязываются только «опоздавшие» строки, остальное — заранее.
+                raise RuntimeError(f"{unlinked} collection items are not linked yet, run `link` first")
+            mismatched, _ = find_mismatches(engine, limit=0)
+            if mismatched:
+                raise RuntimeError(f"{mismatched} collection items do not match their catalog game, see `status`")
+
+            total = 0
+            with SessionLocal() as db:
+                db.execute(text("LOCK TABLE collection_items IN ACCESS EXCLUSIVE MODE"))
+                while linked := _link_legacy_batch(db):
+                    total += linked
+                db.execute(text("DROP TRIGGER IF EXISTS collection_items_legacy_sync ON collection_items"))
+                db.execute(text("DROP FUNCTION IF EXISTS collection_items_legacy_sync()"))
+                db.execute(
+                    text(
+                        "ALTER TABLE collection_items DROP COLUMN title, DROP COLUMN platform, "
+                        "ALTER COLUMN game_id SET NOT NULL"
+                    )
+                )
+                db.commit()
+            return total
+        finally:
+            lock_conn.exec_driver_sql(f"SELECT pg_advisory_unlock({_MIGRATION_LOCK_ID})")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.migrate_catalog",
+        description="Перенос названий и платформ collection_items в каталог games",
+    )
+    parser.add_argument(
+        "command",
+        choices=["status", "link", "drop-legacy"],
+        help="status — проверка; link — проставить game_id; drop-legacy — удалить прежние колонки (необратимо)",
+    )
+    args = parser.parse_args(argv)
+
+    with engine.connect() as conn:
+        legacy = _has_column(conn, "title")
+    if args.command == "status":
+        print(f"legacy columns: {'present' if legacy else 'dropped'}")
+        print(f"unlinked items: {count_unlinked(engine)}")
+        if legacy:
+            mismatched, examples = find_mismatches(engine)
+            print(f"mismatched items: {mismatched}")
+            for example in examples:
+                print("  id=%s %r / %r -> game %r / %r" % example)
+    elif args.command == "link":
+        linked = link_legacy_items(engine)
+        logger.info("Linked %s collection items to the game catalog", linked)
+        print(linked)
+    else:
+        linked = drop_legacy_columns(engine)
+        logger.info("Dropped legacy title/platform columns (linked %s late items)", linked)
+
+
+if __name__ == "__main__":
+    # Миграция в каталог: `python -m app.migrate_catalog status`, затем `link`, после проверки — `drop-legacy`.
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    main()
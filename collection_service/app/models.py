@@ -1,7 +1,23 @@
+import uuid
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Table
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Computed,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Table,
+    Text,
+    UniqueConstraint,
+    func,
+    select,
+)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import Mapped, column_property, mapped_column
 
 from .db import Base
 
@@ -18,19 +34,121 @@ users = Table(
 )
 
 
+# Документы полнотекстового поиска по коллекции: название игры (вес A, в games) и
+# заметка (вес B, в collection_items); search.py склеивает их через ||.
+# Конфигурация simple — без стемминга и стоп-слов: названия игр бывают на любом
+# языке, а поиск идёт по префиксам слов. Выражения нужны и для ALTER TABLE в
+# main.py, поэтому они вынесены в константы.
+TITLE_TSV_SQL = "setweight(to_tsvector('simple'::regconfig, coalesce(title, '')), 'A')"
+NOTE_TSV_SQL = "setweight(to_tsvector('simple'::regconfig, coalesce(note, '')), 'B')"
+
+
+class Game(Base):
+    """Игра в общем каталоге (таблица games): одна строка на пару (название, платформа).
+
+    title/platform — написание, в котором игру добавили первой; title_norm/platform_norm —
+    ключ дедупликации (см. catalog.normalize): «The  Witcher 3» и «the witcher 3» — одна игра.
+    """
+
+    __tablename__ = "games"
+    __table_args__ = (UniqueConstraint("title_norm", "platform_norm", name="ux_games_title_platform"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[str] = mapped_column(String(255), nullable=False)
+    platform: Mapped[str] = mapped_column(String(64), nullable=False)
+    title_norm: Mapped[str] = mapped_column(String(255), nullable=False)
+    platform_norm: Mapped[str] = mapped_column(String(64), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    # Генерируемая колонка: PostgreSQL пересчитывает её сам; deferred — в подсказках она не нужна.
+    title_tsv: Mapped[str] = mapped_column(TSVECTOR, Computed(TITLE_TSV_SQL, persisted=True), deferred=True)
+
+
 class CollectionItem(Base):
-    """Элемент коллекции видеоигр пользователя (таблица collection_items)."""
+    """Элемент коллекции видеоигр пользователя (таблица collection_items).
+
+    Название и платформа хранятся только в каталоге (games); у элемента — game_id,
+    а title/platform читаются из games (см. _game_column) и в запросах ведут себя как колонки.
+    """
 
     __tablename__ = "collection_items"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True, nullable=False)
 
-    title: Mapped[str] = mapped_column(String(255), nullable=False)
-    platform: Mapped[str] = mapped_column(String(64), nullable=False, default="PC")
+    game_id: Mapped[int] = mapped_column(Integer, ForeignKey("games.id"), index=True, nullable=False)
 
     status: Mapped[str] = mapped_column(String(32), nullable=False, default="planned")
     rating: Mapped[int | None] = mapped_column(Integer, nullable=True)
     note: Mapped[str | None] = mapped_column(String(500), nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    # Генерируемая колонка: PostgreSQL пересчитывает её сам при каждом изменении note.
+    # deferred — в обычных выборках элементов она не нужна.
+    note_tsv: Mapped[str] = mapped_column(TSVECTOR, Computed(NOTE_TSV_SQL, persisted=True), deferred=True)
+
+
+def _game_column(column):
+    # Коррелированный подзапрос к games по первичному ключу: и в SELECT элементов, и в фильтрах.
+    return column_property(
+        select(column).where(Game.id == CollectionItem.game_id).correlate_except(Game).scalar_subquery()
+    )
+
+
+CollectionItem.title = _game_column(Game.title)
+CollectionItem.platform = _game_column(Game.platform)
+
+
+# Составные индексы под keyset-пагинацию списка коллекции: фильтр по user_id,
+# затем ключ сортировки и id как тай-брейкер. Рейтинг сортируется как
+# COALESCE(rating, 0), чтобы NULL не ломал сравнение кортежей.
+Index("ix_collection_items_user_id_id", CollectionItem.user_id, CollectionItem.id)
+Index("ix_collection_items_user_created", CollectionItem.user_id, CollectionItem.created_at, CollectionItem.id)
+Index(
+    "ix_collection_items_user_rating",
+    CollectionItem.user_id,
+    func.coalesce(CollectionItem.rating, 0),
+    CollectionItem.id,
+)
+Index("ix_collection_items_user_status", CollectionItem.user_id, CollectionItem.status, CollectionItem.id)
+# Фильтр по платформе — game_id IN (игры этой платформы): по индексу берутся
+# только строки пользователя с этими играми, а не вся его коллекция.
+Index("ix_items_user_game", CollectionItem.user_id, CollectionItem.game_id, CollectionItem.id)
+
+
+class CollectionVersion(Base):
+    """Номер версии коллекции пользователя (таблица collection_versions).
+
+    Увеличивается в той же транзакции, что и любое изменение collection_items
+    пользователя, и служит ETag'ом списка: проверка If-None-Match читает одну
+    строку по первичному ключу и не трогает collection_items.
+    """
+
+    __tablename__ = "collection_versions"
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=1)
+
+
+class OutboxEvent(Base):
+    """Событие, ожидающее публикации в RabbitMQ (таблица outbox).
+
+    Пишется в той же транзакции, что и изменение collection_items, поэтому
+    событие не теряется, даже если брокер недоступен. Публикует его outbox-relay.
+    """
+
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    routing_key: Mapped[str] = mapped_column(String(128), nullable=False)
+    payload_json: Mapped[str] = mapped_column(Text, nullable=False)
+    # Уникальный id события: уходит в message_id сообщения и не меняется при повторных
+    # публикациях, поэтому stats_service может отбрасывать дубликаты.
+    event_id: Mapped[str] = mapped_column(String(36), nullable=False, default=lambda: str(uuid.uuid4()))
+    # W3C traceparent запроса, породившего событие: relay продолжает этот trace при публикации.
+    traceparent: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    # До какого момента строка закреплена за relay, который её опубликовал и ждёт
+    # подтверждения брокера; NULL или прошедшее время — строку может взять любой relay.
+    lease_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -1,45 +1,328 @@
 import json
 import logging
 import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
 
 import pika
+from pika.spec import Basic
+
+from .metrics import MQ_PUBLISH_BACKLOG, observe_publish
 
 RABBITMQ_URL = os.getenv("RABBITMQ_URL", "")
 
 EXCHANGE = "events"
 EXCHANGE_TYPE = "topic"
 
+# Сколько каналов держит один процесс (uvicorn worker) на общем соединении.
+MQ_PUBLISH_CHANNELS = int(os.getenv("MQ_PUBLISH_CHANNELS", "4"))
+# Максимум событий, ожидающих отправки; при переполнении новые события отбрасываются с ошибкой.
+MQ_PUBLISH_QUEUE_MAX = int(os.getenv("MQ_PUBLISH_QUEUE_MAX", "10000"))
+# Пауза перед переподключением к брокеру.
+MQ_RECONNECT_DELAY = float(os.getenv("MQ_RECONNECT_DELAY", "2"))
 
-def publish_event(routing_key: str, payload: dict) -> None:
-    """Публикует событие в RabbitMQ.
 
-    Важно: любые ошибки отправки не должны «ронять» HTTP-обработчик.
-    Поэтому исключения здесь логируются, но наружу не пробрасываются.
+class PublishQueueFull(RuntimeError):
+    """Очередь исходящих событий переполнена (брокер недоступен слишком долго)."""
+
+
+class PublishNacked(RuntimeError):
+    """Брокер ответил basic.nack на публикацию."""
+
+
+class _ChannelState:
+    """Канал с включёнными publisher confirms и его неподтверждённые публикации."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.next_tag = 1
+        # delivery_tag -> (routing_key, body, properties, future)
+        self.pending: dict[int, tuple] = {}
+
+
+class EventPublisher:
+    """Долгоживущий издатель событий в RabbitMQ.
+
+    Держит одно SelectConnection и пул каналов в отдельном потоке с ioloop.
+    Обработчики HTTP только кладут событие в очередь и сразу возвращаются;
+    exchange объявляется один раз при открытии канала, подтверждения брокера
+    (в том числе пачечные, `multiple=True`) разбираются в потоке ioloop.
+    При обрыве соединения неподтверждённые события возвращаются в очередь
+    и отправляются заново после переподключения.
     """
-    connection = None
-    try:
-        params = pika.URLParameters(RABBITMQ_URL)
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
 
-        channel.exchange_declare(exchange=EXCHANGE, exchange_type=EXCHANGE_TYPE, durable=True)
+    def __init__(self, url: str, channels: int = MQ_PUBLISH_CHANNELS, queue_max: int = MQ_PUBLISH_QUEUE_MAX):
+        self._url = url
+        self._channels_wanted = max(1, channels)
+        self._queue_max = queue_max
 
-        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-        channel.basic_publish(
+        self._lock = threading.Lock()
+        self._outgoing: deque = deque()
+        self._drain_scheduled = False
+
+        self._conn = None
+        self._ready: list[_ChannelState] = []
+        self._rr = 0
+
+        self._thread: threading.Thread | None = None
+        self._stopping = False
+
+    # --- API для других потоков ---
+
+    def start(self) -> None:
+        """Запускает поток издателя (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="mq-publisher", daemon=True)
+            self._thread.start()
+
+    def publish(self, routing_key: str, body: bytes, properties: pika.BasicProperties | None = None) -> Future:
+        """Ставит сообщение в очередь на отправку.
+
+        Возвращает Future, который завершается после подтверждения брокером
+        (или с исключением при nack/переполнении очереди).
+        """
+        fut: Future = Future()
+        started = time.perf_counter()
+        fut.add_done_callback(lambda f: observe_publish(started, f.exception()))
+        props = properties or pika.BasicProperties(content_type="application/json", delivery_mode=2)
+        with self._lock:
+            if len(self._outgoing) >= self._queue_max:
+                fut.set_exception(PublishQueueFull("Publish queue is full"))
+                return fut
+            self._outgoing.append((routing_key, body, props, fut))
+        MQ_PUBLISH_BACKLOG.inc()
+        self._schedule_drain()
+        return fut
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Дожидается отправки накопленных событий (не дольше timeout) и закрывает соединение."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.backlog():
+            time.sleep(0.05)
+
+        self._stopping = True
+        conn = self._conn
+        if conn is not None:
+            try:
+                conn.ioloop.add_callback_threadsafe(self._close_connection)
+            except Exception:
+                logging.exception("Failed to schedule RabbitMQ connection close")
+        if self._thread is not None:
+            self._thread.join(timeout=max(0.0, deadline - time.monotonic()) + 1.0)
+        self._thread = None
+
+    def backlog(self) -> int:
+        """Сколько событий ещё не подтверждено брокером."""
+        with self._lock:
+            queued = len(self._outgoing)
+        return queued + sum(len(s.pending) for s in list(self._ready))
+
+    # --- всё, что ниже, выполняется в потоке ioloop ---
+
+    def _run(self) -> None:
+        while not self._stopping:
+            with self._lock:
+                self._drain_scheduled = False
+            try:
+                self._conn = pika.SelectConnection(
+                    pika.URLParameters(self._url),
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_open_error,
+                    on_close_callback=self._on_connection_closed,
+                )
+                self._conn.ioloop.start()
+            except Exception:
+                logging.exception("RabbitMQ publisher crashed")
+            finally:
+                self._conn = None
+                self._ready = []
+
+            if not self._stopping:
+                time.sleep(MQ_RECONNECT_DELAY)
+
+    def _schedule_drain(self) -> None:
+        conn = self._conn
+        if conn is None or not self._ready:
+            # Канала ещё нет: очередь отправится, как только он откроется.
+            return
+        with self._lock:
+            if self._drain_scheduled:
+                return
+            self._drain_scheduled = True
+        try:
+            conn.ioloop.add_callback_threadsafe(self._drain)
+        except Exception:
+            with self._lock:
+                self._drain_scheduled = False
+
+    def _drain(self) -> None:
+        with self._lock:
+            self._drain_scheduled = False
+            batch = list(self._outgoing)
+            self._outgoing.clear()
+
+        for i, (routing_key, body, props, fut) in enumerate(batch):
+            if not self._ready:
+                # Каналы закрылись посреди пачки — вернём остаток в начало очереди.
+                self._requeue(batch[i:])
+                return
+            state = self._ready[self._rr % len(self._ready)]
+            self._rr += 1
+            try:
+                state.channel.basic_publish(EXCHANGE, routing_key, body, properties=props)
+            except Exception:
+                logging.exception("Failed to publish event %s", routing_key)
+                self._requeue(batch[i:])
+                return
+            state.pending[state.next_tag] = (routing_key, body, props, fut)
+            state.next_tag += 1
+
+    def _requeue(self, items: list) -> None:
+        with self._lock:
+            self._outgoing.extendleft(reversed(items))
+
+    def _on_connection_open(self, conn) -> None:
+        logging.info("RabbitMQ publisher connected")
+        for _ in range(self._channels_wanted):
+            conn.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, conn, err) -> None:
+        logging.warning("RabbitMQ publisher connection failed: %s", err)
+        conn.ioloop.stop()
+
+    def _on_connection_closed(self, conn, reason) -> None:
+        if not self._stopping:
+            logging.warning("RabbitMQ publisher connection closed: %s", reason)
+        for state in self._ready:
+            self._return_pending(state)
+        self._ready = []
+        conn.ioloop.stop()
+
+    def _close_connection(self) -> None:
+        if self._conn is not None and not (self._conn.is_closing or self._conn.is_closed):
+            self._conn.close()
+
+    def _on_channel_open(self, channel) -> None:
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.exchange_declare(
             exchange=EXCHANGE,
-            routing_key=routing_key,
-            body=body,
-            properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
+            exchange_type=EXCHANGE_TYPE,
+            durable=True,
+            callback=lambda _frame: self._on_exchange_ok(channel),
+        )
+
+    def _on_exchange_ok(self, channel) -> None:
+        state = _ChannelState(channel)
+        channel.confirm_delivery(
+            ack_nack_callback=lambda frame: self._on_confirm(state, frame),
+            callback=lambda _frame: self._on_channel_ready(state),
         )
 
-        logging.info("Published event %s", routing_key)
+    def _on_channel_ready(self, state: _ChannelState) -> None:
+        self._ready.append(state)
+        with self._lock:
+            has_backlog = bool(self._outgoing)
+        if has_backlog:
+            self._drain()
+
+    def _on_channel_closed(self, channel, reason) -> None:
+        state = next((s for s in self._ready if s.channel is channel), None)
+        if state is not None:
+            self._ready.remove(state)
+            self._return_pending(state)
+        if not self._stopping:
+            logging.warning("RabbitMQ publisher channel %s closed: %s", channel.channel_number, reason)
+            conn = self._conn
+            if conn is not None and conn.is_open:
+                # Восстанавливаем размер пула каналов.
+                conn.ioloop.call_later(
+                    MQ_RECONNECT_DELAY, lambda: conn.is_open and conn.channel(on_open_callback=self._on_channel_open)
+                )
+
+    def _return_pending(self, state: _ChannelState) -> None:
+        """Возвращает неподтверждённые публикации канала в очередь (отправятся повторно)."""
+        if not state.pending:
+            return
+        items = [state.pending[tag] for tag in sorted(state.pending)]
+        state.pending.clear()
+        self._requeue(items)
+
+    def _on_confirm(self, state: _ChannelState, frame) -> None:
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in state.pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        ack = isinstance(method, Basic.Ack)
+        for tag in tags:
+            entry = state.pending.pop(tag, None)
+            if entry is None:
+                continue
+            routing_key, _body, _props, fut = entry
+            MQ_PUBLISH_BACKLOG.dec()
+            if ack:
+                fut.set_result(True)
+            else:
+                fut.set_exception(PublishNacked(f"Broker nacked event {routing_key}"))
+
+
+_publisher: EventPublisher | None = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher() -> EventPublisher:
+    """Возвращает издателя текущего процесса, при необходимости запуская его."""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = EventPublisher(RABBITMQ_URL)
+                _publisher.start()
+    return _publisher
+
+
+def stop_publisher(timeout: float = 5.0) -> None:
+    """Останавливает издателя процесса (вызывается при shutdown приложения)."""
+    global _publisher
+    with _publisher_lock:
+        publisher, _publisher = _publisher, None
+    if publisher is not None:
+        publisher.stop(timeout=timeout)
+
+
+def _log_publish_result(routing_key: str, fut: Future) -> None:
+    exc = fut.exception()
+    if exc is not None:
+        logging.error("Failed to publish event %s: %s", routing_key, exc)
+    else:
+        logging.debug("Published event %s", routing_key)
+
+
+def publish_event(routing_key: str, payload: dict) -> None:
+    """Публикует событие в RabbitMQ, не дожидаясь брокера.
+
+    Событие передаётся в поток издателя, поэтому HTTP-обработчик не ждёт
+    ни соединения, ни подтверждения. message_id и timestamp позволяют consumer'у
+    отбросить повторную доставку. Важно: любые ошибки отправки не должны
+    «ронять» HTTP-обработчик — они логируются, но наружу не пробрасываются.
+    """
+    try:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        props = pika.BasicProperties(
+            content_type="application/json",
+            delivery_mode=2,
+            message_id=str(uuid.uuid4()),
+            timestamp=int(time.time()),
+        )
+        fut = get_publisher().publish(routing_key, body, props)
+        fut.add_done_callback(lambda f: _log_publish_result(routing_key, f))
     except Exception:
         logging.exception("Failed to publish event %s", routing_key)
         # Не бросаем исключение дальше
-    finally:
-        # Гарантируем закрытие соединения, даже если что-то упало посередине.
-        try:
-            if connection and connection.is_open:
-                connection.close()
-        except Exception:
-            logging.exception("Failed to close RabbitMQ connection")
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+from datetime import timedelta, timezone
+
+import pika
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from sqlalchemy import delete, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal
+from .metrics import OUTBOX_EVENTS, OUTBOX_RELAY_SECONDS
+from .models import OutboxEvent
+from .mq import EventPublisher, get_publisher
+from .tracing import context_from_traceparent, current_traceparent, headers_for, setup_tracing, tracer
+
+# Сколько событий relay забирает из outbox за один проход.
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+# Как часто relay проверяет outbox, если его никто не разбудил.
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+# Сколько ждать подтверждений брокера для одной пачки.
+OUTBOX_CONFIRM_TIMEOUT = float(os.getenv("OUTBOX_CONFIRM_TIMEOUT", "10"))
+# На сколько секунд relay арендует опубликованную строку (продлевается, пока он ждёт подтверждения;
+# если процесс relay умер, по истечении аренды строку возьмёт другой).
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+# Запускать ли relay внутри веб-процесса (можно выключить и запускать `python -m app.outbox`).
+OUTBOX_RELAY_ENABLED = os.getenv("OUTBOX_RELAY_ENABLED", "1").lower() in ("1", "true", "yes")
+
+_wakeup = threading.Event()
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+# Строки, опубликованные relay этого процесса и ещё не подтверждённые брокером: id -> Future.
+# Меняется только из потока relay.
+_inflight: dict[int, Future] = {}
+
+
+def add_outbox_event(db: Session | AsyncSession, routing_key: str, payload: dict) -> None:
+    """Добавляет событие в outbox в рамках текущей транзакции.
+
+    Событие будет опубликовано relay'ем только после commit — вместе с изменением данных.
+    """
+    db.add(
+        OutboxEvent(
+            routing_key=routing_key,
+            payload_json=json.dumps(payload, ensure_ascii=False),
+            event_id=str(uuid.uuid4()),
+            traceparent=current_traceparent(),
+        )
+    )
+
+
+def notify_outbox() -> None:
+    """Будит relay этого процесса сразу после commit, не дожидаясь очередного опроса."""
+    _wakeup.set()
+
+
+def _publish_row(publisher: EventPublisher, row: OutboxEvent):
+    """Публикует строку outbox в span'е-продолжении trace'а исходного запроса.
+
+    Span закрывается по подтверждению брокера, а его контекст уходит в заголовке
+    traceparent сообщения — consumer продолжит trace от него. Заголовок user_id
+    нужен для раздела по пользователю в stats_service.
+
+    message_id (event_id строки) и timestamp (время создания события) одинаковы
+    при каждой повторной публикации строки — по ним consumer отбрасывает дубликаты.
+    """
+    span = tracer.start_span(
+        f"publish {row.routing_key}",
+        context=context_from_traceparent(row.traceparent),
+        kind=SpanKind.PRODUCER,
+        attributes={"messaging.system": "rabbitmq", "messaging.destination.name": row.routing_key},
+    )
+    headers = headers_for(span)
+    # По user_id consistent-hash exchange stats_service выбирает раздел: события
+    # одного пользователя попадают в одну очередь и обрабатываются по порядку.
+    user_id = json.loads(row.payload_json).get("user_id")
+    if user_id is not None:
+        headers["user_id"] = str(user_id)
+    props = pika.BasicProperties(
+        content_type="application/json",
+        delivery_mode=2,
+        headers=headers,
+        message_id=row.event_id,
+        timestamp=int(row.created_at.replace(tzinfo=timezone.utc).timestamp()) if row.created_at else None,
+    )
+    fut = publisher.publish(row.routing_key, row.payload_json.encode("utf-8"), props)
+
+    def _done(f):
+        if f.exception() is not None:
+            span.record_exception(f.exception())
+            span.set_status(Status(StatusCode.ERROR))
+        span.end()
+
+    fut.add_done_callback(_done)
+    return fut
+
+
+def _claim(batch_size: int) -> list[OutboxEvent]:
+    """Продлевает аренду строк, ждущих подтверждения, и берёт до batch_size свободных строк.
+
+    Короткая транзакция: `FOR UPDATE SKIP LOCKED` нужен только на время UPDATE,
+    дальше строки защищает lease_until — блокировки на время ожидания
+    подтверждений не держатся.
+    """
+    lease = func.now() + timedelta(seconds=OUTBOX_LEASE_SECONDS)
+    with SessionLocal() as db:
+        if _inflight:
+            db.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_(list(_inflight)))
+                .values(lease_until=lease)
+                .execution_options(synchronize_session=False)
+            )
+        rows: list[OutboxEvent] = []
+        if batch_size > 0:
+            free = (
+                select(OutboxEvent.id)
+                .where(or_(OutboxEvent.lease_until.is_(None), OutboxEvent.lease_until < func.now()))
+                .order_by(OutboxEvent.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = list(
+                db.scalars(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id.in_(free.scalar_subquery()))
+                    .values(lease_until=lease)
+                    .returning(OutboxEvent)
+                    .execution_options(synchronize_session=False)
+                )
+            )
+            db.expunge_all()
+        db.commit()
+    return sorted(rows, key=lambda row: row.id)
+
+
+def relay_batch(publisher: EventPublisher, batch_size: int = OUTBOX_BATCH_SIZE) -> tuple[int, int]:
+    """Один проход relay: публикует новую пачку событий и разбирает подтверждения.
+
+    Строки арендуются (lease_until) в короткой транзакции, поэтому несколько relay
+    (в разных процессах) разбирают outbox параллельно и не публикуют одно и то же.
+    Опубликованная строка остаётся в _inflight, пока брокер её не подтвердит:
+    сообщение уже в очереди EventPublisher (после обрыва он отправит его сам),
+    поэтому повторно строка не публикуется, а её аренда продлевается каждый проход.
+    Подтверждённые строки удаляются; отклонённые (nack, переполненная очередь)
+    освобождаются и уйдут на следующем проходе. Пока подтверждений ждут batch_size
+    строк, новые не берутся — при недоступном брокере очередь издателя не растёт.
+
+    Возвращает (сколько строк взято, сколько подтверждено).
+    """
+    started = time.perf_counter()
+    rows = _claim(batch_size - len(_inflight))
+    for row in rows:
+        _inflight[row.id] = _publish_row(publisher, row)
+    if not _inflight:
+        return 0, 0
+
+    wait(list(_inflight.values()), timeout=OUTBOX_CONFIRM_TIMEOUT)
+    sent_ids, failed_ids = [], []
+    for row_id, fut in list(_inflight.items()):
+        if fut.done():
+            del _inflight[row_id]
+            (failed_ids if fut.exception() is not None else sent_ids).append(row_id)
+
+    if sent_ids or failed_ids:
+        with SessionLocal() as db:
+            if sent_ids:
+                db.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(sent_ids)))
+            if failed_ids:
+                db.execute(
+                    update(OutboxEvent)
+                    .where(OutboxEvent.id.in_(failed_ids))
+                    .values(lease_until=None)
+                    .execution_options(synchronize_session=False)
+                )
+            db.commit()
+    OUTBOX_RELAY_SECONDS.observe(time.perf_counter() - started)
+    OUTBOX_EVENTS.labels("published").inc(len(sent_ids))
+    OUTBOX_EVENTS.labels("failed").inc(len(failed_ids))
+    OUTBOX_EVENTS.labels("unconfirmed").inc(sum(1 for row in rows if row.id in _inflight))
+    return len(rows), len(sent_ids)
+
+
+def run_outbox_relay_forever() -> None:
+    """Бесконечно переносит события из outbox в RabbitMQ.
+
+    Пока outbox отдаёт полные пачки, relay работает без пауз; когда он пуст —
+    ждёт notify_outbox() или OUTBOX_POLL_INTERVAL.
+    """
+    publisher = get_publisher()
+    logging.info("Outbox relay started")
+    while not _stop.is_set():
+        _wakeup.clear()
+        try:
+            taken, sent = relay_batch(publisher)
+        except Exception:
+            logging.exception("Outbox relay failed, retry in %ss", OUTBOX_POLL_INTERVAL)
+            _stop.wait(OUTBOX_POLL_INTERVAL)
+            continue
+
+        if _inflight or (taken and sent < taken):
+            logging.warning("Outbox relay: %s events not confirmed yet, will retry", len(_inflight) or taken - sent)
+            _stop.wait(OUTBOX_POLL_INTERVAL)
+        elif taken < OUTBOX_BATCH_SIZE:
+            _wakeup.wait(OUTBOX_POLL_INTERVAL)
+
+
+def start_outbox_relay() -> None:
+    """Запускает relay в daemon-потоке текущего процесса."""
+    global _thread
+    if _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=run_outbox_relay_forever, name="outbox-relay", daemon=True)
+    _thread.start()
+
+
+def stop_outbox_relay(timeout: float = 5.0) -> None:
+    """Останавливает relay текущего процесса."""
+    global _thread
+    _stop.set()
+    _wakeup.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+    _thread = None
+
+
+if __name__ == "__main__":
+    # Отдельный процесс relay: `python -m app.outbox`.
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    setup_tracing(os.getenv("SERVICE_NAME", "collection_outbox"))
+    run_outbox_relay_forever()
@@ -0,0 +1,20 @@
+import base64
+import json
+
+
+def encode_cursor(values: list) -> str:
+    """Кодирует позицию keyset-пагинации в непрозрачную для клиента строку."""
+    raw = json.dumps(values, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Декодирует курсор, выданный encode_cursor. Бросает ValueError на мусор."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
@@ -0,0 +1,52 @@
+import time
+
+from fastapi import APIRouter, Depends, Query
+
+from . import catalog
+from .db import read_session_scope
+from .metrics import CATALOG_SUGGEST_SECONDS
+from .schemas import CatalogSuggestions, GameOut
+from .security import get_current_user_id
+
+router = APIRouter(prefix="/api/v1/catalog", tags=["catalog"])
+
+# С какой длины запроса пробовать нечёткий поиск (короче у pg_trgm слишком мало триграмм).
+TRIGRAM_MIN_LENGTH = 3
+
+
+@router.get(
+    "/suggest",
+    response_model=CatalogSuggestions,
+    summary="Подсказки по каталогу игр",
+    description="Игры общего каталога, в названии которых есть слово, начинающееся с q (без учёта регистра). Если таких нет и на сервере есть pg_trgm, возвращаются похожие названия (опечатки).",
+)
+async def suggest_games(
+    q: str = Query(min_length=1, max_length=100),
+    limit: int = Query(default=10, ge=1, le=20),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Подсказки для автодополнения названия игры.
+
+    Обычно отвечает индекс каталога в памяти процесса (catalog.catalog_index) —
+    без обращения к БД. Пока индекс не загружен (или выключен) — тот же поиск по
+    началам слов в games (catalog.suggest_prefix); если ничего не нашлось — триграммный поиск pg_trgm.
+    """
+    prefix = catalog.normalize(q)
+    if not prefix:
+        return {"items": []}
+
+    started = time.perf_counter()
+    source = "memory"
+    if catalog.catalog_index.loaded:
+        items = catalog.catalog_index.suggest(prefix, limit)
+    else:
+        source = "db"
+        async with read_session_scope() as db:
+            items = await db.run_sync(catalog.suggest_prefix, prefix, limit)
+    if not items and catalog.trigram_enabled and len(prefix) >= TRIGRAM_MIN_LENGTH:
+        source = "trigram"
+        async with read_session_scope() as db:
+            items = await db.run_sync(catalog.suggest_similar, prefix, limit)
+    CATALOG_SUGGEST_SECONDS.labels(source).observe(time.perf_counter() - started)
+
+    return {"items": [GameOut(id=game_id, title=title, platform=platform) for game_id, title, platform in items]}
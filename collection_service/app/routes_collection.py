@@ -1,32 +1,191 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+import logging
+from datetime import datetime
+from typing import Literal
 
-from .db import get_db
-from .models import CollectionItem
-from .mq import publish_event
-from .schemas import ItemCreate, ItemOut, ItemUpdate
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .catalog import normalize
+from .db import get_db, get_read_db
+from .exporter import export_csv, export_ndjson
+from .importer import (
+    IMPORT_CHUNK_SIZE,
+    IMPORT_MAX_ERRORS,
+    IMPORT_MAX_ROWS,
+    insert_chunk,
+    iter_csv,
+    iter_lines,
+    iter_ndjson,
+    validate_item,
+)
+from .listing import (
+    bump_version,
+    current_version,
+    listing_cache,
+    listing_response,
+    make_etag,
+    matching_etag,
+    not_modified,
+)
+from .metrics import COLLECTION_LIST_RESPONSES
+from .models import CollectionItem, Game
+from .outbox import add_outbox_event, notify_outbox
+from .pagination import decode_cursor, encode_cursor
+from .schemas import (
+    BATCH_MAX_OPERATIONS,
+    BatchAdd,
+    BatchDelete,
+    BatchPatch,
+    BatchRequest,
+    BatchResult,
+    ImportResult,
+    ItemCreate,
+    ItemOut,
+    ItemPage,
+    ItemUpdate,
+)
+from .search import search_items
 from .security import get_current_user_id
+from .writes import (
+    added_payload,
+    delete_items_returning,
+    deleted_payload,
+    insert_items,
+    update_item_returning,
+    update_items_returning,
+    updated_payload,
+)
 
 router = APIRouter(prefix="/api/v1/collection", tags=["collection"])
 
+logger = logging.getLogger(__name__)
+
+# Ключи сортировки списка (по убыванию); id всегда добавляется как тай-брейкер.
+# Выражения совпадают с составными индексами в models.py.
+SORT_KEYS = {
+    "id": None,
+    "created_at": CollectionItem.created_at,
+    "rating": func.coalesce(CollectionItem.rating, 0),
+}
+
+
+def _cursor_key(sort: str, item: CollectionItem):
+    """Значение ключа сортировки элемента в виде, пригодном для JSON-курсора."""
+    if sort == "created_at":
+        return item.created_at.isoformat() if item.created_at else None
+    if sort == "rating":
+        return item.rating or 0
+    return None
+
+
+def _parse_cursor(cursor: str, sort: str) -> tuple:
+    """Разбирает курсор и проверяет, что он выдан для той же сортировки."""
+    try:
+        c_sort, c_key, c_id = decode_cursor(cursor)
+        if c_sort != sort:
+            raise ValueError("Cursor sort mismatch")
+        if sort == "created_at":
+            c_key = datetime.fromisoformat(c_key)
+        elif sort == "rating":
+            c_key = int(c_key)
+        return c_key, int(c_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
 @router.get(
     "",
-    response_model=list[ItemOut],
+    response_model=ItemPage,
     summary="Список игр",
-    description="Возвращает список игр в коллекции текущего пользователя (по JWT).",
+    description="Возвращает страницу игр из коллекции текущего пользователя (по JWT). Поддерживает фильтры по status/platform, сортировку по id/created_at/rating и курсорную пагинацию: для следующей страницы передайте next_cursor из ответа в параметр cursor. Ответ содержит ETag: с заголовком If-None-Match сервер вернёт 304, если коллекция не менялась. Большие ответы сжимаются (gzip/br по Accept-Encoding).",
 )
-def list_items(
-    db: Session = Depends(get_db),
+async def list_items(
+    request: Request,
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: str | None = Query(default=None),
+    status: str | None = Query(default=None, max_length=32),
+    platform: str | None = Query(default=None, max_length=64),
+    sort: Literal["id", "created_at", "rating"] = Query(default="id"),
+    db: AsyncSession = Depends(get_read_db),
     user_id: int = Depends(get_current_user_id),
 ):
-    """Возвращает все элементы коллекции текущего пользователя (по user_id из JWT)."""
-    return (
-        db.query(CollectionItem)
-        .filter(CollectionItem.user_id == user_id)
-        .order_by(CollectionItem.id.desc())
-        .all()
-    )
+    """Возвращает страницу элементов коллекции текущего пользователя.
+
+    Пагинация keyset'ная: следующая страница начинается строго после последнего
+    (ключ сортировки, id) предыдущей, поэтому время ответа не зависит ни от
+    размера коллекции, ни от номера страницы.
+
+    ETag — версия коллекции (collection_versions) и параметры запроса: проверка
+    If-None-Match и попадание в кэш процесса (listing_cache) не читают collection_items.
+    """
+    params = (limit, cursor, status, platform, sort)
+    # Версия читается до страницы: страница может оказаться новее версии, но не старше.
+    version = await current_version(db, user_id)
+    etag = make_etag(user_id, version, params)
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched is not None:
+        COLLECTION_LIST_RESPONSES.labels("not_modified").inc()
+        return not_modified(matched)
+
+    cache_key = (user_id, version, params)
+    variants = listing_cache.get(cache_key)
+    if variants is not None:
+        COLLECTION_LIST_RESPONSES.labels("cache_hit").inc()
+        return listing_response(variants, etag, request)
+
+    q = select(CollectionItem).where(CollectionItem.user_id == user_id)
+    if status is not None:
+        q = q.where(CollectionItem.status == status)
+    if platform is not None:
+        # Платформа сравнивается так же, как при дедупликации каталога (без учёта регистра и пробелов).
+        platform_games = select(Game.id).where(Game.platform_norm == normalize(platform))
+        q = q.where(CollectionItem.game_id.in_(platform_games))
+
+    key = SORT_KEYS[sort]
+    if cursor:
+        c_key, c_id = _parse_cursor(cursor, sort)
+        if key is None:
+            q = q.where(CollectionItem.id < c_id)
+        else:
+            q = q.where(tuple_(key, CollectionItem.id) < (c_key, c_id))
+
+    order_by = [CollectionItem.id.desc()] if key is None else [key.desc(), CollectionItem.id.desc()]
+    # Берём на одну строку больше, чтобы понять, есть ли следующая страница.
+    rows = list((await db.scalars(q.order_by(*order_by).limit(limit + 1))).all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([sort, _cursor_key(sort, last), last.id])
+
+    body = ItemPage(items=rows, next_cursor=next_cursor).model_dump_json().encode("utf-8")
+    COLLECTION_LIST_RESPONSES.labels("db").inc()
+    return listing_response(listing_cache.put(cache_key, body), etag, request)
+
+
+@router.get(
+    "/search",
+    response_model=ItemPage,
+    summary="Поиск по коллекции",
+    description="Полнотекстовый поиск по названию и заметке игр текущего пользователя: все слова запроса должны встречаться (как начала слов), результаты упорядочены по релевантности, совпадение в названии важнее совпадения в заметке. Если ничего не найдено и на сервере есть pg_trgm, ищутся похожие названия (опечатки). Пагинация — как у списка: передайте next_cursor в параметр cursor.",
+)
+async def search_collection(
+    q: str = Query(min_length=1, max_length=200),
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: str | None = Query(default=None),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Ищет игры в коллекции текущего пользователя (см. search.search_items)."""
+    try:
+        items, next_cursor = await search_items(db, user_id, q, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return ItemPage(items=items, next_cursor=next_cursor)
 
 
 @router.post(
@@ -35,28 +194,171 @@ def list_items(
     summary="Добавить игру",
     description="Добавляет игру в коллекцию пользователя (статус по умолчанию: planned) и публикует событие в RabbitMQ.",
 )
-def add_item(
+async def add_item(
     data: ItemCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Создаёт элемент коллекции и публикует событие `collection.item_added`.
+
+    INSERT ... RETURNING сразу отдаёт строку со всеми полями — без flush и refresh.
+    """
+    (item,) = await insert_items(db, user_id, [data])
+    add_outbox_event(db, "collection.item_added", {"user_id": user_id, **added_payload(item)})
+    await bump_version(db, user_id)
+    await db.commit()
+    listing_cache.invalidate(user_id)
+    notify_outbox()
+
+    return item
+
+
+@router.post(
+    "/import",
+    response_model=ImportResult,
+    summary="Импорт игр",
+    description="Потоково импортирует игры из тела запроса в формате NDJSON (application/x-ndjson, по объекту {title, platform} на строку) или CSV (text/csv, с заголовком title,platform). Строки вставляются пачками; на каждую пачку публикуется одно событие collection.items_imported. Ошибочные строки пропускаются и возвращаются в errors с номером строки. Каждая пачка коммитится отдельно: если импорт остановлен раньше конца (больше IMPORT_MAX_ROWS строк или ошибка записи), ответ содержит stopped=true, причину и resume_line — номер первой строки, которая не импортирована.",
+)
+async def import_items(
+    request: Request,
+    format: Literal["ndjson", "csv"] | None = Query(default=None),
     user_id: int = Depends(get_current_user_id),
 ):
-    """Создаёт элемент коллекции и публикует событие `collection.item_added`."""
-    item = CollectionItem(
-        user_id=user_id,
-        title=data.title,
-        platform=data.platform,
-        status="planned",
+    """Импортирует игры из NDJSON/CSV, не загружая тело запроса в память целиком.
+
+    Уже записанные пачки не откатываются, поэтому при остановке импорт не
+    отвечает ошибкой, а сообщает, сколько строк записано и с какой продолжить.
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        if "csv" in content_type:
+            format = "csv"
+        elif "json" in content_type:
+            format = "ndjson"
+        else:
+            raise HTTPException(status_code=415, detail="Use application/x-ndjson or text/csv")
+
+    parse = iter_csv if format == "csv" else iter_ndjson
+    imported = failed = seen = 0
+    errors: list[dict] = []
+    chunk: list[ItemCreate] = []
+    # Номер строки, с которой начинается ещё не записанная пачка.
+    chunk_line: int | None = None
+    stop_reason: str | None = None
+    resume_line: int | None = None
+
+    async def flush() -> bool:
+        nonlocal imported, chunk, chunk_line, stop_reason, resume_line
+        try:
+            imported += len(await insert_chunk(user_id, chunk))
+        except SQLAlchemyError:
+            logger.exception("Import chunk from line %s failed for user %s", chunk_line, user_id)
+            stop_reason, resume_line = "Failed to store rows", chunk_line
+            return False
+        notify_outbox()
+        chunk, chunk_line = [], None
+        return True
+
+    async for line_no, record, error in parse(iter_lines(request.stream())):
+        seen += 1
+        if seen > IMPORT_MAX_ROWS:
+            # Строки до лимита импортируются, остальное тело не читается.
+            if not chunk or await flush():
+                stop_reason, resume_line = f"Too many rows (max {IMPORT_MAX_ROWS})", line_no
+            break
+
+        item = None
+        if error is None:
+            item, error = validate_item(record)
+        if error is not None:
+            failed += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "error": error})
+            continue
+
+        if chunk_line is None:
+            chunk_line = line_no
+        chunk.append(item)
+        if len(chunk) >= IMPORT_CHUNK_SIZE and not await flush():
+            break
+
+    if chunk and stop_reason is None:
+        await flush()
+
+    return ImportResult(
+        imported=imported,
+        failed=failed,
+        errors=errors,
+        stopped=stop_reason is not None,
+        stop_reason=stop_reason,
+        resume_line=resume_line,
     )
-    db.add(item)
-    db.commit()
-    db.refresh(item)
 
-    publish_event(
-        "collection.item_added",
-        {"user_id": user_id, "item_id": item.id, "title": item.title, "platform": item.platform},
+
+@router.post(
+    "/batch",
+    response_model=BatchResult,
+    summary="Пакет изменений",
+    description=f"Применяет до {BATCH_MAX_OPERATIONS} операций add/patch/delete в одной транзакции: все или ни одной. Каждая группа операций выполняется одним SQL-запросом, на весь пакет публикуется одно событие collection.batch_applied. Игра может встречаться в пакете только один раз; если хотя бы одна из игр не найдена, пакет не применяется (404).",
+)
+async def apply_batch(
+    data: BatchRequest,
+    db: AsyncSession = Depends(get_db),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Применяет пакет операций и публикует составное событие `collection.batch_applied`."""
+    adds = [op for op in data.operations if isinstance(op, BatchAdd)]
+    patches = [op for op in data.operations if isinstance(op, BatchPatch)]
+    delete_ids = [op.id for op in data.operations if isinstance(op, BatchDelete)]
+    ids = [op.id for op in patches] + delete_ids
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Each item may appear in a batch only once")
+
+    updated = await update_items_returning(db, user_id, patches) if patches else []
+    deleted = await delete_items_returning(db, user_id, delete_ids) if delete_ids else []
+    missing = set(ids) - {row.id for row in updated} - {row.id for row in deleted}
+    if missing:
+        # Транзакция не зафиксирована — get_db откатит её при закрытии сессии.
+        raise HTTPException(status_code=404, detail=f"Items not found: {sorted(missing)}")
+    added = await insert_items(db, user_id, adds) if adds else []
+
+    add_outbox_event(
+        db,
+        "collection.batch_applied",
+        {
+            "user_id": user_id,
+            "added": [added_payload(row) for row in added],
+            "updated": [updated_payload(row) for row in updated],
+            "deleted": [deleted_payload(row) for row in deleted],
+        },
     )
+    await bump_version(db, user_id)
+    await db.commit()
+    listing_cache.invalidate(user_id)
+    notify_outbox()
 
-    return item
+    return BatchResult(added=added, updated=updated, deleted=[row.id for row in deleted])
+
+
+@router.get(
+    "/export",
+    summary="Экспорт коллекции",
+    description="Потоково выгружает всю коллекцию текущего пользователя в формате NDJSON или CSV. Строки читаются из БД серверным курсором, поэтому выгрузка начинается сразу и не требует памяти под всю коллекцию.",
+)
+async def export_items(
+    format: Literal["ndjson", "csv"] = Query(default="ndjson"),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Стримит коллекцию текущего пользователя (NDJSON/CSV)."""
+    if format == "csv":
+        body, media_type = export_csv(user_id), "text/csv; charset=utf-8"
+    else:
+        body, media_type = export_ndjson(user_id), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="collection.{format}"'},
+    )
 
 
 @router.get(
@@ -65,16 +367,14 @@ def add_item(
     summary="Получить игру",
     description="Возвращает одну игру из коллекции по идентификатору. Доступна только владельцу (по JWT).",
 )
-def get_item(
+async def get_item(
     item_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     user_id: int = Depends(get_current_user_id),
 ):
     """Возвращает элемент коллекции по id (только если он принадлежит текущему пользователю)."""
-    item = (
-        db.query(CollectionItem)
-        .filter(CollectionItem.id == item_id, CollectionItem.user_id == user_id)
-        .first()
+    item = await db.scalar(
+        select(CollectionItem).where(CollectionItem.id == item_id, CollectionItem.user_id == user_id)
     )
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
@@ -87,36 +387,26 @@ def get_item(
     summary="Обновить игру",
     description="Частично обновляет поля игры (status/rating/note) и публикует событие в RabbitMQ.",
 )
-def update_item(
+async def update_item(
     item_id: int,
     data: ItemUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     user_id: int = Depends(get_current_user_id),
 ):
-    """Частично обновляет элемент коллекции и публикует событие `collection.item_updated`."""
-    item = (
-        db.query(CollectionItem)
-        .filter(CollectionItem.id == item_id, CollectionItem.user_id == user_id)
-        .first()
-    )
+    """Частично обновляет элемент коллекции и публикует событие `collection.item_updated`.
+
+    Проверка владельца, блокировка строки, чтение прежних status/rating и само
+    изменение — один UPDATE ... RETURNING (см. update_item_returning).
+    """
+    item = await update_item_returning(db, user_id, item_id, data)
     if not item:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    # Обновляем только те поля, которые реально переданы в PATCH-запросе.
-    if data.status is not None:
-        item.status = data.status
-    if data.rating is not None:
-        item.rating = data.rating
-    if data.note is not None:
-        item.note = data.note
-
-    db.commit()
-    db.refresh(item)
-
-    publish_event(
-        "collection.item_updated",
-        {"user_id": user_id, "item_id": item.id, "status": item.status, "rating": item.rating},
-    )
+    add_outbox_event(db, "collection.item_updated", {"user_id": user_id, **updated_payload(item)})
+    await bump_version(db, user_id)
+    await db.commit()
+    listing_cache.invalidate(user_id)
+    notify_outbox()
 
     return item
 
@@ -126,26 +416,23 @@ def update_item(
     summary="Удалить игру",
     description="Удаляет игру из коллекции пользователя и публикует событие в RabbitMQ.",
 )
-def delete_item(
+async def delete_item(
     item_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     user_id: int = Depends(get_current_user_id),
 ):
-    """Удаляет элемент коллекции и публикует событие `collection.item_deleted`."""
-    item = (
-        db.query(CollectionItem)
-        .filter(CollectionItem.id == item_id, CollectionItem.user_id == user_id)
-        .first()
-    )
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
+    """Удаляет элемент коллекции и публикует событие `collection.item_deleted`.
 
-    db.delete(item)
-    db.commit()
+    Один DELETE ... WHERE id AND user_id RETURNING: удалённая строка нужна для события.
+    """
+    deleted = await delete_items_returning(db, user_id, [item_id])
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Item not found")
 
-    publish_event(
-        "collection.item_deleted",
-        {"user_id": user_id, "item_id": item_id},
-    )
+    add_outbox_event(db, "collection.item_deleted", {"user_id": user_id, **deleted_payload(deleted[0])})
+    await bump_version(db, user_id)
+    await db.commit()
+    listing_cache.invalidate(user_id)
+    notify_outbox()
 
     return {"deleted": True}
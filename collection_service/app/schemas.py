@@ -1,5 +1,10 @@
+from typing import Annotated, Literal
+
 from pydantic import BaseModel, Field
 
+# Сколько операций можно передать в одном POST /api/v1/collection/batch.
+BATCH_MAX_OPERATIONS = 500
+
 class ItemCreate(BaseModel):
     title: str = Field(min_length=1, max_length=255)
     platform: str = Field(default="PC", max_length=64)
@@ -19,3 +24,50 @@ class ItemOut(BaseModel):
 
     class Config:
         from_attributes = True
+
+class ItemPage(BaseModel):
+    items: list[ItemOut]
+    next_cursor: str | None = None
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+class ImportResult(BaseModel):
+    imported: int
+    failed: int
+    errors: list[ImportRowError]
+    # Импорт остановлен до конца тела (лимит строк или ошибка записи); строки до
+    # resume_line уже в коллекции, начиная с неё — не импортированы.
+    stopped: bool = False
+    stop_reason: str | None = None
+    resume_line: int | None = None
+
+class GameOut(BaseModel):
+    id: int
+    title: str
+    platform: str
+
+class CatalogSuggestions(BaseModel):
+    items: list[GameOut]
+
+class BatchAdd(ItemCreate):
+    op: Literal["add"]
+
+class BatchPatch(ItemUpdate):
+    op: Literal["patch"]
+    id: int
+
+class BatchDelete(BaseModel):
+    op: Literal["delete"]
+    id: int
+
+BatchOperation = Annotated[BatchAdd | BatchPatch | BatchDelete, Field(discriminator="op")]
+
+class BatchRequest(BaseModel):
+    operations: list[BatchOperation] = Field(min_length=1, max_length=BATCH_MAX_OPERATIONS)
+
+class BatchResult(BaseModel):
+    added: list[ItemOut]
+    updated: list[ItemOut]
+    deleted: list[int]
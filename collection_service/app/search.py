@@ -0,0 +1,106 @@
+import os
+import re
+
+from sqlalchemy import cast, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import catalog
+from .models import CollectionItem, Game
+from .pagination import decode_cursor, encode_cursor
+
+# Сколько слов запроса учитывать (остальные отбрасываются).
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "8"))
+# С какой длины запроса пробовать нечёткий поиск по названию (pg_trgm).
+SEARCH_FUZZY_MIN_LENGTH = int(os.getenv("SEARCH_FUZZY_MIN_LENGTH", "3"))
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tsquery_text(q: str) -> str | None:
+    """Запрос для to_tsquery: каждое слово как префикс, все слова обязательны.
+
+    «witch 3» -> 'witch':* & '3':* — находит «The Witcher 3» по мере набора.
+    Строка собирается только из \\w-символов, поэтому синтаксис tsquery из
+    пользовательского ввода не протекает. None — в запросе нет ни одного слова.
+    """
+    words = _WORD_RE.findall(q.casefold())[:SEARCH_MAX_TERMS]
+    return " & ".join(f"'{word}':*" for word in words) or None
+
+
+def _score(expr):
+    # ts_rank/word_similarity возвращают real; в double precision значение
+    # без потерь проходит через JSON-курсор и обратно.
+    return cast(expr, DOUBLE_PRECISION)
+
+
+def parse_search_cursor(cursor: str) -> tuple[str, float, int]:
+    """(режим, оценка, id) из курсора поиска. Бросает ValueError на чужой или испорченный курсор."""
+    try:
+        mode, score, item_id = decode_cursor(cursor)
+        if mode not in ("fts", "fuzzy"):
+            raise ValueError("Unknown search mode")
+        return mode, float(score), int(item_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+async def _page(db: AsyncSession, stmt, score, limit: int, after: tuple[float, int] | None):
+    if after is not None:
+        stmt = stmt.where(tuple_(score, CollectionItem.id) < after)
+    rows = (await db.execute(stmt.order_by(score.desc(), CollectionItem.id.desc()).limit(limit + 1))).all()
+    return list(rows)
+
+
+async def search_items(
+    db: AsyncSession, user_id: int, q: str, limit: int, cursor: str | None
+) -> tuple[list[CollectionItem], str | None]:
+    """Страница результатов поиска по коллекции пользователя и курсор следующей.
+
+    Основной режим (fts) — полнотекстовый поиск по документу «название игры
+    (games.title_tsv) || заметка (note_tsv)», порядок — ts_rank_cd (совпадение в
+    названии весит больше, чем в заметке). Документ склеивается из двух таблиц,
+    поэтому GIN-индекс к нему неприменим: строки отбираются по индексу user_id,
+    и стоимость поиска растёт с размером коллекции, а не всей таблицы. Если на
+    первой странице ничего не нашлось и есть pg_trgm — режим fuzzy: названия,
+    похожие на запрос (опечатки), по word_similarity. Режим записан в курсоре,
+    поэтому все страницы одного поиска идут в одном режиме. Пагинация keyset'ная
+    по (оценка, id).
+    """
+    mode, after = "fts", None
+    if cursor:
+        mode, c_score, c_id = parse_search_cursor(cursor)
+        after = (c_score, c_id)
+
+    rows: list = []
+    if mode == "fts":
+        query_text = tsquery_text(q)
+        if query_text is not None:
+            tsquery = func.to_tsquery("simple", query_text)
+            document = Game.title_tsv.op("||")(CollectionItem.note_tsv)
+            score = _score(func.ts_rank_cd(document, tsquery))
+            stmt = (
+                select(CollectionItem, score.label("score"))
+                .join(Game, Game.id == CollectionItem.game_id)
+                .where(CollectionItem.user_id == user_id, document.op("@@")(tsquery))
+            )
+            rows = await _page(db, stmt, score, limit, after)
+        if not rows and cursor is None and catalog.trigram_enabled and len(q.strip()) >= SEARCH_FUZZY_MIN_LENGTH:
+            mode = "fuzzy"
+
+    if mode == "fuzzy":
+        needle = literal(catalog.normalize(q))
+        score = _score(func.word_similarity(needle, Game.title_norm))
+        stmt = (
+            select(CollectionItem, score.label("score"))
+            .join(Game, Game.id == CollectionItem.game_id)
+            .where(CollectionItem.user_id == user_id, needle.op("<%")(Game.title_norm))
+        )
+        rows = await _page(db, stmt, score, limit, after)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_item, last_score = rows[-1]
+        next_cursor = encode_cursor([mode, last_score, last_item.id])
+    return [item for item, _ in rows], next_cursor
@@ -0,0 +1,121 @@
+from sqlalchemy import Integer, String, bindparam, cast, delete, func, insert, literal_column, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .catalog import resolve_games
+from .models import CollectionItem
+from .schemas import BatchPatch, ItemCreate, ItemUpdate
+
+table = CollectionItem.__table__
+
+
+def _game_field(name: str):
+    # Название и платформа — из каталога. У INSERT ... RETURNING SQLAlchemy не коррелирует
+    # подзапрос с вставляемой строкой, поэтому он задан текстом (имя колонки — константа).
+    return literal_column(f"(SELECT games.{name} FROM games WHERE games.id = collection_items.game_id)", String).label(name)
+
+
+# Колонки, которые возвращают RETURNING'и (note_tsv клиенту и событиям не нужна).
+ITEM_COLUMNS = [
+    *(column for column in table.c if column.name != "note_tsv"),
+    _game_field("title"),
+    _game_field("platform"),
+]
+
+# Поля, которые меняет PATCH (None в запросе — «не менять»).
+PATCH_FIELDS = ("status", "rating", "note")
+
+
+def added_payload(row) -> dict:
+    """Данные события о добавленной игре (collection.item_added и batch_applied.added)."""
+    return {"item_id": row.id, "title": row.title, "platform": row.platform, "status": row.status}
+
+
+def updated_payload(row) -> dict:
+    """Данные события об изменённой игре; row — строка UPDATE ... RETURNING с prev_status/prev_rating."""
+    return {
+        "item_id": row.id,
+        "platform": row.platform,
+        "status": row.status,
+        "rating": row.rating,
+        "prev_status": row.prev_status,
+        "prev_rating": row.prev_rating,
+    }
+
+
+def deleted_payload(row) -> dict:
+    """Данные события об удалённой игре (по ним stats_service вычитает её из агрегатов)."""
+    return {"item_id": row.id, "platform": row.platform, "status": row.status, "rating": row.rating}
+
+
+async def insert_items(db: AsyncSession, user_id: int, items: list[ItemCreate]) -> list:
+    """INSERT ... RETURNING: добавленные строки в порядке items (название и платформа — из общего каталога)."""
+    games = await db.run_sync(resolve_games, [(i.title, i.platform) for i in items])
+    rows = [{"user_id": user_id, "status": "planned", "game_id": game.id} for game in games]
+    result = await db.execute(insert(table).returning(*ITEM_COLUMNS, sort_by_parameter_order=True), rows)
+    return list(result.all())
+
+
+def _locked_prev(user_id: int, *criteria):
+    """Подзапрос с прежними status/rating строк пользователя, заблокированных до конца транзакции.
+
+    FOR UPDATE: параллельные изменения одной игры не прочитают одно и то же «предыдущее»
+    состояние — по нему stats_service пересчитывает агрегаты.
+    """
+    return (
+        select(table.c.id, table.c.status, table.c.rating)
+        .where(table.c.user_id == user_id, *criteria)
+        .order_by(table.c.id)
+        .with_for_update()
+        .subquery("prev")
+    )
+
+
+async def update_item_returning(db: AsyncSession, user_id: int, item_id: int, data: ItemUpdate):
+    """Один UPDATE ... FROM ... RETURNING: изменённая строка с prev_status/prev_rating или None.
+
+    Строка, не принадлежащая пользователю, не попадает в prev — и не меняется.
+    """
+    prev = _locked_prev(user_id, table.c.id == item_id)
+    values = {name: getattr(data, name) for name in PATCH_FIELDS if getattr(data, name) is not None}
+    stmt = (
+        update(table)
+        .where(table.c.id == prev.c.id)
+        # Пустой PATCH ничего не меняет, но всё равно возвращает строку и порождает событие.
+        .values(values or {"status": table.c.status})
+        .returning(*ITEM_COLUMNS, prev.c.status.label("prev_status"), prev.c.rating.label("prev_rating"))
+    )
+    return (await db.execute(stmt)).first()
+
+
+async def update_items_returning(db: AsyncSession, user_id: int, patches: list[BatchPatch]) -> list:
+    """Применяет все PATCH одним UPDATE ... FROM unnest(...) ... RETURNING.
+
+    Значения передаются массивами по полям; COALESCE оставляет поле как есть,
+    если в операции оно не задано. Возвращает только строки пользователя.
+    """
+    ids = [p.id for p in patches]
+    data = select(
+        func.unnest(cast(bindparam("ids", ids, type_=ARRAY(Integer)), ARRAY(Integer))).label("id"),
+        func.unnest(cast(bindparam("statuses", [p.status for p in patches], type_=ARRAY(String)), ARRAY(String))).label("status"),
+        func.unnest(cast(bindparam("ratings", [p.rating for p in patches], type_=ARRAY(Integer)), ARRAY(Integer))).label("rating"),
+        func.unnest(cast(bindparam("notes", [p.note for p in patches], type_=ARRAY(String)), ARRAY(String))).label("note"),
+    ).subquery("data")
+    prev = _locked_prev(user_id, table.c.id.in_(ids))
+    stmt = (
+        update(table)
+        .where(table.c.id == prev.c.id, table.c.id == data.c.id)
+        .values({name: func.coalesce(data.c[name], table.c[name]) for name in PATCH_FIELDS})
+        .returning(*ITEM_COLUMNS, prev.c.status.label("prev_status"), prev.c.rating.label("prev_rating"))
+    )
+    return list((await db.execute(stmt)).all())
+
+
+async def delete_items_returning(db: AsyncSession, user_id: int, ids: list[int]) -> list:
+    """DELETE ... WHERE user_id AND id IN (...) RETURNING: удалённые строки пользователя."""
+    stmt = (
+        delete(table)
+        .where(table.c.user_id == user_id, table.c.id.in_(ids))
+        .returning(table.c.id, _game_field("platform"), table.c.status, table.c.rating)
+    )
+    return list((await db.execute(stmt)).all())
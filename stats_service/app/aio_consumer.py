@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import os
+import time
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractQueue
+
+from .db import session_scope
+from .ingest import WriteResult, write_events
+from .metrics import CONSUMER_PREFETCH_GAUGE, CONSUMER_QUEUE_BACKLOG
+from .mq_consumer import (
+    BIND_KEY,
+    CONSUMER_BATCH_SIZE,
+    CONSUMER_FLUSH_MS,
+    CONSUMER_PREFETCH,
+    CONSUMER_ROUTING,
+    EXCHANGE,
+    HASH_EXCHANGE,
+    QUEUE,
+    message_links,
+    parse_batch,
+    partition_queue,
+    record_batch,
+    record_consume_spans,
+    republish_target,
+)
+from .retry import DLQ, REQUEUE_EXCHANGE, STATS_RETRY_DELAYS_MS, retry_queue, retry_queue_arguments
+from .tracing import tracer
+
+RABBITMQ_URL = os.getenv("RABBITMQ_URL", "")
+
+# Сколько пачек одного процесса пишутся в БД одновременно. Сообщения раскладываются
+# по «полосам» по user_id, поэтому события одного пользователя всё равно пишутся по порядку.
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", "4"))
+# Границы, в которых prefetch подстраивается под задержку записи и длину очереди.
+CONSUMER_PREFETCH_MIN = int(os.getenv("CONSUMER_PREFETCH_MIN", str(max(1, CONSUMER_BATCH_SIZE // 4))))
+CONSUMER_PREFETCH_MAX = int(os.getenv("CONSUMER_PREFETCH_MAX", str(CONSUMER_BATCH_SIZE * CONSUMER_CONCURRENCY * 2)))
+# Целевое время записи пачки: выше — prefetch уменьшается (БД не успевает), ниже — может расти.
+CONSUMER_TARGET_FLUSH_MS = float(os.getenv("CONSUMER_TARGET_FLUSH_MS", "200"))
+# Как часто пересчитывать prefetch (секунды).
+CONSUMER_ADAPT_INTERVAL = float(os.getenv("CONSUMER_ADAPT_INTERVAL", "2"))
+# Пауза перед повторной попыткой, если запись пачки в БД не удалась.
+CONSUMER_RETRY_DELAY = float(os.getenv("CONSUMER_RETRY_DELAY", "3"))
+
+
+async def declare_topology_async(
+    channel: AbstractChannel, worker: int = 0, drain: list[str] | tuple = ()
+) -> list[AbstractQueue]:
+    """То же, что mq_consumer.declare_topology, для aio-pika."""
+    exchange = await channel.declare_exchange(EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+    shared = await channel.declare_queue(QUEUE, durable=True)
+    requeue = await channel.declare_exchange(REQUEUE_EXCHANGE, aio_pika.ExchangeType.TOPIC, durable=True)
+    for delay in sorted(set(STATS_RETRY_DELAYS_MS)):
+        name = retry_queue(delay)
+        retry_exchange = await channel.declare_exchange(name, aio_pika.ExchangeType.FANOUT, durable=True)
+        retry = await channel.declare_queue(name, durable=True, arguments=retry_queue_arguments(delay))
+        await retry.bind(retry_exchange)
+    await channel.declare_queue(DLQ, durable=True)
+
+    if CONSUMER_ROUTING != "hash":
+        await shared.bind(exchange, routing_key=BIND_KEY)
+        await shared.bind(requeue, routing_key=BIND_KEY)
+        return [shared]
+
+    hash_exchange = await channel.declare_exchange(
+        HASH_EXCHANGE, "x-consistent-hash", durable=True, arguments={"hash-header": "user_id"}
+    )
+    await hash_exchange.bind(exchange, routing_key=BIND_KEY)
+    await hash_exchange.bind(requeue, routing_key=BIND_KEY)
+    queue = await channel.declare_queue(partition_queue(worker), durable=True)
+    # Для consistent-hash exchange routing key привязки — вес раздела.
+    await queue.bind(hash_exchange, routing_key="1")
+    if worker != 0:
+        return [queue]
+    # Общая очередь больше не получает новых событий; worker 0 дочитывает то, что в ней осталось.
+    await shared.unbind(exchange, routing_key=BIND_KEY)
+    await shared.unbind(requeue, routing_key=BIND_KEY)
+    return [queue, shared] + [await channel.declare_queue(name, durable=True) for name in drain]
+
+
+class AsyncBatchingConsumer:
+    """asyncio-consumer: пачки пишутся в БД параллельно, prefetch подстраивается под нагрузку.
+
+    Доставки раскладываются по CONSUMER_CONCURRENCY полосам (по заголовку user_id);
+    каждая полоса копит пачку (CONSUMER_BATCH_SIZE / CONSUMER_FLUSH_MS) и пишет её,
+    пока остальные полосы пишут свои. Число неподтверждённых сообщений ограничено
+    prefetch'ем, поэтому когда БД замедляется, брокер сам перестаёт присылать новые,
+    а adapt_prefetch дополнительно уменьшает окно.
+
+    Prefetch задаётся на канал (global): такой лимит брокер меняет на лету для уже
+    зарегистрированных подписок, а лимит на подписку действовал бы только на новые.
+    """
+
+    def __init__(self, channel: AbstractChannel, lanes: int = CONSUMER_CONCURRENCY):
+        self.channel = channel
+        self.prefetch = CONSUMER_PREFETCH
+        self._lanes: list[asyncio.Queue] = [asyncio.Queue() for _ in range(max(1, lanes))]
+        self._tasks: list[asyncio.Task] = []
+        self._flush_seconds: list[float] = []
+        self._rr = 0
+
+    @property
+    def tasks(self) -> list[asyncio.Task]:
+        """Задачи полос — run_async_consumer_forever следит, чтобы ни одна не завершилась раньше времени."""
+        return list(self._tasks)
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._run_lane(lane)) for lane in self._lanes]
+        CONSUMER_PREFETCH_GAUGE.set(self.prefetch)
+
+    async def on_message(self, message: AbstractIncomingMessage) -> None:
+        """Callback aio-pika: только кладёт доставку в полосу её пользователя."""
+        user_id = (message.headers or {}).get("user_id")
+        if user_id is not None:
+            lane = hash(str(user_id)) % len(self._lanes)
+        else:
+            lane = self._rr % len(self._lanes)
+            self._rr += 1
+        self._lanes[lane].put_nowait((message, time.time_ns()))
+
+    async def drain(self) -> None:
+        """Дописывает накопленные пачки и останавливает полосы (после отмены подписки)."""
+        for lane in self._lanes:
+            lane.put_nowait(None)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def abort(self) -> None:
+        """Останавливает полосы без записи: неподтверждённые сообщения брокер вернёт после закрытия соединения."""
+        for task in self._tasks:
+            task.cancel()
+
+    async def _republish_exchanges(self) -> dict:
+        """Exchange'и переопубликации по имени из retry.next_hop: очереди задержки и DLQ (default exchange)."""
+        exchanges = {"": self.channel.default_exchange}
+        for delay in sorted(set(STATS_RETRY_DELAYS_MS)):
+            name = retry_queue(delay)
+            exchanges[name] = await self.channel.get_exchange(name)
+        return exchanges
+
+    async def _run_lane(self, lane: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        # Получаем один раз на полосу, а не на каждое переопубликованное сообщение.
+        exchanges = await self._republish_exchanges()
+        while True:
+            item = await lane.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + CONSUMER_FLUSH_MS / 1000
+            stopping = False
+            while len(batch) < CONSUMER_BATCH_SIZE:
+                if lane.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(lane.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = lane.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                await self._flush(batch, exchanges)
+            except Exception:
+                # Переопубликация или ack не прошли (обычно канал закрылся): сообщения пачки
+                # остались неподтверждёнными и вернутся после переподключения. Полоса продолжает работу.
+                logging.exception("Failed to republish or ack batch of %s messages", len(batch))
+            if stopping:
+                return
+
+    async def _flush(self, batch: list, exchanges: dict) -> None:
+        """Пишет пачку в event_logs и подтверждает каждое её сообщение."""
+        flush_started = time.perf_counter()
+        events, rejected = parse_batch(
+            [(m.routing_key or "", m.body, m.message_id, m.timestamp) for m, _received in batch]
+        )
+        meta = [(m.routing_key or "", m.headers, received) for m, received in batch]
+
+        started = time.perf_counter()
+        result = WriteResult(0)
+        try:
+            with tracer.start_as_current_span(
+                "stats.write_batch",
+                links=message_links(meta),
+                attributes={"messaging.batch.message_count": len(batch)},
+            ) as batch_span:
+                if events:
+                    async with session_scope() as db:
+                        result = await db.run_sync(write_events, events)
+        except Exception:
+            # БД недоступна (ошибки отдельных событий write_events возвращает в result.failed):
+            # возвращаем пачку брокеру и даём БД время прийти в себя.
+            logging.exception("Failed to write batch of %s events, requeueing", len(batch))
+            for message, _received in batch:
+                await message.nack(requeue=True)
+            await asyncio.sleep(CONSUMER_RETRY_DELAY)
+            return
+        elapsed = time.perf_counter() - started
+        record_consume_spans(meta, batch_span)
+
+        # Канал открыт с publisher confirms: publish возвращается после подтверждения брокером.
+        for index, error in rejected:
+            await self._republish(batch[index][0], error, exchanges, permanent=True)
+        for event, error in result.failed:
+            await self._republish(batch[event.delivery][0], error, exchanges)
+        for message, _received in batch:
+            await message.ack()
+        self._flush_seconds.append(elapsed)
+        record_batch(
+            len(batch), result.written, len(rejected), elapsed, time.perf_counter() - flush_started, len(result.failed)
+        )
+
+    async def _republish(
+        self, message: AbstractIncomingMessage, error: str, exchanges: dict, permanent: bool = False
+    ) -> None:
+        """Отправляет сообщение в очередь задержки или DLQ (см. retry.next_hop)."""
+        exchange, routing_key, headers = republish_target(message.routing_key or "", message.headers, error, permanent)
+        await exchanges[exchange].publish(
+            aio_pika.Message(
+                message.body,
+                headers=headers,
+                content_type=message.content_type,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                message_id=message.message_id,
+                timestamp=message.timestamp,
+            ),
+            routing_key=routing_key,
+        )
+
+    async def adapt_prefetch(self, queues: list[str]) -> None:
+        """Периодически пересчитывает prefetch (AIMD).
+
+        Запись пачки медленнее CONSUMER_TARGET_FLUSH_MS — prefetch умножается на 0.7;
+        быстрее, а в очереди ждёт больше, чем помещается в окно, — растёт на пачку.
+        """
+        while True:
+            await asyncio.sleep(CONSUMER_ADAPT_INTERVAL)
+            try:
+                await self._adapt_once(queues)
+            except Exception:
+                # Например, канал переоткрывается после обрыва: пересчитаем на следующем шаге.
+                logging.exception("Failed to adapt consumer prefetch")
+
+    async def _adapt_once(self, queues: list[str]) -> None:
+        samples, self._flush_seconds = self._flush_seconds, []
+
+        backlog = 0
+        for name in queues:
+            declared = await self.channel.declare_queue(name, passive=True)
+            count = declared.declaration_result.message_count or 0
+            CONSUMER_QUEUE_BACKLOG.labels(name).set(count)
+            backlog += count
+
+        # DLQ в расчёт prefetch не входит, только в метрику.
+        dlq = await self.channel.declare_queue(DLQ, passive=True)
+        CONSUMER_QUEUE_BACKLOG.labels(DLQ).set(dlq.declaration_result.message_count or 0)
+
+        prefetch = self.prefetch
+        avg_ms = sum(samples) / len(samples) * 1000 if samples else 0.0
+        if avg_ms > CONSUMER_TARGET_FLUSH_MS:
+            prefetch = max(CONSUMER_PREFETCH_MIN, int(prefetch * 0.7))
+        elif backlog > prefetch:
+            prefetch = min(CONSUMER_PREFETCH_MAX, prefetch + CONSUMER_BATCH_SIZE)
+
+        if prefetch != self.prefetch:
+            await self.channel.set_qos(prefetch_count=prefetch, global_=True)
+            logging.info(
+                "Consumer prefetch %s -> %s (avg flush %.1f ms, backlog %s)", self.prefetch, prefetch, avg_ms, backlog
+            )
+            self.prefetch = prefetch
+            CONSUMER_PREFETCH_GAUGE.set(prefetch)
+
+
+async def run_async_consumer_forever(
+    worker: int = 0, workers: int = 1, stop: asyncio.Event | None = None, drain: list[str] | tuple = ()
+) -> None:
+    """asyncio-вариант mq_consumer.run_consumer_forever (CONSUMER_MODE=async).
+
+    Соединение восстанавливается aio-pika (connect_robust). После установки stop
+    подписки отменяются, накопленные пачки дописываются, и функция возвращается.
+    Если полоса или adapt_prefetch завершились сами (ошибка), соединение закрывается
+    (неподтверждённые сообщения брокер отдаст заново) и consumer запускается заново.
+    """
+    stop = stop or asyncio.Event()
+    while not stop.is_set():
+        connection = consumer = adapt = stopped = None
+        try:
+            connection = await aio_pika.connect_robust(RABBITMQ_URL)
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=CONSUMER_PREFETCH, global_=True)
+            queues = await declare_topology_async(channel, worker, drain)
+
+            consumer = AsyncBatchingConsumer(channel)
+            consumer.start()
+            tags = [(queue, await queue.consume(consumer.on_message)) for queue in queues]
+            adapt = asyncio.create_task(consumer.adapt_prefetch([queue.name for queue in queues]))
+            logging.info(
+                "Async stats consumer %s/%s started (queues=%s, batch=%s, lanes=%s, prefetch=%s..%s)",
+                worker + 1,
+                workers,
+                ",".join(queue.name for queue in queues),
+                CONSUMER_BATCH_SIZE,
+                CONSUMER_CONCURRENCY,
+                CONSUMER_PREFETCH_MIN,
+                CONSUMER_PREFETCH_MAX,
+            )
+
+            stopped = asyncio.create_task(stop.wait())
+            done, _ = await asyncio.wait([stopped, adapt, *consumer.tasks], return_when=asyncio.FIRST_COMPLETED)
+            if stopped not in done:
+                failed = done.pop()
+                error = None if failed.cancelled() else failed.exception()
+                raise RuntimeError(f"Consumer task {failed.get_coro().__qualname__} exited unexpectedly") from error
+            adapt.cancel()
+            for queue, tag in tags:
+                await queue.cancel(tag)
+            await consumer.drain()
+            consumer = None
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Async consumer crashed, retry in 3s...")
+            try:
+                await asyncio.wait_for(stop.wait(), 3)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            for task in (stopped, adapt):
+                if task is not None:
+                    task.cancel()
+            if consumer is not None:
+                consumer.abort()
+            if connection is not None:
+                try:
+                    await connection.close()
+                except Exception:
+                    logging.exception("Failed to close RabbitMQ connection")
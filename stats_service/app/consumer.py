@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
+
+# Сколько процессов читают события (и сколько разделов при CONSUMER_ROUTING=hash).
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "2"))
+# Порт, на котором supervisor отдаёт /metrics всех worker'ов (0 — не отдавать).
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "9100"))
+
+SERVICE_NAME = os.getenv("SERVICE_NAME", "stats_consumer")
+
+
+def _setup_process_logging() -> None:
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s",
+    )
+
+
+def run_worker(index: int, workers: int, drain: list[str] | tuple = ()) -> None:
+    """Точка входа процесса-worker'а: читает свою очередь (и разделы drain) до SIGTERM."""
+    _setup_process_logging()
+
+    from .mq_consumer import CONSUMER_MODE, run_consumer_forever
+    from .tracing import setup_tracing, shutdown_tracing
+
+    setup_tracing(SERVICE_NAME)
+    try:
+        if CONSUMER_MODE == "async":
+            asyncio.run(_run_async_worker(index, workers, drain))
+            return
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        run_consumer_forever(worker=index, workers=workers, stop=stop, drain=drain)
+    finally:
+        shutdown_tracing()
+
+
+async def _run_async_worker(index: int, workers: int, drain: list[str] | tuple) -> None:
+    from .aio_consumer import run_async_consumer_forever
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    await run_async_consumer_forever(worker=index, workers=workers, stop=stop, drain=drain)
+
+
+def _start_worker(ctx, index: int, workers: int, drain: list[str]):
+    # Лишние разделы дочитывает worker 0.
+    drain = drain if index == 0 else []
+    proc = ctx.Process(target=run_worker, args=(index, workers, drain), name=f"consumer-{index}")
+    proc.start()
+    return proc
+
+
+def _serve_metrics(multiproc_dir: str) -> None:
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    start_http_server(CONSUMER_METRICS_PORT, registry=registry)
+
+
+def _reconcile_partitions(logger, stopping: threading.Event) -> list[str]:
+    """Сверяет разделы hash-маршрутизации с CONSUMER_WORKERS; возвращает разделы, которые нужно дочитать.
+
+    Пока RabbitMQ недоступен, повторяет попытку: worker'ы без него всё равно не работают.
+    """
+    from .mq_consumer import CONSUMER_ROUTING, reconcile_partitions
+
+    if CONSUMER_ROUTING != "hash":
+        return []
+    while not stopping.is_set():
+        try:
+            drain = reconcile_partitions(CONSUMER_WORKERS)
+        except Exception:
+            logger.exception("Failed to reconcile hash partitions, retry in 3s...")
+            stopping.wait(3.0)
+            continue
+        if drain:
+            logger.warning("Unbound stale partitions %s; worker 0 drains them", ",".join(drain))
+        return drain
+    return []
+
+
+def main() -> None:
+    """Supervisor: запускает CONSUMER_WORKERS процессов-worker'ов и перезапускает упавшие.
+
+    У каждого worker'а своё соединение и канал RabbitMQ. Веб-приложение при этом
+    запускается с STATS_CONSUMER_ENABLED=0.
+    """
+    _setup_process_logging()
+    logger = logging.getLogger(SERVICE_NAME)
+
+    # Метрики worker'ов собираются через общий каталог; задаём его до их запуска.
+    multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="stats-consumer-metrics-"))
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+    from .schema import ensure_schema
+
+    ensure_schema(logger)
+    if CONSUMER_METRICS_PORT:
+        _serve_metrics(multiproc_dir)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    drain = _reconcile_partitions(logger, stopping)
+
+    # spawn: worker'ы не наследуют соединения и потоки supervisor'а.
+    ctx = multiprocessing.get_context("spawn")
+    procs = [_start_worker(ctx, i, CONSUMER_WORKERS, drain) for i in range(CONSUMER_WORKERS)]
+    logger.info("Started %s consumer workers", CONSUMER_WORKERS)
+
+    while not stopping.wait(1.0):
+        for i, proc in enumerate(procs):
+            if not proc.is_alive():
+                logger.warning("Consumer worker %s exited with code %s, restarting", i, proc.exitcode)
+                if multiproc_dir:
+                    from prometheus_client import multiprocess
+
+                    multiprocess.mark_process_dead(proc.pid)
+                procs[i] = _start_worker(ctx, i, CONSUMER_WORKERS, drain)
+
+    logger.info("Stopping consumer workers...")
+    for proc in procs:
+        proc.terminate()
+    deadline = time.monotonic() + 10
+    for proc in procs:
+        proc.join(timeout=max(0.0, deadline - time.monotonic()))
+        if proc.is_alive():
+            proc.kill()
+
+
+if __name__ == "__main__":
+    # Отдельный процесс consumer'а: `python -m app.consumer`.
+    main()
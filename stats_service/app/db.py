@@ -1,15 +1,87 @@
+import itertools
+import logging
 import os
-from typing import Generator
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, AsyncIterator
 
-from sqlalchemy import create_engine
+from sqlalchemy import String, bindparam, create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from .metrics import DB_READ_SESSIONS, observe_pool
+from .tracing import instrument_engine
 
 # URL подключения к БД берётся из переменной окружения DATABASE_URL.
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Как HTTP-обработчики работают с БД:
+# - async: asyncpg + AsyncSession, запрос не занимает поток из пула Starlette;
+# - sync:  psycopg2, каждый вызов БД уходит в пул потоков (прежнее поведение, для сравнения).
+DB_MODE = os.getenv("DB_MODE", "async").lower()
+
+# Реплики для чтения: DATABASE_READ_URLS — через запятую, или одна DATABASE_READ_URL.
+# Без них все запросы идут в DATABASE_URL.
+DATABASE_READ_URLS = [
+    url.strip()
+    for url in (os.getenv("DATABASE_READ_URLS") or os.getenv("DATABASE_READ_URL", "")).split(",")
+    if url.strip()
+]
+# Сколько секунд браузер хранит cookie с позицией WAL своей последней записи (см. ReadConsistency).
+# Токен лишь запрещает реплики, которые эту позицию ещё не воспроизвели, поэтому срок можно брать с запасом.
+DB_READ_STICKY_SECONDS = float(os.getenv("DB_READ_STICKY_SECONDS", "60"))
+# На сколько секунд исключать реплику, к которой не удалось подключиться.
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "10"))
+
+logger = logging.getLogger(__name__)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, который отдаёт в /metrics время ожидания соединения и заполненность пула."""
+
+    metrics_name = "sync"
+
+    def _do_get(self):
+        started = time.perf_counter()
+        conn = super()._do_get()
+        observe_pool(self.metrics_name, self, time.perf_counter() - started)
+        return conn
+
+    def _do_return_conn(self, record) -> None:
+        super()._do_return_conn(record)
+        observe_pool(self.metrics_name, self)
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+
+def _async_url(url: str) -> str:
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+
+# Синхронный engine нужен всегда: создание таблиц при старте и фоновые потоки.
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, poolclass=TimedQueuePool)
+instrument_engine(engine)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+# Сессии HTTP-запросов не «протухают» после commit: иначе чтение атрибута
+# после commit ушло бы в БД синхронно прямо из event loop.
+_RequestSessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
+
+async_engine = None
+AsyncSessionLocal = None
+if DB_MODE == "async":
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True, poolclass=TimedAsyncQueuePool)
+    instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 
 class Base(DeclarativeBase):
     """Базовый класс декларативных моделей SQLAlchemy."""
@@ -17,10 +89,283 @@ class Base(DeclarativeBase):
     pass
 
 
-def get_db() -> Generator[Session, None, None]:
+class SyncSessionAdapter:
+    """Синхронная Session с интерфейсом AsyncSession (режим DB_MODE=sync).
+
+    Каждый вызов, который ходит в БД, выполняется в пуле потоков, поэтому
+    одни и те же `async def` обработчики работают в обоих режимах.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    def add(self, instance) -> None:
+        self.sync_session.add(instance)
+
+    def add_all(self, instances) -> None:
+        self.sync_session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def delete(self, instance) -> None:
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self) -> None:
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def refresh(self, instance) -> None:
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def commit(self) -> None:
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self) -> None:
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self) -> None:
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        """Как AsyncSession.run_sync: вызывает fn(session, ...) с синхронной сессией."""
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def connection(self):
+        return await run_in_threadpool(self.sync_session.connection)
+
+
+class Replica:
+    """Реплика для чтения: свой пул соединений и момент, до которого она исключена."""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.down_until = 0.0
+        self.engine = None
+        self.async_engine = None
+        # Пул с собственным именем в метриках db_pool_*.
+        pool_class = TimedAsyncQueuePool if DB_MODE == "async" else TimedQueuePool
+        pool_class = type(f"{name}Pool", (pool_class,), {"metrics_name": name})
+        if DB_MODE == "async":
+            self.async_engine = create_async_engine(_async_url(url), pool_pre_ping=True, poolclass=pool_class)
+            instrument_engine(self.async_engine.sync_engine)
+            self.sessionmaker = async_sessionmaker(bind=self.async_engine, autoflush=False, expire_on_commit=False)
+        else:
+            self.engine = create_engine(url, pool_pre_ping=True, poolclass=pool_class)
+            instrument_engine(self.engine)
+            self.sessionmaker = sessionmaker(bind=self.engine, autoflush=False, expire_on_commit=False)
+
+    def session(self):
+        db = self.sessionmaker()
+        db_session = db if DB_MODE == "async" else SyncSessionAdapter(db)
+        db_session.sync_session.info["replica"] = self.name
+        return db_session
+
+    async def dispose(self) -> None:
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        if self.engine is not None:
+            self.engine.dispose()
+
+
+replicas = [Replica(f"replica{n}", url) for n, url in enumerate(DATABASE_READ_URLS)]
+_next_replica = itertools.count()
+
+
+# Токен read-your-writes: позиция WAL primary после записи клиента (pg_lsn, «16/B374D848»).
+# Ответ на запрос с записью отдаёт его в заголовке и cookie; клиент возвращает заголовком
+# (или браузер — cookie), и такой запрос читает только с реплик, уже воспроизведших эту позицию.
+DB_POSITION_HEADER = "X-DB-Position"
+DB_POSITION_COOKIE = "db_position"
+_LSN_RE = re.compile(r"[0-9A-F]{1,8}/[0-9A-F]{1,8}")
+
+
+class ReadConsistency:
+    """Read-your-writes одного HTTP-запроса.
+
+    after — позиция WAL из токена клиента, wrote — запрос сам закоммитил запись в primary.
+    Состояние не зависит от процесса: всё, что нужно, приходит с запросом.
+    Объект изменяемый, потому что ContextVar копируется в задачу обработчика и в потоки
+    пула, а флаг wrote должен дойти до middleware.
+    """
+
+    def __init__(self, after: str | None):
+        self.after = after
+        self.wrote = False
+
+
+_consistency: ContextVar[ReadConsistency | None] = ContextVar("db_read_consistency", default=None)
+
+
+def bind_consistency(token: str | None) -> ReadConsistency | None:
+    """Начинает read-your-writes для запроса (из middleware); без реплик ничего не делает.
+
+    token — значение заголовка DB_POSITION_HEADER или cookie DB_POSITION_COOKIE;
+    испорченный токен игнорируется.
+    """
+    if not replicas:
+        return None
+    token = (token or "").strip().upper()
+    state = ReadConsistency(token if _LSN_RE.fullmatch(token) else None)
+    _consistency.set(state)
+    return state
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_write(session: Session) -> None:
+    # Срабатывает и для AsyncSession (её sync_session); у фоновых задач запроса нет.
+    state = _consistency.get()
+    if state is not None and "replica" not in session.info:
+        state.wrote = True
+
+
+async def issue_consistency_token(state: ReadConsistency | None, response) -> None:
+    """Если запрос писал в primary, отдаёт клиенту токен с позицией WAL после его записи.
+
+    Позиция читается после commit, поэтому реплика, дошедшая до неё, видит запись.
+    Ошибка здесь не должна превращать успешную запись в ошибку — только в предупреждение.
+    """
+    if state is None or not state.wrote:
+        return
+    try:
+        async with session_scope() as db:
+            position = await db.scalar(text("SELECT pg_current_wal_lsn()::text"))
+    except Exception:
+        logger.warning("Failed to read WAL position for read-your-writes token", exc_info=True)
+        return
+    response.headers[DB_POSITION_HEADER] = position
+    response.set_cookie(
+        DB_POSITION_COOKIE, position, max_age=int(DB_READ_STICKY_SECONDS), httponly=True, samesite="lax"
+    )
+
+
+def is_replica(db) -> bool:
+    """Открыта ли сессия на реплике (данные могут отставать от primary)."""
+    return "replica" in db.sync_session.info
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """Открывает сессию для текущего режима DB_MODE и гарантирует её закрытие."""
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+
+    db = SyncSessionAdapter(_RequestSessionLocal())
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """FastAPI dependency: отдаёт сессию SQLAlchemy и гарантирует её закрытие."""
-    db = SessionLocal()
+    async with session_scope() as db:
+        yield db
+
+
+# Дошла ли реплика до позиции after. Параметр типизирован строкой: иначе asyncpg
+# выводит для него тип pg_lsn и не принимает str.
+_REPLAYED_UP_TO = text("SELECT coalesce(pg_last_wal_replay_lsn() >= CAST(:after AS pg_lsn), true)").bindparams(
+    bindparam("after", type_=String)
+)
+
+
+async def _open_replica_session(after: str | None):
+    """(сессия на первой подходящей реплике по кругу или None, отстали ли реплики от after).
+
+    Соединение берётся сразу (pool_pre_ping проверяет его): если реплика не
+    отвечает, она исключается на DB_REPLICA_RETRY_SECONDS и пробуется следующая.
+    С after реплика подходит, только если уже воспроизвела WAL до этой позиции
+    (pg_last_wal_replay_lsn; NULL — сервер не в recovery, то есть сам primary).
+    """
+    start = next(_next_replica)
+    now = time.monotonic()
+    behind = False
+    for i in range(len(replicas)):
+        replica = replicas[(start + i) % len(replicas)]
+        if replica.down_until > now:
+            continue
+        db = replica.session()
+        try:
+            await db.connection()
+            if after is None or await db.scalar(_REPLAYED_UP_TO, {"after": after}):
+                return db, behind
+        except Exception:
+            await db.close()
+            replica.down_until = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+            logger.warning("Read replica %s is unavailable, excluded for %ss", replica.name, DB_REPLICA_RETRY_SECONDS)
+            continue
+        await db.close()
+        behind = True
+    return None, behind
+
+
+@asynccontextmanager
+async def read_session_scope() -> AsyncIterator[AsyncSession]:
+    """Сессия только для чтения: реплика, которая видит записи клиента (см. ReadConsistency), иначе primary."""
+    db = None
+    if replicas:
+        state = _consistency.get()
+        if state is not None and state.wrote:
+            # Этот же запрос уже записал в primary, позиции его записи у клиента ещё нет.
+            DB_READ_SESSIONS.labels("primary_sticky").inc()
+        else:
+            db, behind = await _open_replica_session(state.after if state is not None else None)
+            if db is not None:
+                DB_READ_SESSIONS.labels("replica").inc()
+            else:
+                DB_READ_SESSIONS.labels("primary_sticky" if behind else "primary_failover").inc()
+    if db is None:
+        async with session_scope() as db:
+            yield db
+        return
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
+
+
+async def get_read_db() -> AsyncGenerator[AsyncSession, None]:
+    """FastAPI dependency для обработчиков, которые только читают (см. read_session_scope)."""
+    async with read_session_scope() as db:
+        yield db
+
+
+async def stream_partitions(stmt, size: int) -> AsyncIterator[list]:
+    """Читает результат запроса серверным курсором пачками по size строк.
+
+    Открывает собственную сессию (на реплике, если она есть), так как
+    используется при стриминге ответа — уже после закрытия зависимости get_db.
+    """
+    stmt = stmt.execution_options(yield_per=size)
+    async with read_session_scope() as db:
+        if AsyncSessionLocal is not None:
+            result = await db.stream(stmt)
+            async for partition in result.partitions():
+                yield partition
+            return
+
+        def _sync_partitions():
+            yield from db.sync_session.execute(stmt).partitions()
+
+        async for partition in iterate_in_threadpool(_sync_partitions()):
+            yield partition
+
+
+async def dispose_engines() -> None:
+    """Закрывает пулы соединений, в том числе реплик (вызывается при остановке приложения)."""
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+    for replica in replicas:
+        await replica.dispose()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import logging
+import os
+
+import pika
+
+from .retry import DLQ, ERROR_HEADER, FAILED_AT_HEADER, REQUEUE_EXCHANGE, ROUTING_KEY_HEADER, replay_headers
+
+RABBITMQ_URL = os.getenv("RABBITMQ_URL", "")
+
+
+def _text(value) -> str | None:
+    return value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+
+
+def _fetch(ch, limit: int):
+    """Забирает до limit сообщений DLQ без ack (они вернутся в очередь, если их не подтвердить)."""
+    for _ in range(limit):
+        method, props, body = ch.basic_get(queue=DLQ, auto_ack=False)
+        if method is None:
+            return
+        yield method, props, body
+
+
+def list_messages(ch, limit: int, event_type: str | None = None) -> list[dict]:
+    """Описание первых limit сообщений DLQ; очередь при этом не меняется."""
+    result = []
+    last_tag = None
+    for method, props, body in _fetch(ch, limit):
+        last_tag = method.delivery_tag
+        headers = props.headers or {}
+        routing_key = _text(headers.get(ROUTING_KEY_HEADER))
+        if event_type and routing_key != event_type:
+            continue
+        result.append(
+            {
+                "message_id": props.message_id,
+                "routing_key": routing_key,
+                "error": _text(headers.get(ERROR_HEADER)),
+                "failed_at": _text(headers.get(FAILED_AT_HEADER)),
+                "body": body.decode("utf-8", "replace")[:1000],
+            }
+        )
+    if last_tag is not None:
+        ch.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+    return result
+
+
+def replay_messages(ch, limit: int, event_type: str | None = None) -> int:
+    """Возвращает до limit сообщений DLQ в поток stats (через REQUEUE_EXCHANGE).
+
+    Счётчик попыток сбрасывается. Сообщения с другим event_type (если он задан)
+    остаются в DLQ. Возвращает число отправленных сообщений.
+    """
+    ch.confirm_delivery()
+    replayed = 0
+    skipped_tag = None
+    for method, props, body in _fetch(ch, limit):
+        routing_key, headers = replay_headers(props.headers)
+        if not routing_key or (event_type and routing_key != event_type):
+            skipped_tag = method.delivery_tag
+            continue
+        # В режиме confirm basic_publish возвращается после подтверждения — только потом ack.
+        ch.basic_publish(
+            exchange=REQUEUE_EXCHANGE,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=props.content_type,
+                delivery_mode=2,
+                headers=headers,
+                message_id=props.message_id,
+                timestamp=props.timestamp,
+            ),
+        )
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    if skipped_tag is not None:
+        # Все ещё не подтверждённые к этому моменту — пропущенные сообщения.
+        ch.basic_nack(delivery_tag=skipped_tag, multiple=True, requeue=True)
+    return replayed
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.dlq", description="Просмотр и повтор сообщений stats_events.dlq")
+    parser.add_argument("command", choices=["count", "list", "replay"])
+    parser.add_argument("--limit", type=int, default=100, help="сколько сообщений просмотреть (по умолчанию 100)")
+    parser.add_argument("--event-type", help="только события с этим routing key, например collection.item_added")
+    args = parser.parse_args(argv)
+
+    conn = pika.BlockingConnection(pika.URLParameters(RABBITMQ_URL))
+    try:
+        ch = conn.channel()
+        declared = ch.queue_declare(queue=DLQ, durable=True)
+        if args.command == "count":
+            print(declared.method.message_count)
+        elif args.command == "list":
+            for item in list_messages(ch, args.limit, args.event_type):
+                print(json.dumps(item, ensure_ascii=False))
+        else:
+            replayed = replay_messages(ch, args.limit, args.event_type)
+            logging.info("Replayed %s messages from %s", replayed, DLQ)
+            print(replayed)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # Администрирование DLQ: `python -m app.dlq list --limit 20`, `python -m app.dlq replay`.
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    main()
@@ -0,0 +1,56 @@
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator
+
+from sqlalchemy import Text, cast, select
+
+from .db import stream_partitions
+from .models import EventLog
+
+# Сколько строк за раз читается из серверного курсора и отдаётся одним куском ответа.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+EXPORT_COLUMNS = ["id", "event_type", "payload_json", "created_at"]
+
+
+def event_columns():
+    """Колонки события для выдачи клиенту; payload читается текстом JSONB, без разбора в Python."""
+    return EventLog.id, EventLog.event_type, cast(EventLog.payload_json, Text).label("payload_json"), EventLog.created_at
+
+
+def event_json(row) -> str:
+    """JSON-объект события; payload вставляется как есть, без повторного разбора JSON."""
+    return '{"id":%d,"event_type":%s,"payload":%s,"created_at":%s}' % (
+        row.id,
+        json.dumps(row.event_type),
+        row.payload_json,
+        json.dumps(row.created_at.isoformat() if row.created_at else None),
+    )
+
+
+def _rows(user_id: int) -> AsyncIterator[list]:
+    """Читает события пользователя серверным курсором, пачками по EXPORT_BATCH_SIZE."""
+    stmt = select(*event_columns()).where(EventLog.user_id == user_id).order_by(EventLog.id)
+    return stream_partitions(stmt, EXPORT_BATCH_SIZE)
+
+
+async def export_ndjson(user_id: int) -> AsyncIterator[str]:
+    """Отдаёт события как NDJSON."""
+    async for partition in _rows(user_id):
+        yield "".join(event_json(row) + "\n" for row in partition)
+
+
+async def export_csv(user_id: int) -> AsyncIterator[str]:
+    """Отдаёт события как CSV с заголовком."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buf.getvalue()
+
+    async for partition in _rows(user_id):
+        buf.seek(0)
+        buf.truncate()
+        writer.writerows(partition)
+        yield buf.getvalue()
@@ -0,0 +1,386 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+
+from .metrics import CONSUMER_DUPLICATES
+from .models import EventLog, RollupState, UserStats, UserStatsBreakdown
+
+# Сколько последних event_id помнить в памяти процесса, чтобы повторные доставки
+# отбрасывались без запроса в БД (0 — только уникальный индекс в БД).
+STATS_DEDUP_CACHE_SIZE = int(os.getenv("STATS_DEDUP_CACHE_SIZE", "100000"))
+
+# Канал pg_notify: после commit пачки в нём приходят id пользователей с новыми событиями
+# (через запятую). Его слушает EventHub потоков SSE (см. live.py).
+EVENTS_CHANNEL = "stats_events"
+# Ограничение PostgreSQL на payload уведомления — 8000 байт.
+_NOTIFY_PAYLOAD_LIMIT = 7900
+
+# Строка rollup_state: момент снимка collection_items, которым засеяны user_stats* (см. schema.seed_user_stats).
+# v2 — платформы в написании каталога games: агрегаты, засеянные раньше, пересчитываются.
+STATS_SEED_STATE = "user_stats_seed_v2"
+_seed_cutoff: datetime | None = None
+_seed_cutoff_loaded = False
+
+
+@dataclass
+class IncomingEvent:
+    """Разобранное сообщение из RabbitMQ, готовое к записи в event_logs."""
+
+    event_type: str
+    user_id: int
+    payload: dict
+    # Тело сообщения: пишется в event_logs.payload_json как есть, без json.dumps
+    raw: str
+    # message_id сообщения (None у сообщений старых издателей)
+    event_id: str | None = None
+    # Время создания события издателем; None — время записи.
+    created_at: datetime | None = None
+    # Номер сообщения в пачке consumer'а (чтобы найти доставку упавшего события)
+    delivery: int | None = None
+
+
+@dataclass
+class WriteResult:
+    """Итог write_events: сколько строк записано и какие события записать не удалось."""
+
+    written: int
+    failed: list[tuple[IncomingEvent, str]] = field(default_factory=list)
+
+
+class RecentIds:
+    """Ограниченное множество недавно записанных event_id (LRU)."""
+
+    def __init__(self, max_size: int = STATS_DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, event_id: str) -> bool:
+        with self._lock:
+            if event_id not in self._ids:
+                return False
+            self._ids.move_to_end(event_id)
+            return True
+
+    def add_many(self, event_ids) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            for event_id in event_ids:
+                self._ids[event_id] = None
+                self._ids.move_to_end(event_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+
+recent_ids = RecentIds()
+
+
+def _message_time(timestamp) -> datetime | None:
+    """AMQP timestamp (секунды от эпохи у pika, datetime у aio-pika) -> naive UTC."""
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp
+    return datetime.fromtimestamp(int(timestamp), timezone.utc).replace(tzinfo=None)
+
+
+def parse_event(routing_key: str, body: bytes, message_id: str | None = None, timestamp=None) -> IncomingEvent:
+    """Разбирает тело сообщения. Бросает ValueError, если событие некорректно.
+
+    JSON разбирается один раз — для проверки и расчёта агрегатов; в БД уходит исходный текст.
+    """
+    raw = body.decode("utf-8")
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError("Event body must be a JSON object")
+
+    raw_uid = data.get("user_id")
+    if raw_uid is None:
+        raise ValueError("Missing user_id in event")
+
+    user_id = int(raw_uid)
+    if user_id <= 0:
+        raise ValueError("Invalid user_id in event")
+
+    return IncomingEvent(
+        event_type=routing_key,
+        user_id=user_id,
+        payload=data,
+        raw=raw,
+        event_id=message_id or None,
+        created_at=_message_time(timestamp),
+    )
+
+
+def _row(event: IncomingEvent, now: datetime) -> dict:
+    return {
+        "event_type": event.event_type,
+        "user_id": event.user_id,
+        "payload_json": event.raw,
+        "event_id": event.event_id,
+        "created_at": event.created_at or now,
+    }
+
+
+class _Deltas:
+    """Суммарные изменения агрегатов по пачке событий."""
+
+    def __init__(self):
+        # user_id -> [total_items, rated_items, rating_sum]
+        self.totals: dict[int, list[int]] = defaultdict(lambda: [0, 0, 0])
+        # (user_id, dimension, value) -> item_count
+        self.breakdown: dict[tuple[int, str, str], int] = defaultdict(int)
+
+    def item(self, user_id: int, sign: int, status: str | None, platform: str | None, rating) -> None:
+        """Учитывает появление (sign=+1) или исчезновение (sign=-1) игры целиком."""
+        self.totals[user_id][0] += sign
+        if status:
+            self.breakdown[(user_id, "status", status)] += sign
+        if platform:
+            self.breakdown[(user_id, "platform", platform)] += sign
+        self.rating(user_id, sign, rating)
+
+    def rating(self, user_id: int, sign: int, rating) -> None:
+        if rating is not None:
+            self.totals[user_id][1] += sign
+            self.totals[user_id][2] += sign * int(rating)
+
+    def status(self, user_id: int, old: str | None, new: str | None) -> None:
+        if old == new:
+            return
+        if old:
+            self.breakdown[(user_id, "status", old)] -= 1
+        if new:
+            self.breakdown[(user_id, "status", new)] += 1
+
+
+# Части события collection.batch_applied и соответствующие им одиночные события.
+_BATCH_PARTS = {
+    "added": "collection.item_added",
+    "updated": "collection.item_updated",
+    "deleted": "collection.item_deleted",
+}
+
+
+def _event_deltas(deltas: _Deltas, user_id: int, event_type: str, p: dict) -> None:
+    if event_type == "collection.item_added":
+        deltas.item(user_id, +1, p.get("status") or "planned", p.get("platform"), p.get("rating"))
+    elif event_type == "collection.item_deleted":
+        deltas.item(user_id, -1, p.get("status"), p.get("platform"), p.get("rating"))
+    elif event_type == "collection.items_imported":
+        status = p.get("status") or "planned"
+        for platform, count in (p.get("platforms") or {}).items():
+            count = int(count)
+            deltas.totals[user_id][0] += count
+            deltas.breakdown[(user_id, "status", status)] += count
+            deltas.breakdown[(user_id, "platform", platform)] += count
+    elif event_type == "collection.item_updated":
+        if "prev_status" in p:
+            deltas.status(user_id, p.get("prev_status"), p.get("status"))
+        if "prev_rating" in p and p.get("prev_rating") != p.get("rating"):
+            deltas.rating(user_id, -1, p.get("prev_rating"))
+            deltas.rating(user_id, +1, p.get("rating"))
+    elif event_type == "collection.batch_applied":
+        # Составное событие POST /collection/batch: списки тех же payload, что у одиночных событий.
+        for part, part_type in _BATCH_PARTS.items():
+            for item in p.get(part) or ():
+                _event_deltas(deltas, user_id, part_type, item)
+
+
+def _collect_deltas(events: list[IncomingEvent]) -> _Deltas:
+    """Переводит события коллекции в дельты агрегатов user_stats.
+
+    Для item_updated/item_deleted дельта считается по значениям из самого события
+    (prev_status/prev_rating, status/platform/rating удалённой игры), поэтому
+    consumer не читает текущее состояние и пачки можно применять в любом порядке.
+    """
+    deltas = _Deltas()
+    for e in events:
+        _event_deltas(deltas, e.user_id, e.event_type, e.payload)
+    return deltas
+
+
+def _aggregates_cutoff(db: Session) -> datetime | None:
+    """Момент снимка, которым засеяны агрегаты (None — не засевались); читается один раз на процесс."""
+    global _seed_cutoff, _seed_cutoff_loaded
+    if not _seed_cutoff_loaded:
+        _seed_cutoff = db.scalar(select(RollupState.watermark).where(RollupState.name == STATS_SEED_STATE))
+        _seed_cutoff_loaded = True
+    return _seed_cutoff
+
+
+def apply_aggregates(db: Session, events: list[IncomingEvent]) -> None:
+    """Применяет дельты пачки к user_stats/user_stats_breakdown через INSERT ... ON CONFLICT.
+
+    События, созданные до снимка collection_items, которым засеяны агрегаты,
+    уже учтены в нём и пропускаются (в event_logs они всё равно пишутся).
+    Ключи сортируются, чтобы параллельные consumer'ы брали блокировки строк
+    в одном порядке и не упирались в deadlock.
+    """
+    cutoff = _aggregates_cutoff(db)
+    if cutoff is not None:
+        events = [e for e in events if e.created_at is None or e.created_at >= cutoff]
+    deltas = _collect_deltas(events)
+    now = datetime.utcnow()
+
+    totals = [
+        {"user_id": uid, "total_items": t, "rated_items": r, "rating_sum": s, "updated_at": now}
+        for uid, (t, r, s) in sorted(deltas.totals.items())
+        if t or r or s
+    ]
+    if totals:
+        stmt = pg_insert(UserStats.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserStats.user_id],
+            set_={
+                "total_items": UserStats.total_items + stmt.excluded.total_items,
+                "rated_items": UserStats.rated_items + stmt.excluded.rated_items,
+                "rating_sum": UserStats.rating_sum + stmt.excluded.rating_sum,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        db.execute(stmt, totals)
+
+    breakdown = [
+        {"user_id": uid, "dimension": dim, "value": value[:64], "item_count": n}
+        for (uid, dim, value), n in sorted(deltas.breakdown.items())
+        if n
+    ]
+    if breakdown:
+        stmt = pg_insert(UserStatsBreakdown.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserStatsBreakdown.user_id, UserStatsBreakdown.dimension, UserStatsBreakdown.value],
+            set_={"item_count": UserStatsBreakdown.item_count + stmt.excluded.item_count},
+        )
+        db.execute(stmt, breakdown)
+
+
+def _drop_seen(events: list[IncomingEvent]) -> list[IncomingEvent]:
+    """Убирает события, уже записанные недавно или повторяющиеся внутри пачки."""
+    fresh: list[IncomingEvent] = []
+    batch_ids: set[str] = set()
+    for e in events:
+        if e.event_id is not None:
+            if e.event_id in batch_ids or e.event_id in recent_ids:
+                continue
+            batch_ids.add(e.event_id)
+        fresh.append(e)
+    if len(fresh) < len(events):
+        CONSUMER_DUPLICATES.labels("memory").inc(len(events) - len(fresh))
+    return fresh
+
+
+def _insert_new(db: Session, events: list[IncomingEvent], rows: list[dict]) -> list[IncomingEvent]:
+    """INSERT ... ON CONFLICT (event_id, created_at) DO NOTHING RETURNING: возвращает реально вставленные события."""
+    stmt = (
+        pg_insert(EventLog.__table__)
+        .on_conflict_do_nothing(index_elements=[EventLog.event_id, EventLog.created_at])
+        .returning(EventLog.event_id)
+    )
+    inserted = {r[0] for r in db.execute(stmt, rows)}
+    # У событий без event_id конфликтов не бывает — они вставлены всегда.
+    return [e for e in events if e.event_id is None or e.event_id in inserted]
+
+
+def _is_connection_error(exc: Exception) -> bool:
+    """Проблема с БД (соединение, deadlock), а не с конкретным событием."""
+    if isinstance(exc, (OperationalError, InterfaceError)):
+        return True
+    return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+
+def write_events(db: Session, events: list[IncomingEvent]) -> WriteResult:
+    """Записывает пачку событий одним multi-row INSERT в одной транзакции.
+
+    Повторные доставки (тот же event_id) отбрасываются: сначала по памяти
+    процесса (recent_ids), затем уникальным индексом event_logs (event_id, created_at)
+    через ON CONFLICT DO NOTHING (created_at берётся из timestamp сообщения и при
+    повторной доставке тот же). Агрегаты user_stats (см. apply_aggregates)
+    обновляются в той же транзакции и только по реально вставленным строкам,
+    поэтому доставка «хотя бы один раз» не искажает статистику.
+
+    Если пачка не записалась из-за конкретного события (FK на несуществующего
+    пользователя, некорректное значение в payload), повторяем построчно через
+    SAVEPOINT: такие события возвращаются в WriteResult.failed, остальные
+    записываются. Ошибки соединения с БД пробрасываются наружу — тогда
+    сообщения не будут ack'нуты и придут повторно.
+    """
+    events = _drop_seen(events)
+    if not events:
+        return WriteResult(0)
+
+    now = datetime.utcnow()
+    rows = [_row(e, now) for e in events]
+    try:
+        written = _insert_new(db, events, rows)
+        apply_aggregates(db, written)
+        notify_users(db, written)
+        db.commit()
+        _remember(events, written)
+        return WriteResult(len(written))
+    except Exception as exc:
+        db.rollback()
+        if _is_connection_error(exc):
+            raise
+        logging.warning("Batch insert of %s events failed (%s), falling back to row-by-row", len(rows), type(exc).__name__)
+
+    written = []
+    stored: list[IncomingEvent] = []
+    failed: list[tuple[IncomingEvent, str]] = []
+    for event, row in zip(events, rows):
+        try:
+            with db.begin_nested():
+                inserted = _insert_new(db, [event], [row])
+                apply_aggregates(db, inserted)
+            written.extend(inserted)
+            stored.append(event)
+        except Exception as exc:
+            if _is_connection_error(exc):
+                raise
+            logging.exception("Failed to store event %s for user %s", event.event_type, event.user_id)
+            # У ошибок SQLAlchemy текст драйвера короче и понятнее (без SQL и параметров).
+            failed.append((event, f"{type(exc).__name__}: {getattr(exc, 'orig', None) or exc}"))
+    notify_users(db, written)
+    db.commit()
+    _remember(stored, written)
+    return WriteResult(len(written), failed)
+
+
+def notify_users(db: Session, written: list[IncomingEvent]) -> None:
+    """Сообщает слушателям EVENTS_CHANNEL, у каких пользователей появились события.
+
+    NOTIFY транзакционный: уведомление уходит только после commit, так что
+    подписчик, прочитав event_logs по нему, уже увидит новые строки.
+    """
+    chunk = ""
+    for user_id in sorted({e.user_id for e in written}):
+        if len(chunk) > _NOTIFY_PAYLOAD_LIMIT:
+            db.execute(select(func.pg_notify(EVENTS_CHANNEL, chunk)))
+            chunk = ""
+        chunk = f"{chunk},{user_id}" if chunk else str(user_id)
+    if chunk:
+        db.execute(select(func.pg_notify(EVENTS_CHANNEL, chunk)))
+
+
+def _remember(stored: list[IncomingEvent], written: list[IncomingEvent]) -> None:
+    """Запоминает event_id после commit.
+
+    stored — события, которые теперь есть в event_logs (вставленные и отсечённые
+    индексом как дубликаты), written — только вставленные.
+    """
+    duplicates = len(stored) - len(written)
+    if duplicates:
+        CONSUMER_DUPLICATES.labels("db").inc(duplicates)
+    recent_ids.add_many(e.event_id for e in stored if e.event_id is not None)
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import asyncpg
+from sqlalchemy import BigInteger, Text, cast, func, select, tuple_
+from sqlalchemy.engine import make_url
+
+from .db import DATABASE_URL, session_scope
+from .exporter import event_columns, event_json
+from .ingest import EVENTS_CHANNEL
+from .metrics import STREAM_CLIENTS, STREAM_EVENTS
+from .models import EventLog
+
+# Как часто отправлять в простаивающий поток SSE комментарий keep-alive (секунды):
+# не даёт прокси закрыть соединение по таймауту и быстро находит отключившихся клиентов.
+STATS_STREAM_HEARTBEAT = float(os.getenv("STATS_STREAM_HEARTBEAT", "15"))
+# Через сколько миллисекунд EventSource переподключается после обрыва.
+STATS_STREAM_RETRY_MS = int(os.getenv("STATS_STREAM_RETRY_MS", "3000"))
+# Сколько событий читать из БД за один запрос (при догоне по Last-Event-ID).
+STATS_STREAM_BATCH = int(os.getenv("STATS_STREAM_BATCH", "200"))
+# Как часто перепроверять закоммиченные события, которые ещё за горизонтом xmin (секунды).
+STATS_STREAM_PENDING_POLL = float(os.getenv("STATS_STREAM_PENDING_POLL", "0.5"))
+# Пауза перед переподключением LISTEN-соединения после ошибки.
+STATS_STREAM_RECONNECT_DELAY = float(os.getenv("STATS_STREAM_RECONNECT_DELAY", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+def _listen_dsn() -> str:
+    """DSN для asyncpg: тот же сервер, что и у остальных соединений сервиса."""
+    url = os.getenv("ASYNC_DATABASE_URL") or DATABASE_URL
+    return make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class EventHub:
+    """Будит потоки SSE этого процесса, когда consumer записал события их пользователя.
+
+    На процесс — одно соединение asyncpg с LISTEN EVENTS_CHANNEL (уведомления
+    приходят от любого consumer'а, в том числе из других процессов). Подписчик —
+    это asyncio.Event, поэтому тысячи простаивающих потоков не занимают ни
+    потоков, ни соединений с БД. Уведомление только будит подписчика: события он
+    сам перечитывает из event_logs после последнего отправленного, поэтому
+    потерянное уведомление (например, при переподключении) ничего не теряет.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[int, set[asyncio.Event]] = {}
+        self._task: asyncio.Task | None = None
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int) -> AsyncIterator[asyncio.Event]:
+        """Подписка на события пользователя: Event взводится при каждом уведомлении."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._listen_forever())
+        wakeup = asyncio.Event()
+        self._subscribers.setdefault(user_id, set()).add(wakeup)
+        STREAM_CLIENTS.inc()
+        try:
+            yield wakeup
+        finally:
+            STREAM_CLIENTS.dec()
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.discard(wakeup)
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def _on_notify(self, conn, pid, channel, payload: str) -> None:
+        for user_id in payload.split(","):
+            try:
+                subscribers = self._subscribers.get(int(user_id), ())
+            except ValueError:
+                continue
+            for wakeup in subscribers:
+                wakeup.set()
+
+    def _wake_all(self) -> None:
+        for subscribers in self._subscribers.values():
+            for wakeup in subscribers:
+                wakeup.set()
+
+    async def _listen_forever(self) -> None:
+        while True:
+            try:
+                conn = await asyncpg.connect(_listen_dsn())
+                try:
+                    await conn.add_listener(EVENTS_CHANNEL, self._on_notify)
+                    # Пока соединения не было, уведомления могли пропасть — пусть подписчики перечитают БД.
+                    self._wake_all()
+                    while True:
+                        # Обрыв соединения без ошибки сокета замечаем по проверочному запросу.
+                        await asyncio.sleep(STATS_STREAM_HEARTBEAT)
+                        await conn.execute("SELECT 1")
+                finally:
+                    await conn.close(timeout=2)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Stats events LISTEN connection failed, reconnecting")
+            await asyncio.sleep(STATS_STREAM_RECONNECT_DELAY)
+
+    async def close(self) -> None:
+        """Закрывает LISTEN-соединение (при остановке приложения)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+
+hub = EventHub()
+
+
+# xmin текущего снимка: все транзакции с меньшим id уже завершились, и новых строк
+# с xact_id ниже него не появится.
+_HORIZON = cast(cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), Text), BigInteger)
+# Курсор «после всех строк транзакции»: id строк (integer) меньше.
+_MAX_ID = 2**31 - 1
+
+
+def parse_stream_cursor(value: str) -> tuple[int, int] | int:
+    """Курсор из Last-Event-ID: «xact_id-id» или просто id события. Бросает ValueError."""
+    xact_id, sep, event_id = value.partition("-")
+    if not sep:
+        return int(value)
+    return int(xact_id), int(event_id)
+
+
+async def _start_cursor(user_id: int, last_event_id: tuple[int, int] | int | None) -> tuple[int, int]:
+    if isinstance(last_event_id, tuple):
+        return last_event_id
+    async with session_scope() as db:
+        if last_event_id is not None:
+            # Id события без транзакции (Last-Event-ID прежнего формата): позиция этого события.
+            xact_id = await db.scalar(
+                select(EventLog.xact_id).where(EventLog.user_id == user_id, EventLog.id == last_event_id)
+            )
+            if xact_id is not None:
+                return xact_id, last_event_id
+        # Только новые события: всё ниже горизонта уже видно и в поток не идёт. Строки
+        # выше горизонта, закоммиченные до подписки, поток отдаст — лучше лишнее, чем пропуск.
+        return await db.scalar(select(_HORIZON)) - 1, _MAX_ID
+
+
+async def _events_after(user_id: int, cursor: tuple[int, int]) -> tuple[list, bool]:
+    """События после cursor в порядке (xact_id, id), не дальше горизонта, и есть ли ещё за ним.
+
+    Строка выше горизонта может быть из транзакции, которая закоммичена, тогда как
+    транзакция с меньшим id ещё идёт и допишет строки перед ней, — её отдавать рано.
+    """
+    stmt = (
+        select(*event_columns(), EventLog.xact_id, _HORIZON.label("horizon"))
+        .where(EventLog.user_id == user_id, tuple_(EventLog.xact_id, EventLog.id) > cursor)
+        .order_by(EventLog.xact_id, EventLog.id)
+        .limit(STATS_STREAM_BATCH)
+    )
+    async with session_scope() as db:
+        rows = (await db.execute(stmt)).all()
+    visible = [row for row in rows if row.xact_id < row.horizon]
+    return visible, len(rows) > len(visible) or len(rows) == STATS_STREAM_BATCH
+
+
+async def event_stream(user_id: int, last_event_id: tuple[int, int] | int | None) -> AsyncIterator[str]:
+    """Поток SSE событий пользователя.
+
+    Без last_event_id отдаёт только новые события; с ним — сначала пропущенные
+    (переподключение EventSource передаёт заголовок Last-Event-ID сам). Id события
+    в потоке — «xact_id-id»: порядок по транзакции записи, а не по id, и строка
+    отдаётся, только когда все транзакции до неё завершились (горизонт xmin).
+    Поэтому курсор не перескакивает события, которые несколько lane'ов consumer'а
+    закоммитили не в порядке id. Пока горизонт не дошёл до закоммиченных строк
+    (его держит любая длинная транзакция в БД), поток перепроверяет их раз в
+    STATS_STREAM_PENDING_POLL секунд.
+    """
+    async with hub.subscribe(user_id) as wakeup:
+        # Подписка — до чтения курсора: событие между ними разбудит поток.
+        cursor = await _start_cursor(user_id, last_event_id)
+        yield f"retry: {STATS_STREAM_RETRY_MS}\n\n"
+        idle_since = time.monotonic()
+        while True:
+            wakeup.clear()
+            rows, more = await _events_after(user_id, cursor)
+            if rows:
+                cursor = (rows[-1].xact_id, rows[-1].id)
+                STREAM_EVENTS.inc(len(rows))
+                yield "".join(
+                    f"id: {row.xact_id}-{row.id}\nevent: stats_event\ndata: {event_json(row)}\n\n" for row in rows
+                )
+                idle_since = time.monotonic()
+                if len(rows) == STATS_STREAM_BATCH:
+                    continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), STATS_STREAM_PENDING_POLL if more else STATS_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                if time.monotonic() - idle_since >= STATS_STREAM_HEARTBEAT:
+                    yield ": keep-alive\n\n"
+                    idle_since = time.monotonic()
@@ -1,30 +1,75 @@
+import asyncio
 import os
 import threading
 import time
 
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from .db import engine
-from .logging_setup import setup_logging
-from .models import EventLog  # noqa: F401  # импорт нужен, чтобы SQLAlchemy создал таблицу event_logs
-from .mq_consumer import run_consumer_forever
+from .db import dispose_engines
+from .live import hub
+from .logging_setup import setup_logging, should_log_access
+from .maintenance import STATS_MAINTENANCE_ENABLED, start_maintenance, stop_maintenance
+from .metrics import HTTP_REQUESTS_IN_FLIGHT, observe_request, render_metrics
+from .mq_consumer import CONSUMER_MODE, consumer_stats, run_consumer_forever
 from .routes_stats import router as stats_router
+from .schema import ensure_schema
+from .security import jwt_cache_stats
+from .tracing import current_trace_id, finish_request_span, request_span, setup_tracing, shutdown_tracing
 
 app = FastAPI(title="Stats Service", version="0.2.0")
 
+# Встроенный consumer (поток в веб-процессе). Выключите, если события обрабатывает
+# отдельный процесс `python -m app.consumer`.
+STATS_CONSUMER_ENABLED = os.getenv("STATS_CONSUMER_ENABLED", "1").lower() in ("1", "true", "yes")
+
 logger = setup_logging(os.getenv("SERVICE_NAME", "stats_service"))
+setup_tracing(os.getenv("SERVICE_NAME", "stats_service"))
 
 
 @app.middleware("http")
 async def access_log(request: Request, call_next):
-    """Логирует входящие и исходящие HTTP-запросы."""
-    logger.info("IN %s %s", request.method, request.url.path)
-    resp = await call_next(request)
-    logger.info("OUT %s %s -> %s", request.method, request.url.path, resp.status_code)
-    return resp
+    """Пишет одну строку access-лога на запрос (статус, длительность, пользователь), метрики и span запроса.
+
+    Успешные запросы сэмплируются (LOG_ACCESS_SAMPLE_RATE), ошибки пишутся всегда.
+    """
+    started = time.perf_counter()
+    status_code = 500
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+    with request_span(request) as span:
+        try:
+            resp = await call_next(request)
+            status_code = resp.status_code
+            return resp
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            # Шаблон маршрута, а не сам путь — иначе число серий метрик не ограничено.
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            observe_request(request.method, route, status_code, elapsed)
+            finish_request_span(span, request.method, route, status_code)
+            if should_log_access(status_code):
+                duration_ms = round(elapsed * 1000, 2)
+                user_id = getattr(request.state, "user_id", None)
+                logger.info(
+                    "%s %s -> %s %.2fms user=%s",
+                    request.method,
+                    request.url.path,
+                    status_code,
+                    duration_ms,
+                    user_id,
+                    extra={
+                        "method": request.method,
+                        "path": request.url.path,
+                        "status": status_code,
+                        "duration_ms": duration_ms,
+                        "user_id": user_id,
+                        "trace_id": current_trace_id(),
+                    },
+                )
 
 
 @app.exception_handler(RequestValidationError)
@@ -48,27 +93,77 @@ async def any_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=400, content={"detail": "Request processing error"})
 
 
-@app.on_event("startup")
-def on_startup():
-    """Создаёт таблицу event_logs и запускает фоновый consumer RabbitMQ."""
-    from .db import Base
+_consumer_stop: asyncio.Event | None = None
+_consumer_task: asyncio.Task | None = None
 
-    # Таблица users создаётся auth_service, но event_logs ссылается на users.id.
-    # Поэтому делаем несколько попыток на случай, если auth_service стартует чуть позже.
-    for attempt in range(1, 31):
-        try:
-            Base.metadata.create_all(bind=engine, tables=[EventLog.__table__])
-            logger.info("DB schema ensured (attempt %s)", attempt)
-            break
-        except Exception:
-            logger.exception("DB init failed (attempt %s/30). Retrying in 2s...", attempt)
-            time.sleep(2)
-    else:
-        raise RuntimeError("DB init failed after retries")
 
+@app.on_event("startup")
+async def on_startup():
+    """Создаёт таблицы event_logs и user_stats* и, если не выключено, запускает consumer RabbitMQ."""
+    global _consumer_stop, _consumer_task
+    # DDL идёт через синхронный engine и может ждать блокировок — не в event loop.
+    await run_in_threadpool(ensure_schema, logger)
+
+    # Свёртка event_logs в event_counts_*, секции на следующие месяцы и удаление старых.
+    # Проход выполняет один процесс за раз (advisory lock), остальные его пропускают.
+    if STATS_MAINTENANCE_ENABLED:
+        start_maintenance()
+
+    if not STATS_CONSUMER_ENABLED:
+        logger.info("Embedded consumer disabled, events are handled by `python -m app.consumer`")
+        return
+    if CONSUMER_MODE == "async":
+        # aio-pika consumer работает в event loop веб-приложения.
+        from .aio_consumer import run_async_consumer_forever
+
+        _consumer_stop = asyncio.Event()
+        _consumer_task = asyncio.create_task(run_async_consumer_forever(stop=_consumer_stop))
+        return
     # Consumer работает в отдельном daemon-потоке.
     t = threading.Thread(target=run_consumer_forever, daemon=True)
     t.start()
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Дописывает накопленные consumer'ом пачки, останавливает фоновые задачи (обслуживание event_logs, LISTEN потоков SSE) и закрывает пулы соединений с БД."""
+    await run_in_threadpool(stop_maintenance)
+    await hub.close()
+    if _consumer_task is not None:
+        _consumer_stop.set()
+        try:
+            await asyncio.wait_for(_consumer_task, 10)
+        except Exception:
+            logger.exception("Embedded consumer did not stop cleanly")
+    await dispose_engines()
+    shutdown_tracing()
+
+
+@app.get(
+    "/internal/consumer",
+    summary="Показатели consumer'а",
+    description="Размер пачек, время сброса в БД и скорость записи событий consumer'ом этого процесса.",
+)
+def consumer_metrics():
+    """Возвращает счётчики batched-consumer'а RabbitMQ."""
+    return consumer_stats()
+
+
+@app.get(
+    "/internal/jwt-cache",
+    summary="Показатели кэша JWT",
+    description="Размер кэша проверенных токенов и число попаданий/промахов в этом процессе.",
+)
+def jwt_cache_metrics():
+    """Возвращает счётчики кэша проверенных JWT."""
+    return jwt_cache_stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Метрики процесса (или всех worker'ов при PROMETHEUS_MULTIPROC_DIR) в формате Prometheus."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
 app.include_router(stats_router)
@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+
+from .db import engine
+from .models import EventCountDaily, EventCountHourly, EventLog, RollupState
+from .partitions import add_months, drop_partitions_before, ensure_future_partitions, month_start
+
+# Запускать ли обслуживание event_logs (свёртка, новые секции, удаление старых) в веб-процессе.
+STATS_MAINTENANCE_ENABLED = os.getenv("STATS_MAINTENANCE_ENABLED", "1").lower() in ("1", "true", "yes")
+# Как часто выполнять обслуживание (секунды).
+STATS_MAINTENANCE_INTERVAL = float(os.getenv("STATS_MAINTENANCE_INTERVAL", "60"))
+# Сколько полных месяцев хранить сырые события; 0 — не удалять.
+STATS_RETENTION_MONTHS = int(os.getenv("STATS_RETENTION_MONTHS", "12"))
+# Насколько назад пересчитывать свёртку при каждом проходе: события, пришедшие с
+# опозданием больше этого окна (timestamp сообщения старше), в event_counts_* не попадут.
+STATS_ROLLUP_LAG_MINUTES = int(os.getenv("STATS_ROLLUP_LAG_MINUTES", "120"))
+
+ROLLUP_NAME = "event_counts"
+# Обслуживание выполняет один процесс за раз (остальные пропускают проход).
+_MAINTENANCE_LOCK_ID = 7_301_002
+
+logger = logging.getLogger(__name__)
+
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def _hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def rolled_up_before(watermark: datetime) -> datetime:
+    """Граница, до которой свёртка окончательна: раньше неё проход уже не пересчитывает."""
+    return _hour(watermark - timedelta(minutes=STATS_ROLLUP_LAG_MINUTES))
+
+
+def rollup(conn: Connection, now: datetime) -> datetime:
+    """Пересчитывает event_counts_hourly/daily за часы, начиная с rolled_up_before(watermark).
+
+    Счётчики за окно перезаписываются целиком, поэтому повторный проход идемпотентен.
+    Возвращает начало пересчитанного окна.
+    """
+    watermark = conn.execute(select(RollupState.watermark).where(RollupState.name == ROLLUP_NAME)).scalar()
+    if watermark is None:
+        # Первый проход: сворачиваем всю историю.
+        first = conn.execute(select(func.min(EventLog.created_at))).scalar()
+        since = _hour(first) if first is not None else _hour(now)
+    else:
+        since = rolled_up_before(watermark)
+
+    hour = func.date_trunc("hour", EventLog.created_at)
+    hourly = pg_insert(EventCountHourly).from_select(
+        ["user_id", "bucket", "event_type", "events"],
+        select(EventLog.user_id, hour, EventLog.event_type, func.count())
+        .where(EventLog.created_at >= since, EventLog.created_at < now)
+        .group_by(EventLog.user_id, hour, EventLog.event_type),
+    )
+    conn.execute(
+        hourly.on_conflict_do_update(
+            index_elements=[EventCountHourly.user_id, EventCountHourly.bucket, EventCountHourly.event_type],
+            set_={"events": hourly.excluded.events},
+        )
+    )
+
+    day_start = since.replace(hour=0)
+    day = func.date_trunc("day", EventCountHourly.bucket)
+    daily = pg_insert(EventCountDaily).from_select(
+        ["user_id", "bucket", "event_type", "events"],
+        select(EventCountHourly.user_id, day, EventCountHourly.event_type, func.sum(EventCountHourly.events))
+        .where(EventCountHourly.bucket >= day_start)
+        .group_by(EventCountHourly.user_id, day, EventCountHourly.event_type),
+    )
+    conn.execute(
+        daily.on_conflict_do_update(
+            index_elements=[EventCountDaily.user_id, EventCountDaily.bucket, EventCountDaily.event_type],
+            set_={"events": daily.excluded.events},
+        )
+    )
+
+    state = pg_insert(RollupState).values(name=ROLLUP_NAME, watermark=now)
+    conn.execute(state.on_conflict_do_update(index_elements=[RollupState.name], set_={"watermark": now}))
+    return since
+
+
+def apply_retention(conn: Connection, now: datetime) -> list[str]:
+    """Удаляет секции старше STATS_RETENTION_MONTHS — но только уже свёрнутые в event_counts_*."""
+    if STATS_RETENTION_MONTHS <= 0:
+        return []
+    watermark = conn.execute(select(RollupState.watermark).where(RollupState.name == ROLLUP_NAME)).scalar()
+    if watermark is None:
+        return []
+    cutoff = min(add_months(month_start(now), -STATS_RETENTION_MONTHS), rolled_up_before(watermark))
+    return drop_partitions_before(conn, cutoff)
+
+
+def run_maintenance_once(now: datetime | None = None) -> dict | None:
+    """Один проход обслуживания: свёртка, секции на будущие месяцы, удаление старых.
+
+    Возвращает описание сделанного или None, если проход уже выполняет другой процесс.
+    """
+    now = now or datetime.utcnow()
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": _MAINTENANCE_LOCK_ID}).scalar():
+            return None
+        # Свёртка — до DDL: создание и удаление секций блокирует вставку до конца транзакции.
+        since = rollup(conn, now)
+        created = ensure_future_partitions(conn, now)
+        dropped = apply_retention(conn, now)
+    if created or dropped:
+        logger.info("event_logs partitions: created %s, dropped %s", created, dropped)
+    return {"rolled_up_since": since.isoformat(), "created": created, "dropped": dropped}
+
+
+def run_maintenance_forever() -> None:
+    """Периодически выполняет обслуживание до stop_maintenance()."""
+    while not _stop.is_set():
+        try:
+            run_maintenance_once()
+        except Exception:
+            logger.exception("event_logs maintenance failed")
+        _stop.wait(STATS_MAINTENANCE_INTERVAL)
+
+
+def start_maintenance() -> None:
+    """Запускает обслуживание event_logs в фоновом потоке (один раз на процесс)."""
+    global _thread
+    if _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=run_maintenance_forever, name="stats-maintenance", daemon=True)
+    _thread.start()
+
+
+def stop_maintenance(timeout: float = 5.0) -> None:
+    """Останавливает фоновый поток обслуживания."""
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=timeout)
+    _thread = None
+
+
+if __name__ == "__main__":
+    # Разовый проход, например из cron: `python -m app.maintenance`.
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    print(run_maintenance_once())
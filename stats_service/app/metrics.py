@@ -0,0 +1,97 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# Для нескольких uvicorn worker'ов задайте PROMETHEUS_MULTIPROC_DIR — пустой каталог,
+# очищаемый перед запуском. Каждый процесс пишет значения в свои mmap-файлы,
+# а /metrics в любом из процессов отдаёт сумму по всем.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Границы бакетов для быстрых операций (ожидание пула, запись пачки).
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки HTTP-запроса",
+    ["method", "route", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Сколько HTTP-запросов обрабатывается прямо сейчас",
+    multiprocess_mode="livesum",
+)
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Сколько запрос ждал соединение из пула SQLAlchemy",
+    ["pool"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_SIZE = Gauge("db_pool_size", "Размер пула соединений", ["pool"], multiprocess_mode="livesum")
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Соединения, выданные из пула", ["pool"], multiprocess_mode="livesum"
+)
+DB_POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Соединения сверх pool_size (max_overflow)", ["pool"], multiprocess_mode="livesum"
+)
+DB_READ_SESSIONS = Counter(
+    "db_read_sessions_total",
+    "Сессии для чтения: replica, primary_sticky (реплики ещё не дошли до записи клиента), primary_failover (нет доступных реплик)",
+    ["target"],
+)
+
+
+CONSUMER_MESSAGES = Counter("consumer_messages_total", "Сообщения, полученные consumer'ом", ["result"])
+CONSUMER_BATCH_MESSAGES = Histogram(
+    "consumer_batch_size",
+    "Число сообщений в одной пачке consumer'а",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+CONSUMER_FLUSH_SECONDS = Histogram(
+    "consumer_flush_duration_seconds", "Полное время обработки пачки: разбор, запись в БД и ack", buckets=FAST_BUCKETS
+)
+CONSUMER_DB_WRITE_SECONDS = Histogram(
+    "consumer_db_write_duration_seconds", "Время записи пачки в event_logs и агрегаты", buckets=FAST_BUCKETS
+)
+# Одну очередь могут читать несколько consumer'ов, поэтому между процессами берётся максимум.
+CONSUMER_QUEUE_BACKLOG = Gauge(
+    "consumer_queue_backlog", "Сообщения, ожидающие в очереди consumer'а", ["queue"], multiprocess_mode="max"
+)
+CONSUMER_REPUBLISHED = Counter(
+    "consumer_republished_total", "Сообщения, отправленные в очередь задержки (retry) или DLQ (dlq)", ["target"]
+)
+CONSUMER_DUPLICATES = Counter(
+    "consumer_duplicates_total", "Повторные доставки, отброшенные по event_id", ["stage"]
+)
+CONSUMER_PREFETCH_GAUGE = Gauge(
+    "consumer_prefetch", "Текущий prefetch consumer'а (CONSUMER_MODE=async)", multiprocess_mode="livesum"
+)
+
+STREAM_CLIENTS = Gauge(
+    "stats_stream_clients", "Открытые потоки /api/v1/stats/events/stream", multiprocess_mode="livesum"
+)
+STREAM_EVENTS = Counter("stats_stream_events_total", "События, отправленные в потоки SSE")
+
+
+def observe_request(method: str, route: str, status: int, seconds: float) -> None:
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+def observe_pool(pool_name: str, pool, wait_seconds: float | None = None) -> None:
+    """Обновляет метрики пула SQLAlchemy; вызывается при выдаче и возврате соединения."""
+    if wait_seconds is not None:
+        DB_POOL_CHECKOUT_SECONDS.labels(pool_name).observe(wait_seconds)
+    DB_POOL_SIZE.labels(pool_name).set(pool.size())
+    DB_POOL_CHECKED_OUT.labels(pool_name).set(pool.checkedout())
+    DB_POOL_OVERFLOW.labels(pool_name).set(max(0, pool.overflow()))
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Текст для /metrics в формате Prometheus: (тело, Content-Type)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
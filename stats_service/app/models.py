@@ -1,7 +1,9 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Table, Text
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Index, Integer, String, Table, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.types import TypeDecorator
 
 from .db import Base
 
@@ -18,13 +20,116 @@ users = Table(
 )
 
 
+class JSONBText(TypeDecorator):
+    """JSONB, в который пишется готовый JSON-текст (тело сообщения) без повторного json.dumps.
+
+    Сравнения с документом (@>) строятся через type_coerce(..., JSONB).
+    """
+
+    impl = JSONB
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        return None
+
+
 class EventLog(Base):
-    """Событие, полученное из RabbitMQ и сохранённое в БД (таблица event_logs)."""
+    """Событие, полученное из RabbitMQ и сохранённое в БД (таблица event_logs).
+
+    Таблица секционирована по месяцам created_at (event_logs_YYYYMM, см. partitions.py):
+    вставка и индексы работают с одной небольшой секцией, а старые месяцы
+    удаляются целиком после свёртки в event_counts_*. Ключ секционирования
+    обязан входить в первичный ключ и уникальные индексы.
+    """
 
     __tablename__ = "event_logs"
+    __table_args__ = (
+        # Повторная доставка приходит с тем же message_id и timestamp (а значит и created_at).
+        Index("ux_event_logs_event_id", "event_id", "created_at", unique=True),
+        Index("ix_event_logs_created_at", "created_at"),
+        # jsonb_path_ops: компактный GIN-индекс под запросы payload_json @> '{...}' (см. /api/v1/stats/events).
+        Index(
+            "ix_event_logs_payload",
+            "payload_json",
+            postgresql_using="gin",
+            postgresql_ops={"payload_json": "jsonb_path_ops"},
+        ),
+        # Догон потока SSE пользователя в порядке commit'ов (см. live.event_stream).
+        Index("ix_event_logs_user_xact", "user_id", "xact_id", "id"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
-    id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     event_type: Mapped[str] = mapped_column(String(128), index=True, nullable=False)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), index=True, nullable=False)
-    payload_json: Mapped[str] = mapped_column(Text, nullable=False)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Тело сообщения как есть (JSON-объект события).
+    payload_json: Mapped[dict] = mapped_column(JSONBText, nullable=False)
+    # message_id сообщения; вместе с created_at отсекает повторные доставки одного события.
+    # У старых строк и сообщений без message_id — NULL (такие не дедуплицируются).
+    event_id: Mapped[str | None] = mapped_column(String(36), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True, default=datetime.utcnow)
+    # Транзакция, записавшая строку (pg_current_xact_id). Строки из транзакций ниже
+    # xmin снимка уже закоммичены все, поэтому по (xact_id, id) поток SSE идёт в
+    # порядке commit'ов. У строк, записанных до появления колонки, — NULL.
+    xact_id: Mapped[int | None] = mapped_column(
+        BigInteger, server_default=text("(pg_current_xact_id()::text::bigint)"), nullable=True
+    )
+
+
+class EventCountHourly(Base):
+    """Число событий пользователя по типам за час (свёртка event_logs, переживает удаление секций)."""
+
+    __tablename__ = "event_counts_hourly"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    event_type: Mapped[str] = mapped_column(String(128), primary_key=True)
+    events: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class EventCountDaily(Base):
+    """Число событий пользователя по типам за сутки (считается из event_counts_hourly)."""
+
+    __tablename__ = "event_counts_daily"
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    bucket: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    event_type: Mapped[str] = mapped_column(String(128), primary_key=True)
+    events: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+
+class RollupState(Base):
+    """До какого момента event_logs уже свёрнут в event_counts_* (таблица rollup_state)."""
+
+    __tablename__ = "rollup_state"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    watermark: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class UserStats(Base):
+    """Агрегаты коллекции пользователя, поддерживаемые consumer'ом (таблица user_stats).
+
+    Обновляются только прибавлением дельт, поэтому порядок и группировка
+    событий в пачки на итог не влияют.
+    """
+
+    __tablename__ = "user_stats"
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    total_items: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rated_items: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rating_sum: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class UserStatsBreakdown(Base):
+    """Количество игр пользователя в разрезе статуса или платформы (таблица user_stats_breakdown)."""
+
+    __tablename__ = "user_stats_breakdown"
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    # "status" или "platform"
+    dimension: Mapped[str] = mapped_column(String(16), primary_key=True)
+    value: Mapped[str] = mapped_column(String(64), primary_key=True)
+    item_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
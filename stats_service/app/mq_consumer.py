@@ -1,78 +1,415 @@
-import json
 import logging
 import os
+import threading
 import time
+from collections import deque
 
 import pika
+from opentelemetry import trace
+from opentelemetry.trace import Link, SpanKind
 
 from .db import SessionLocal
-from .models import EventLog
+from .ingest import IncomingEvent, WriteResult, parse_event, write_events
+from .metrics import (
+    CONSUMER_BATCH_MESSAGES,
+    CONSUMER_DB_WRITE_SECONDS,
+    CONSUMER_FLUSH_SECONDS,
+    CONSUMER_MESSAGES,
+    CONSUMER_QUEUE_BACKLOG,
+    CONSUMER_REPUBLISHED,
+)
+from .retry import DLQ, REQUEUE_EXCHANGE, declare_retry_topology, next_hop
+from .tracing import TRACING_ENABLED, context_from_traceparent, tracer
 
 RABBITMQ_URL = os.getenv("RABBITMQ_URL", "")
 EXCHANGE = "events"
 QUEUE = "stats_events"
 BIND_KEY = "collection.*"
 
+# topic — все consumer'ы читают общую очередь stats_events (порядок событий между ними не гарантирован);
+# hash  — события раскладываются по очередям stats_events.<N> exchange'ем x-consistent-hash
+#         по заголовку user_id: события одного пользователя обрабатывает один worker по порядку.
+#         Нужен плагин rabbitmq_consistent_hash_exchange.
+CONSUMER_ROUTING = os.getenv("CONSUMER_ROUTING", "topic").lower()
+HASH_EXCHANGE = "stats_events.hash"
+
+# Пачка сбрасывается в БД, когда набралось CONSUMER_BATCH_SIZE сообщений
+# или прошло CONSUMER_FLUSH_MS с момента прихода первого сообщения пачки.
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "500"))
+CONSUMER_FLUSH_MS = int(os.getenv("CONSUMER_FLUSH_MS", "50"))
+# Prefetch должен покрывать пачку с запасом, иначе брокер не пришлёт достаточно сообщений.
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", str(CONSUMER_BATCH_SIZE * 2)))
+# Как часто (секунды) запрашивать у брокера длину очереди для метрики consumer_queue_backlog.
+CONSUMER_BACKLOG_INTERVAL = float(os.getenv("CONSUMER_BACKLOG_INTERVAL", "5"))
+# blocking — pika BlockingConnection, одна пачка за раз (этот модуль);
+# async    — aio-pika: несколько пачек пишутся параллельно, prefetch подстраивается (aio_consumer.py).
+CONSUMER_MODE = os.getenv("CONSUMER_MODE", "blocking").lower()
+
+
+class ConsumerStats:
+    """Счётчики consumer'а: размер пачек, время сброса и скорость записи."""
+
+    WINDOW_SECONDS = 10.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._recent: deque = deque()  # (monotonic, rows)
+        self.batches = 0
+        self.messages = 0
+        self.rows_written = 0
+        self.invalid = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def record_flush(self, batch_size: int, written: int, invalid: int, seconds: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.batches += 1
+            self.messages += batch_size
+            self.rows_written += written
+            self.invalid += invalid
+            self.last_batch_size = batch_size
+            self.last_flush_ms = seconds * 1000
+            self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+            self._recent.append((now, written))
+            while self._recent and now - self._recent[0][0] > self.WINDOW_SECONDS:
+                self._recent.popleft()
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            recent_rows = sum(n for ts, n in self._recent if now - ts <= self.WINDOW_SECONDS)
+            return {
+                "batches": self.batches,
+                "messages": self.messages,
+                "rows_written": self.rows_written,
+                "invalid": self.invalid,
+                "avg_batch_size": round(self.messages / self.batches, 1) if self.batches else 0.0,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "max_flush_ms": round(self.max_flush_ms, 2),
+                "rows_per_sec": round(recent_rows / self.WINDOW_SECONDS, 1),
+                "batch_limit": CONSUMER_BATCH_SIZE,
+                "flush_ms_limit": CONSUMER_FLUSH_MS,
+                "prefetch": CONSUMER_PREFETCH,
+            }
+
+
+stats = ConsumerStats()
+
+
+def _traceparent(headers: dict | None) -> str | None:
+    value = (headers or {}).get("traceparent")
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def message_links(meta: list) -> list[Link]:
+    """Связи span'а пачки с trace'ами её сообщений (у пачки нет единственного родителя).
+
+    meta — список (routing_key, headers, время получения в нс).
+    """
+    if not TRACING_ENABLED:
+        return []
+    links = []
+    for _routing_key, headers, _received in meta[:128]:
+        ctx = trace.get_current_span(context_from_traceparent(_traceparent(headers))).get_span_context()
+        if ctx.is_valid:
+            links.append(Link(ctx))
+    return links
 
-def _handle_message(ch, method, properties, body: bytes):
-    """Callback для pika: сохраняет событие в таблицу event_logs и ack'ает сообщение."""
-    try:
-        data = json.loads(body.decode("utf-8"))
-        event_type = method.routing_key
 
-        raw_uid = data.get("user_id")
-        if raw_uid is None:
-            raise ValueError("Missing user_id in event")
+def record_consume_spans(meta: list, batch_span) -> None:
+    """Span на каждое сообщение — от получения до записи в БД — в trace его запроса.
+
+    Вместе со span'ами HTTP-запроса и публикации это даёт полную задержку
+    «запрос — публикация — очередь — запись в event_logs».
+    """
+    if not TRACING_ENABLED:
+        return
+    for routing_key, headers, received in meta:
+        span = tracer.start_span(
+            f"consume {routing_key}",
+            context=context_from_traceparent(_traceparent(headers)),
+            kind=SpanKind.CONSUMER,
+            start_time=received,
+            links=[Link(batch_span.get_span_context())],
+            attributes={"messaging.system": "rabbitmq", "messaging.destination.name": routing_key},
+        )
+        span.end()
 
-        user_id = int(raw_uid)
-        if user_id <= 0:
-            raise ValueError("Invalid user_id in event")
 
-        db = SessionLocal()
+def parse_batch(items: list[tuple]) -> tuple[list[IncomingEvent], list[tuple[int, str]]]:
+    """Разбирает пачку (routing_key, body, message_id, timestamp).
+
+    Возвращает (события, [(номер сообщения, ошибка)] для некорректных сообщений).
+    У каждого события delivery — номер его сообщения в пачке.
+    """
+    events: list[IncomingEvent] = []
+    rejected: list[tuple[int, str]] = []
+    for index, (routing_key, body, message_id, timestamp) in enumerate(items):
         try:
-            db.add(
-                EventLog(
-                    event_type=event_type,
-                    user_id=user_id,
-                    payload_json=json.dumps(data, ensure_ascii=False),
-                )
-            )
-            db.commit()
-        finally:
-            db.close()
+            event = parse_event(routing_key, body, message_id, timestamp)
+        except Exception as exc:
+            # Некорректное сообщение не исправится при повторной доставке — сразу в DLQ.
+            rejected.append((index, f"{type(exc).__name__}: {exc}"))
+            logging.warning("Failed to parse message %s: %s", routing_key, exc)
+            continue
+        event.delivery = index
+        events.append(event)
+    return events, rejected
+
+
+def republish_target(routing_key: str, headers: dict | None, error: str, permanent: bool = False) -> tuple[str, str, dict]:
+    """next_hop + метрика: куда отправить сообщение, которое не удалось обработать."""
+    exchange, target_key, new_headers = next_hop(routing_key, headers, error, permanent)
+    CONSUMER_REPUBLISHED.labels("dlq" if target_key == DLQ else "retry").inc()
+    return exchange, target_key, new_headers
+
+
+def record_batch(
+    size: int, written: int, invalid: int, db_seconds: float, flush_seconds: float, failed: int = 0
+) -> None:
+    """Обновляет счётчики /internal/consumer и метрики Prometheus по обработанной пачке."""
+    stats.record_flush(size, written, invalid, db_seconds)
+    CONSUMER_BATCH_MESSAGES.observe(size)
+    CONSUMER_MESSAGES.labels("written").inc(written)
+    CONSUMER_MESSAGES.labels("invalid").inc(invalid)
+    CONSUMER_MESSAGES.labels("failed").inc(failed)
+    CONSUMER_MESSAGES.labels("skipped").inc(size - written - invalid - failed)
+    if size > invalid:
+        CONSUMER_DB_WRITE_SECONDS.observe(db_seconds)
+    CONSUMER_FLUSH_SECONDS.observe(flush_seconds)
+    logging.debug("Flushed %s events (%s written) in %.1f ms", size, written, db_seconds * 1000)
+
+
+class _BatchingConsumer:
+    """Копит доставки и сбрасывает их в БД пачкой с одним ack(multiple=True).
 
-        logging.info("Consumed %s", event_type)
-    except Exception:
-        logging.exception("Failed to process message")
+    Сообщения, которые не удалось разобрать или записать, перед ack
+    переопубликовываются в очередь задержки или DLQ (см. retry.next_hop),
+    поэтому одно плохое событие не задерживает остальные.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.pending: list = []  # (method, properties, body, время получения в нс)
+        self.deadline = 0.0
+
+    def on_message(self, ch, method, properties, body: bytes):
+        """Callback для pika: только складывает сообщение в текущую пачку."""
+        if not self.pending:
+            self.deadline = time.monotonic() + CONSUMER_FLUSH_MS / 1000
+        self.pending.append((method, properties, body, time.time_ns()))
+
+    def time_left(self) -> float:
+        """Сколько можно ждать новых сообщений до обязательного сброса пачки."""
+        if not self.pending:
+            return 1.0
+        return max(0.0, self.deadline - time.monotonic())
+
+    def due(self) -> bool:
+        return bool(self.pending) and (
+            len(self.pending) >= CONSUMER_BATCH_SIZE or time.monotonic() >= self.deadline
+        )
+
+    def flush(self) -> None:
+        """Пишет пачку в event_logs и подтверждает все её сообщения одним ack."""
+        flush_started = time.perf_counter()
+        batch, self.pending = self.pending, []
+        events, rejected = parse_batch(
+            [(method.routing_key, body, props.message_id, props.timestamp) for method, props, body, _received in batch]
+        )
+        meta = [(method.routing_key, props.headers, received) for method, props, _body, received in batch]
+
+        started = time.perf_counter()
+        result = WriteResult(0)
+        with tracer.start_as_current_span(
+            "stats.write_batch",
+            links=message_links(meta),
+            attributes={"messaging.batch.message_count": len(batch)},
+        ) as batch_span:
+            if events:
+                db = SessionLocal()
+                try:
+                    # Ошибки соединения с БД пробрасываются: пачка не ack'ается и придёт повторно.
+                    result = write_events(db, events)
+                finally:
+                    db.close()
+        elapsed = time.perf_counter() - started
+        record_consume_spans(meta, batch_span)
+
+        # Канал в режиме confirm: basic_publish возвращается после подтверждения брокером,
+        # поэтому ack ниже не потеряет сообщение, даже если процесс упадёт между ними.
+        for index, error in rejected:
+            self._republish(batch[index], error, permanent=True)
+        for event, error in result.failed:
+            self._republish(batch[event.delivery], error)
+        self.channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+        record_batch(
+            len(batch), result.written, len(rejected), elapsed, time.perf_counter() - flush_started, len(result.failed)
+        )
+
+    def _republish(self, entry: tuple, error: str, permanent: bool = False) -> None:
+        method, props, body, _received = entry
+        exchange, routing_key, headers = republish_target(method.routing_key, props.headers, error, permanent)
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=props.content_type,
+                delivery_mode=2,
+                headers=headers,
+                message_id=props.message_id,
+                timestamp=props.timestamp,
+            ),
+        )
+
+
+def consumer_stats() -> dict:
+    """Текущие показатели consumer'а этого процесса."""
+    return stats.snapshot()
+
+
+def partition_queue(index: int) -> str:
+    return f"{QUEUE}.{index}"
+
+
+def declare_topology(ch, worker: int = 0, drain: list[str] | tuple = ()) -> list[str]:
+    """Объявляет exchange'и и очереди worker'а и возвращает очереди, которые он читает.
+
+    drain — отвязанные разделы, в которых остались сообщения (см. reconcile_partitions);
+    их дочитывает worker 0.
+    """
+    ch.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True)
+    ch.queue_declare(queue=QUEUE, durable=True)
+    # Сообщения из очередей задержки возвращаются через REQUEUE_EXCHANGE туда же, куда и из events.
+    declare_retry_topology(ch)
+
+    if CONSUMER_ROUTING != "hash":
+        ch.queue_bind(exchange=EXCHANGE, queue=QUEUE, routing_key=BIND_KEY)
+        ch.queue_bind(exchange=REQUEUE_EXCHANGE, queue=QUEUE, routing_key=BIND_KEY)
+        return [QUEUE]
+
+    ch.exchange_declare(
+        exchange=HASH_EXCHANGE,
+        exchange_type="x-consistent-hash",
+        durable=True,
+        arguments={"hash-header": "user_id"},
+    )
+    ch.exchange_bind(destination=HASH_EXCHANGE, source=EXCHANGE, routing_key=BIND_KEY)
+    ch.exchange_bind(destination=HASH_EXCHANGE, source=REQUEUE_EXCHANGE, routing_key=BIND_KEY)
+    queue = partition_queue(worker)
+    ch.queue_declare(queue=queue, durable=True)
+    # Для consistent-hash exchange routing key привязки — вес раздела.
+    ch.queue_bind(exchange=HASH_EXCHANGE, queue=queue, routing_key="1")
+    if worker != 0:
+        return [queue]
+    # Общая очередь больше не получает новых событий; worker 0 дочитывает то, что в ней осталось.
+    ch.queue_unbind(exchange=EXCHANGE, queue=QUEUE, routing_key=BIND_KEY)
+    ch.queue_unbind(exchange=REQUEUE_EXCHANGE, queue=QUEUE, routing_key=BIND_KEY)
+    for name in drain:
+        ch.queue_declare(queue=name, durable=True)
+    return [queue, QUEUE, *drain]
+
+
+def reconcile_partitions(workers: int) -> list[str]:
+    """Приводит разделы stats_events.<N> к числу worker'ов (CONSUMER_ROUTING=hash).
+
+    Вызывается supervisor'ом до запуска worker'ов. Объявляет и привязывает разделы
+    0..workers-1, а разделы с большими номерами (остались от прежнего, большего
+    CONSUMER_WORKERS) отвязывает от HASH_EXCHANGE — иначе их доля событий копилась бы
+    в очередях, которые никто не читает. Пустые лишние разделы удаляются, непустые
+    возвращаются: их дочитывает worker 0, а удаляются они при следующем запуске.
+    Лишние разделы ищутся по порядку номеров до первого отсутствующего.
+    """
+    conn = pika.BlockingConnection(pika.URLParameters(RABBITMQ_URL))
+    try:
+        ch = conn.channel()
+        for worker in range(workers):
+            declare_topology(ch, worker)
+
+        leftovers = []
+        index = workers
+        while True:
+            name = partition_queue(index)
+            # Пассивное объявление несуществующей очереди (404) закрывает канал — на каждый раздел свой.
+            probe = conn.channel()
+            try:
+                declared = probe.queue_declare(queue=name, passive=True)
+            except pika.exceptions.ChannelClosedByBroker:
+                break
+            probe.queue_unbind(exchange=HASH_EXCHANGE, queue=name, routing_key="1")
+            if declared.method.message_count:
+                leftovers.append(name)
+            else:
+                try:
+                    # if_unused: старый worker ещё может держать неподтверждённые сообщения.
+                    probe.queue_delete(queue=name, if_unused=True, if_empty=True)
+                except pika.exceptions.ChannelClosedByBroker:
+                    leftovers.append(name)
+            if probe.is_open:
+                probe.close()
+            index += 1
+        return leftovers
     finally:
-        # Ack в любом случае, чтобы очередь не «залипла» на плохом сообщении.
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        conn.close()
 
 
-def run_consumer_forever():
-    """Бесконечно читает события из RabbitMQ и пишет их в БД.
+def run_consumer_forever(
+    worker: int = 0, workers: int = 1, stop: threading.Event | None = None, drain: list[str] | tuple = ()
+):
+    """Бесконечно читает события из RabbitMQ и пишет их в БД пачками.
 
+    worker/workers — номер этого consumer'а и их общее число (для CONSUMER_ROUTING=hash),
+    drain — лишние разделы, которые нужно дочитать (см. reconcile_partitions).
     При падении соединения/канала — делает паузу и переподключается.
+    Если передан stop, после его установки дописывает текущую пачку и выходит.
     """
-    while True:
+    stop = stop or threading.Event()
+    while not stop.is_set():
         conn = None
         try:
             params = pika.URLParameters(RABBITMQ_URL)
             conn = pika.BlockingConnection(params)
             ch = conn.channel()
 
-            ch.exchange_declare(exchange=EXCHANGE, exchange_type="topic", durable=True)
-            ch.queue_declare(queue=QUEUE, durable=True)
-            ch.queue_bind(exchange=EXCHANGE, queue=QUEUE, routing_key=BIND_KEY)
+            queues = declare_topology(ch, worker, drain)
+            # Переопубликация в очередь задержки/DLQ должна быть подтверждена до ack исходного сообщения.
+            ch.confirm_delivery()
 
-            ch.basic_qos(prefetch_count=10)
-            ch.basic_consume(queue=QUEUE, on_message_callback=_handle_message)
+            ch.basic_qos(prefetch_count=CONSUMER_PREFETCH)
+            consumer = _BatchingConsumer(ch)
+            for queue in queues:
+                ch.basic_consume(queue=queue, on_message_callback=consumer.on_message)
 
-            logging.info("Stats consumer started. Waiting for messages...")
-            ch.start_consuming()
+            logging.info(
+                "Stats consumer %s/%s started (queues=%s, batch=%s, flush=%sms, prefetch=%s). Waiting for messages...",
+                worker + 1,
+                workers,
+                ",".join(queues),
+                CONSUMER_BATCH_SIZE,
+                CONSUMER_FLUSH_MS,
+                CONSUMER_PREFETCH,
+            )
+            backlog_checked = 0.0
+            while not stop.is_set():
+                # Возвращается, как только пришли сообщения, или по истечении таймаута.
+                conn.process_data_events(time_limit=consumer.time_left())
+                if consumer.due():
+                    consumer.flush()
+                if time.monotonic() - backlog_checked >= CONSUMER_BACKLOG_INTERVAL:
+                    backlog_checked = time.monotonic()
+                    for queue in queues + [DLQ]:
+                        # passive=True только читает состояние очереди, не меняя её.
+                        declared = ch.queue_declare(queue=queue, passive=True)
+                        CONSUMER_QUEUE_BACKLOG.labels(queue).set(declared.method.message_count)
+            if consumer.pending:
+                consumer.flush()
         except Exception:
             logging.exception("Consumer crashed, retry in 3s...")
-            time.sleep(3)
+            stop.wait(3)
         finally:
             # Важно закрывать соединение, иначе при множественных рестартах будут утечки.
             try:
@@ -0,0 +1,132 @@
+import os
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy.engine import Connection
+
+from .models import EventLog
+
+# Сколько месяцев вперёд держать готовые секции event_logs (создаются заранее, чтобы
+# вставка никогда не ждала DDL).
+STATS_PARTITIONS_AHEAD = int(os.getenv("STATS_PARTITIONS_AHEAD", "2"))
+
+# Секция для строк вне месячных секций (события с очень старым или будущим timestamp).
+DEFAULT_PARTITION = "event_logs_default"
+_PARTITION_RE = re.compile(r"^event_logs_(\d{4})(\d{2})$")
+
+
+def month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(month: datetime, n: int) -> datetime:
+    years, month_index = divmod(month.month - 1 + n, 12)
+    return datetime(month.year + years, month_index + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"event_logs_{month:%Y%m}"
+
+
+def list_partitions(conn: Connection) -> dict[str, datetime]:
+    """Месячные секции event_logs: имя -> начало месяца."""
+    names = conn.exec_driver_sql(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'event_logs'::regclass"
+    ).scalars()
+    result = {}
+    for name in names:
+        match = _PARTITION_RE.match(name)
+        if match:
+            result[name] = datetime(int(match[1]), int(match[2]), 1)
+    return result
+
+
+def create_partitions(conn: Connection, first: datetime, last: datetime) -> list[str]:
+    """Создаёт недостающие месячные секции с месяца first по месяц last включительно.
+
+    Если в секции по умолчанию уже есть строки этого месяца, они переносятся
+    в новую секцию (иначе PostgreSQL не даст её создать).
+    """
+    existing = list_partitions(conn)
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing:
+            lower, upper = f"{month:%Y-%m-%d}", f"{add_months(month, 1):%Y-%m-%d}"
+            conn.exec_driver_sql(
+                f"CREATE TEMP TABLE _moved_events (LIKE event_logs) ON COMMIT DROP; "
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                f"WHERE created_at >= '{lower}' AND created_at < '{upper}' RETURNING *) "
+                f"INSERT INTO _moved_events SELECT * FROM moved; "
+                f"CREATE TABLE {name} PARTITION OF event_logs FOR VALUES FROM ('{lower}') TO ('{upper}'); "
+                f"INSERT INTO event_logs SELECT * FROM _moved_events; "
+                f"DROP TABLE _moved_events"
+            )
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def ensure_future_partitions(conn: Connection, now: datetime | None = None) -> list[str]:
+    """Секции на текущий месяц и STATS_PARTITIONS_AHEAD месяцев вперёд."""
+    current = month_start(now or datetime.utcnow())
+    return create_partitions(conn, current, add_months(current, STATS_PARTITIONS_AHEAD))
+
+
+def drop_partitions_before(conn: Connection, cutoff: datetime) -> list[str]:
+    """Удаляет месячные секции, целиком лежащие раньше cutoff, и такие же строки секции по умолчанию."""
+    dropped = []
+    for name, month in sorted(list_partitions(conn).items(), key=lambda item: item[1]):
+        if add_months(month, 1) <= cutoff:
+            conn.exec_driver_sql(f"DROP TABLE {name}")
+            dropped.append(name)
+    conn.exec_driver_sql(f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at < '{cutoff.isoformat(sep=' ')}'")
+    return dropped
+
+
+def create_partitioned_table(conn: Connection) -> None:
+    """Создаёт секционированную event_logs с секцией по умолчанию и секциями на ближайшие месяцы."""
+    EventLog.__table__.create(conn)
+    conn.exec_driver_sql(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF event_logs DEFAULT")
+    ensure_future_partitions(conn)
+
+
+def migrate_unpartitioned(conn: Connection) -> None:
+    """Переносит данные из обычной (до секционирования) event_logs в секционированную.
+
+    Выполняется один раз, в транзакции ensure_schema; старая таблица удаляется.
+    """
+    # Колонки, добавленные до секционирования, — на случай совсем старой схемы.
+    conn.exec_driver_sql("ALTER TABLE event_logs ADD COLUMN IF NOT EXISTS event_id VARCHAR(36)")
+    conn.exec_driver_sql(
+        """
+        DO $$ BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'event_logs' AND column_name = 'payload_json') <> 'jsonb' THEN
+                ALTER TABLE event_logs ALTER COLUMN payload_json TYPE JSONB USING payload_json::jsonb;
+            END IF;
+        END $$;
+        """
+    )
+
+    # Имена индексов и ограничений глобальны в схеме — освобождаем их для новой таблицы.
+    conn.exec_driver_sql("ALTER TABLE event_logs RENAME TO event_logs_unpartitioned")
+    conn.exec_driver_sql("ALTER TABLE event_logs_unpartitioned RENAME CONSTRAINT event_logs_pkey TO event_logs_unpartitioned_pkey")
+    for index in ("ix_event_logs_event_type", "ix_event_logs_user_id", "ix_event_logs_event_id", "ix_event_logs_payload"):
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+
+    create_partitioned_table(conn)
+    first = conn.exec_driver_sql("SELECT min(created_at) FROM event_logs_unpartitioned").scalar()
+    if first is not None:
+        create_partitions(conn, first, datetime.utcnow() + timedelta(days=1))
+    conn.exec_driver_sql(
+        "INSERT INTO event_logs (id, event_type, user_id, payload_json, event_id, created_at) "
+        "SELECT id, event_type, user_id, payload_json, event_id, COALESCE(created_at, now() AT TIME ZONE 'utc') "
+        "FROM event_logs_unpartitioned"
+    )
+    conn.exec_driver_sql(
+        "SELECT setval(pg_get_serial_sequence('event_logs', 'id'), COALESCE((SELECT max(id) FROM event_logs), 0) + 1, false)"
+    )
+    conn.exec_driver_sql("DROP TABLE event_logs_unpartitioned")
@@ -0,0 +1,83 @@
+import os
+from datetime import datetime
+
+# Задержки повторных попыток (мс). Для каждой — очередь stats_events.retry.<N>ms с TTL:
+# сообщение лежит в ней N мс и возвращается в поток через exchange stats_events.requeue.
+STATS_RETRY_DELAYS_MS = [int(x) for x in os.getenv("STATS_RETRY_DELAYS_MS", "1000,10000,60000").split(",") if x.strip()]
+# Сколько всего раз обрабатывать сообщение; после последней неудачи оно уходит в stats_events.dlq.
+STATS_RETRY_MAX_ATTEMPTS = int(os.getenv("STATS_RETRY_MAX_ATTEMPTS", str(len(STATS_RETRY_DELAYS_MS) + 1)))
+
+# Возврат из очередей задержки: привязан к тем же очередям/exchange'ам, что и events (см. declare_topology).
+REQUEUE_EXCHANGE = "stats_events.requeue"
+DLQ = "stats_events.dlq"
+
+ATTEMPT_HEADER = "x-attempt"
+ERROR_HEADER = "x-error"
+ROUTING_KEY_HEADER = "x-original-routing-key"
+FAILED_AT_HEADER = "x-failed-at"
+# Заголовки, которые добавляют повтор и DLQ; при replay из DLQ они сбрасываются.
+RETRY_HEADERS = (ATTEMPT_HEADER, ERROR_HEADER, ROUTING_KEY_HEADER, FAILED_AT_HEADER)
+# Заголовки, которые RabbitMQ добавляет при dead-lettering (x-death, x-first-death-queue, ...).
+_DEATH_PREFIXES = ("x-death", "x-first-death", "x-last-death")
+
+
+def _without_death(headers: dict | None) -> dict:
+    return {k: v for k, v in (headers or {}).items() if not k.startswith(_DEATH_PREFIXES)}
+
+
+def retry_queue(delay_ms: int) -> str:
+    """Имя очереди задержки (и fanout exchange'а перед ней)."""
+    return f"stats_events.retry.{delay_ms}ms"
+
+
+def retry_queue_arguments(delay_ms: int) -> dict:
+    return {"x-message-ttl": delay_ms, "x-dead-letter-exchange": REQUEUE_EXCHANGE}
+
+
+def attempt_of(headers: dict | None) -> int:
+    """Номер текущей попытки обработки сообщения (первая доставка — 1)."""
+    try:
+        return max(1, int((headers or {}).get(ATTEMPT_HEADER, 1)))
+    except (TypeError, ValueError):
+        return 1
+
+
+def next_hop(routing_key: str, headers: dict | None, error: str, permanent: bool = False) -> tuple[str, str, dict]:
+    """Куда переопубликовать сообщение, которое не удалось обработать.
+
+    Возвращает (exchange, routing_key, headers). Пока попытки не исчерпаны —
+    fanout exchange очереди задержки (routing key сохраняется, по нему событие
+    вернётся в поток); permanent=True или последняя попытка — очередь DLQ.
+    """
+    headers = _without_death(headers)
+    headers[ERROR_HEADER] = error[:500]
+    attempt = attempt_of(headers)
+
+    if permanent or attempt >= STATS_RETRY_MAX_ATTEMPTS or not STATS_RETRY_DELAYS_MS:
+        headers[ROUTING_KEY_HEADER] = routing_key
+        headers[FAILED_AT_HEADER] = datetime.utcnow().isoformat(timespec="seconds")
+        return "", DLQ, headers
+
+    headers[ATTEMPT_HEADER] = attempt + 1
+    delay = STATS_RETRY_DELAYS_MS[min(attempt - 1, len(STATS_RETRY_DELAYS_MS) - 1)]
+    return retry_queue(delay), routing_key, headers
+
+
+def declare_retry_topology(ch) -> None:
+    """Объявляет (pika) exchange возврата, очереди задержки и DLQ."""
+    ch.exchange_declare(exchange=REQUEUE_EXCHANGE, exchange_type="topic", durable=True)
+    for delay in sorted(set(STATS_RETRY_DELAYS_MS)):
+        name = retry_queue(delay)
+        ch.exchange_declare(exchange=name, exchange_type="fanout", durable=True)
+        ch.queue_declare(queue=name, durable=True, arguments=retry_queue_arguments(delay))
+        ch.queue_bind(exchange=name, queue=name)
+    ch.queue_declare(queue=DLQ, durable=True)
+
+
+def replay_headers(headers: dict | None) -> tuple[str | None, dict]:
+    """Исходный routing key сообщения из DLQ и заголовки без служебных (счётчик попыток начинается заново)."""
+    headers = _without_death(headers)
+    routing_key = headers.get(ROUTING_KEY_HEADER)
+    if isinstance(routing_key, bytes):
+        routing_key = routing_key.decode()
+    return routing_key, {k: v for k, v in headers.items() if k not in RETRY_HEADERS}
@@ -1,31 +1,176 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from datetime import datetime, timedelta, timezone
+from typing import Literal
 
-from .db import get_db
-from .models import EventLog
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import func, select, type_coerce
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .db import get_read_db
+from .exporter import event_columns, event_json, export_csv, export_ndjson
+from .live import event_stream, parse_stream_cursor
+from .models import EventCountDaily, EventCountHourly, EventLog, UserStats, UserStatsBreakdown
 from .security import get_current_user_id
 
 router = APIRouter(prefix="/api/v1/stats", tags=["stats"])
 
+# Максимальное число точек в ответе /timeseries (ограничивает диапазон запроса).
+_TIMESERIES_MAX_POINTS = {"hour": 24 * 31, "day": 366 * 2}
+_TIMESERIES_DEFAULT_RANGE = {"hour": timedelta(hours=24), "day": timedelta(days=30)}
+
+
+def _utc_naive(value: datetime | None) -> datetime | None:
+    """created_at хранится в UTC без часового пояса — приводим параметр запроса к тому же виду."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
 
 @router.get(
     "/events",
     summary="Мои события",
-    description="Возвращает последние 50 событий (логов), связанных с действиями текущего пользователя. События формируются асинхронно через RabbitMQ.",
+    description="Возвращает последние 50 событий (логов), связанных с действиями текущего пользователя. События формируются асинхронно через RabbitMQ. Параметры item_id, platform и status отбирают события по полям payload (GIN-индекс по JSONB), from и to — по времени события (читаются только секции event_logs за этот период).",
 )
-def my_events(
-    db: Session = Depends(get_db),
+async def my_events(
+    from_: datetime | None = Query(default=None, alias="from", description="События не раньше этого момента (ISO 8601)"),
+    to: datetime | None = Query(default=None, description="События раньше этого момента (ISO 8601)"),
+    item_id: int | None = Query(default=None, description="Только события этой записи коллекции"),
+    platform: str | None = Query(default=None, max_length=64, description="Только события с этой платформой"),
+    status: str | None = Query(default=None, max_length=32, description="Только события с этим статусом"),
+    db: AsyncSession = Depends(get_read_db),
     user_id: int = Depends(get_current_user_id),
 ):
     """Возвращает последние 50 событий текущего пользователя из таблицы event_logs."""
-    rows = (
-        db.query(EventLog)
-        .filter(EventLog.user_id == user_id)
-        .order_by(EventLog.id.desc())
-        .limit(50)
-        .all()
+    stmt = select(*event_columns()).where(EventLog.user_id == user_id)
+    if from_ is not None:
+        stmt = stmt.where(EventLog.created_at >= _utc_naive(from_))
+    if to is not None:
+        stmt = stmt.where(EventLog.created_at < _utc_naive(to))
+    fields = {"item_id": item_id, "platform": platform, "status": status}
+    match = {key: value for key, value in fields.items() if value is not None}
+    if match:
+        # user_id есть и в самом payload: с ним условие целиком покрывается GIN-индексом по payload_json.
+        stmt = stmt.where(EventLog.payload_json.op("@>")(type_coerce({"user_id": user_id, **match}, JSONB)))
+    rows = (await db.execute(stmt.order_by(EventLog.id.desc()).limit(50))).all()
+    # payload приходит из БД текстом и вставляется в ответ без разбора и повторной сериализации.
+    return Response("[" + ",".join(event_json(r) for r in rows) + "]", media_type="application/json")
+
+
+@router.get(
+    "/events/export",
+    summary="Экспорт событий",
+    description="Потоково выгружает всю историю событий текущего пользователя в формате NDJSON или CSV. Строки читаются из БД серверным курсором, поэтому выгрузка начинается сразу и не требует памяти под всю историю.",
+)
+async def export_events(
+    format: Literal["ndjson", "csv"] = Query(default="ndjson"),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Стримит историю событий текущего пользователя (NDJSON/CSV)."""
+    if format == "csv":
+        body, media_type = export_csv(user_id), "text/csv; charset=utf-8"
+    else:
+        body, media_type = export_ndjson(user_id), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="events.{format}"'},
+    )
+
+
+@router.get(
+    "/events/stream",
+    summary="Поток событий (SSE)",
+    description="Server-Sent Events: присылает события текущего пользователя сразу после того, как consumer записал их в БД, вместо периодического опроса /events. При переподключении заголовок Last-Event-ID (EventSource передаёт его сам) продолжает поток с пропущенных событий. В простое раз в STATS_STREAM_HEARTBEAT секунд приходит комментарий keep-alive.",
+    response_class=StreamingResponse,
+)
+async def stream_events(
+    last_event_id: str | None = Header(default=None, alias="Last-Event-ID"),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Открывает поток SSE с событиями текущего пользователя."""
+    try:
+        resume_after = parse_stream_cursor(last_event_id) if last_event_id else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id from this stream")
+    return StreamingResponse(
+        event_stream(user_id, resume_after),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx не должен копить ответ в буфере.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/timeseries",
+    summary="Активность по времени",
+    description="Число событий текущего пользователя по часам или дням. Считается из свёрток event_counts_*, поэтому доступно и после удаления старых сырых событий; последние минуты появляются с задержкой до интервала обслуживания.",
+)
+async def my_timeseries(
+    granularity: Literal["hour", "day"] = Query(default="day"),
+    from_: datetime | None = Query(default=None, alias="from", description="Начало периода (по умолчанию — сутки/30 дней назад)"),
+    to: datetime | None = Query(default=None, description="Конец периода, не включая (по умолчанию — сейчас)"),
+    event_type: str | None = Query(default=None, max_length=128, description="Только события этого типа"),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Возвращает точки {bucket, events} из event_counts_hourly/daily; пустые интервалы пропускаются."""
+    end = _utc_naive(to) or datetime.utcnow()
+    start = _utc_naive(from_) or end - _TIMESERIES_DEFAULT_RANGE[granularity]
+    step = timedelta(hours=1) if granularity == "hour" else timedelta(days=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="'from' must be earlier than 'to'")
+    if (end - start) / step > _TIMESERIES_MAX_POINTS[granularity]:
+        raise HTTPException(status_code=400, detail=f"Range is too large for granularity={granularity}")
+
+    table = EventCountHourly if granularity == "hour" else EventCountDaily
+    # Интервал, в который попадает start, входит в ответ целиком.
+    start = start.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        start = start.replace(hour=0)
+    stmt = (
+        select(table.bucket, func.sum(table.events))
+        .where(table.user_id == user_id, table.bucket >= start, table.bucket < end)
+        .group_by(table.bucket)
+        .order_by(table.bucket)
     )
-    return [
-        {"id": r.id, "event_type": r.event_type, "payload_json": r.payload_json, "created_at": str(r.created_at)}
-        for r in rows
-    ]
+    if event_type is not None:
+        stmt = stmt.where(table.event_type == event_type)
+    rows = (await db.execute(stmt)).all()
+    return {
+        "granularity": granularity,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "points": [{"bucket": bucket.isoformat(), "events": int(events)} for bucket, events in rows],
+    }
+
+
+@router.get(
+    "/summary",
+    summary="Сводка по коллекции",
+    description="Возвращает число игр по статусам и платформам, общее количество и средний рейтинг. Агрегаты поддерживаются consumer'ом по событиям коллекции, поэтому ответ не зависит от размера коллекции.",
+)
+async def my_summary(
+    db: AsyncSession = Depends(get_read_db),
+    user_id: int = Depends(get_current_user_id),
+):
+    """Возвращает агрегаты коллекции текущего пользователя из user_stats."""
+    stats = await db.get(UserStats, user_id)
+    breakdown = (
+        await db.execute(
+            select(UserStatsBreakdown.dimension, UserStatsBreakdown.value, UserStatsBreakdown.item_count).where(
+                UserStatsBreakdown.user_id == user_id, UserStatsBreakdown.item_count > 0
+            )
+        )
+    ).all()
+
+    by_status = {value: count for dim, value, count in breakdown if dim == "status"}
+    by_platform = {value: count for dim, value, count in breakdown if dim == "platform"}
+    rated = stats.rated_items if stats else 0
+    return {
+        "total_items": stats.total_items if stats else 0,
+        "rated_items": rated,
+        "average_rating": round(stats.rating_sum / rated, 2) if rated else None,
+        "by_status": by_status,
+        "by_platform": by_platform,
+    }
@@ -0,0 +1,121 @@
+import logging
+import time
+
+from sqlalchemy import text
+
+from .db import Base, engine
+from .ingest import STATS_SEED_STATE
+from .models import EventCountDaily, EventCountHourly, EventLog, RollupState, UserStats, UserStatsBreakdown
+from .partitions import create_partitioned_table, ensure_future_partitions, migrate_unpartitioned
+
+# event_logs секционирована по месяцам и создаётся отдельно (см. partitions.py).
+STATS_TABLES = [
+    UserStats.__table__,
+    UserStatsBreakdown.__table__,
+    EventCountHourly.__table__,
+    EventCountDaily.__table__,
+    RollupState.__table__,
+]
+_SCHEMA_LOCK_ID = 7_301_001
+
+
+def seed_user_stats(conn, logger: logging.Logger) -> None:
+    """Один раз пересчитывает user_stats/user_stats_breakdown по текущему collection_items.
+
+    Дельты событий описывают только изменения, поэтому коллекции, собранные до
+    появления агрегатов, иначе в них не попадают (а удаление такой игры уводит
+    счётчики в минус). SHARE-блокировка collection_items дожидается незавершённых
+    записей и не пускает новые до конца транзакции: всё, что закоммичено до
+    снимка, в нём есть, а события более поздних изменений созданы не раньше
+    отметки времени снимка. Эту отметку (с точностью до секунды, как timestamp
+    AMQP) apply_aggregates использует, чтобы не учесть события из очереди дважды.
+    Выполняется, пока в rollup_state нет строки STATS_SEED_STATE; если таблицы
+    collection_items в этой БД нет — ничего не делает. Платформа берётся из каталога
+    games (как в событиях collection_service); строки, которые collection_service
+    ещё не перенёс в каталог, — со своей платформой.
+    """
+    if conn.execute(text("SELECT 1 FROM rollup_state WHERE name = :name"), {"name": STATS_SEED_STATE}).first():
+        return
+    if conn.exec_driver_sql("SELECT to_regclass('collection_items')").scalar() is None:
+        logger.warning("collection_items is not in this database, user_stats are not seeded")
+        return
+    conn.exec_driver_sql("LOCK TABLE collection_items IN SHARE MODE")
+    columns = {
+        row[0]
+        for row in conn.exec_driver_sql(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'collection_items'"
+        )
+    }
+    if "game_id" not in columns:
+        source, platform = "collection_items ci", "ci.platform"
+    else:
+        source = "collection_items ci LEFT JOIN games g ON g.id = ci.game_id"
+        platform = "coalesce(g.platform, ci.platform)" if "platform" in columns else "g.platform"
+    conn.exec_driver_sql("DELETE FROM user_stats_breakdown")
+    conn.exec_driver_sql("DELETE FROM user_stats")
+    conn.exec_driver_sql(
+        """
+        INSERT INTO user_stats (user_id, total_items, rated_items, rating_sum, updated_at)
+        SELECT user_id, count(*), count(rating), coalesce(sum(rating), 0), now() AT TIME ZONE 'utc'
+        FROM collection_items
+        GROUP BY user_id
+        """
+    )
+    conn.exec_driver_sql(
+        f"""
+        INSERT INTO user_stats_breakdown (user_id, dimension, value, item_count)
+        SELECT user_id, 'status', left(status, 64), count(*) FROM collection_items GROUP BY 1, 3
+        UNION ALL
+        SELECT ci.user_id, 'platform', left({platform}, 64), count(*) FROM {source} GROUP BY 1, 3
+        """
+    )
+    conn.execute(
+        text(
+            "INSERT INTO rollup_state (name, watermark) "
+            "VALUES (:name, date_trunc('second', statement_timestamp() AT TIME ZONE 'utc'))"
+        ),
+        {"name": STATS_SEED_STATE},
+    )
+    logger.info("user_stats seeded from collection_items")
+
+
+def ensure_schema(logger: logging.Logger) -> None:
+    """Создаёт таблицы event_logs (с секциями), user_stats* и event_counts_* (если их ещё нет).
+
+    При первом запуске засевает user_stats* по collection_items (seed_user_stats).
+
+    Вызывается и веб-приложением, и процессом consumer'а — кто стартует первым.
+    """
+    # Таблица users создаётся auth_service, но event_logs ссылается на users.id.
+    # Поэтому делаем несколько попыток на случай, если auth_service стартует чуть позже.
+    for attempt in range(1, 31):
+        try:
+            Base.metadata.create_all(bind=engine, tables=STATS_TABLES)
+            with engine.begin() as conn:
+                # Несколько процессов стартуют одновременно — миграцию event_logs выполняет один.
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SCHEMA_LOCK_ID})
+                kind = conn.exec_driver_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass('event_logs')").scalar()
+                if kind is None:
+                    create_partitioned_table(conn)
+                elif kind == "r":
+                    # event_logs из прошлых релизов — обычная таблица; переносим в секционированную.
+                    logger.info("Migrating event_logs to a partitioned table")
+                    migrate_unpartitioned(conn)
+                else:
+                    # Колонка появилась после секционирования; DEFAULT отдельно — без перезаписи секций.
+                    conn.exec_driver_sql("ALTER TABLE event_logs ADD COLUMN IF NOT EXISTS xact_id BIGINT")
+                    conn.exec_driver_sql(
+                        "ALTER TABLE event_logs ALTER COLUMN xact_id SET DEFAULT (pg_current_xact_id()::text::bigint)"
+                    )
+                    # create_all не добавляет новые индексы к уже существующей таблице.
+                    for index in EventLog.__table__.indexes:
+                        index.create(bind=conn, checkfirst=True)
+                    ensure_future_partitions(conn)
+                seed_user_stats(conn, logger)
+            logger.info("DB schema ensured (attempt %s)", attempt)
+            return
+        except Exception:
+            logger.exception("DB init failed (attempt %s/30). Retrying in 2s...", attempt)
+            time.sleep(2)
+    raise RuntimeError("DB init failed after retries")
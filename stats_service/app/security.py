@@ -1,41 +1,123 @@
+import hashlib
 import os
+import threading
+import time
+from collections import OrderedDict
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 
 JWT_SECRET = os.getenv("JWT_SECRET", "DUhBi61fh85J8fA47npzwo1PYXjXlsfjVXcoFRgKWcy")
 JWT_ALG = os.getenv("JWT_ALG", "HS256")
+# Сколько проверенных токенов держать в памяти процесса (0 — кэш выключен).
+JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+# Сколько хранить токен без claim'а exp (секунды).
+JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", "300"))
 
 bearer = HTTPBearer(auto_error=False)
 
 
+class ClaimsCache:
+    """LRU проверенных JWT: sha256(токен) -> (claims, момент истечения).
+
+    Запись живёт до exp токена, поэтому повторная проверка того же токена
+    сводится к поиску в словаре. Потокобезопасен.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items: OrderedDict[bytes, tuple[dict, float]] = OrderedDict()
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, key: bytes) -> dict | None:
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: bytes, claims: dict) -> None:
+        if self.size <= 0:
+            return
+        exp = claims.get("exp")
+        expires_at = float(exp) if isinstance(exp, (int, float)) else time.time() + JWT_CACHE_TTL
+        with self._lock:
+            self._items[key] = (claims, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+claims_cache = ClaimsCache(JWT_CACHE_SIZE)
+
+
 def _decode_token(creds: HTTPAuthorizationCredentials | None) -> dict:
-    """Достаёт и декодирует JWT из заголовка Authorization (Bearer)."""
+    """Достаёт и декодирует JWT из заголовка Authorization (Bearer).
+
+    Уже проверенные токены берутся из claims_cache без повторной проверки подписи.
+    Возвращаемый словарь общий для всех запросов с этим токеном — его нельзя изменять.
+    """
     if creds is None or creds.scheme.lower() != "bearer":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing Bearer token")
     token = creds.credentials
+    key = claims_cache.key(token)
+    claims = claims_cache.get(key)
+    if claims is not None:
+        return claims
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    claims_cache.put(key, claims)
+    return claims
+
+
+def jwt_cache_stats() -> dict:
+    """Счётчики кэша проверенных JWT."""
+    return claims_cache.snapshot()
 
 
-def get_current_user_id(
+async def get_current_user_id(
+    request: Request,
     creds: HTTPAuthorizationCredentials | None = Depends(bearer),
 ) -> int:
-    """Возвращает user_id (users.id) из JWT (claim: uid)."""
+    """Возвращает user_id (users.id) из JWT (claim: uid) и запоминает его для access-лога."""
     payload = _decode_token(creds)
     uid = payload.get("uid")
     if uid is None:
         raise HTTPException(status_code=401, detail="Invalid token")
     try:
-        return int(uid)
+        request.state.user_id = int(uid)
     except (TypeError, ValueError):
         raise HTTPException(status_code=401, detail="Invalid token")
+    return request.state.user_id
 
 
-def get_current_email(
+async def get_current_email(
     creds: HTTPAuthorizationCredentials | None = Depends(bearer),
 ) -> str:
     """Возвращает email из JWT (claim: sub). Используется для совместимости/отладки."""